@@ -3,6 +3,8 @@ var MS_URL = "http://localhost:8888";
 var MD_QUERY = "/metadata?subject.href=http://localhost:8888/nodes/519b8fd6164ed872c827ea4d";
 var INITIAL_DATA_QUERY = "";
 var UPDATE_INTERVAL = 2000; //query every update_interval in ms
+var MAX_UPDATE_INTERVAL = 60000; //idle metadata are queried less often, down to this
+var STREAM_WAIT = 25; //seconds the MS may hold a long poll of /stream
 mdids = {};
 function fill_mdids(data){
     for(var i = 0; i<data.length; i++){
@@ -73,55 +75,75 @@ var initial = $.get(UNIS_URL + MD_QUERY, {}, fill_mdids).then(get_initial_data);
 $.when(initial).then(start_updates);
 console.log("done");
 
-function start_updates(){
-    window.setInterval(
-	function () {
-	    console.log("doing update");
-	    for( var idd in mdids ){
-		var plot = mdids[idd]["plot"]
-		var plot_data = plot.series[0].data;
-		var dlen = plot_data.length;
-		var latest_ts = plot_data[dlen-1][0]*1000;
-		$.get(
-		    MS_URL + "/data/" + idd + "?ts=gt=" + latest_ts,
-		    {},
-		    (function (data) {
-			idd = this.idd;
-			dlist = parse_data(data);
-			if(dlist.length>0){
-			    mdids[idd]["plot"].series[0].data = mdids[idd]["plot"].series[0].data.concat(dlist);
-			    mdids[idd]["plot"].replot({resetAxes: true});
-			}
-		    }).bind({"idd": idd}));
-	    }
-	},
-	UPDATE_INTERVAL);
+function latest_ts(idd){
+    var plot_data = mdids[idd]["plot"].series[0].data;
+    var dlen = plot_data.length;
+    return dlen > 0 ? plot_data[dlen-1][0]*1000 : null;
 }
 
-$.when(initial).then(start_updates);
-console.log("done");
+function add_points(idd, dlist){
+    if(dlist.length>0){
+	mdids[idd]["plot"].series[0].data = mdids[idd]["plot"].series[0].data.concat(dlist);
+	mdids[idd]["plot"].replot({resetAxes: true});
+    }
+}
 
-function start_updates(){
-    window.setInterval(
-	function () {
-	    console.log("doing update");
-	    for( var idd in mdids ){
-		var plot = mdids[idd]["plot"]
-		var plot_data = plot.series[0].data;
-		var dlen = plot_data.length;
-		var latest_ts = plot_data[dlen-1][0]*1000;
-		$.get(
-		    MS_URL + "/data/" + idd + "?ts=gt=" + latest_ts,
-		    {},
-		    (function (data) {
-			idd = this.idd;
-			dlist = parse_data(data);
-			if(dlist.length>0){
-			    mdids[idd]["plot"].series[0].data = mdids[idd]["plot"].series[0].data.concat(dlist);
-			    mdids[idd]["plot"].replot({resetAxes: true});
-			}
-		    }).bind({"idd": idd}));
+// poll one metadata, waiting twice as long after every poll that brings no
+// points, up to MAX_UPDATE_INTERVAL
+function poll(idd, interval){
+    var ts = latest_ts(idd);
+    $.get(MS_URL + "/data/" + idd + (ts === null ? INITIAL_DATA_QUERY : "?ts=gt=" + ts))
+	.done(function (data) {
+	    var dlist = parse_data(data);
+	    add_points(idd, dlist);
+	    interval = dlist.length>0 ? UPDATE_INTERVAL :
+		Math.min(interval*2, MAX_UPDATE_INTERVAL);
+	})
+	.fail(function () {
+	    interval = Math.min(interval*2, MAX_UPDATE_INTERVAL);
+	})
+	.always(function () {
+	    window.setTimeout(function () { poll(idd, interval); }, interval);
+	});
+}
+
+// long poll the stream of the MS, it answers as soon as any metadata has
+// new points. An MS without /stream, or that the browser may not post to,
+// is polled instead.
+function stream(){
+    var since = {};
+    for( var idd in mdids ){
+	since[idd] = latest_ts(idd);
+    }
+    $.ajax({type: "POST",
+	    url: MS_URL + "/stream",
+	    data: JSON.stringify({since: since, wait: STREAM_WAIT}),
+	    // a simple request, application/json would need a CORS preflight
+	    contentType: "text/plain",
+	    dataType: "json"})
+	.done(function (data) {
+	    for( var idd in data ){
+		if(idd in mdids){
+		    add_points(idd, parse_data(data[idd]));
+		}
+	    }
+	    stream();
+	})
+	.fail(function (xhr) {
+	    // status 0: the request was refused before any answer, e.g. an MS
+	    // without /stream that sends no CORS headers for it
+	    if(xhr.status == 0 || xhr.status == 404 || xhr.status == 405 ||
+	       xhr.status == 501){
+		console.log("no stream, polling");
+		for( var idd in mdids ){
+		    poll(idd, UPDATE_INTERVAL);
+		}
+	    } else {
+		window.setTimeout(stream, UPDATE_INTERVAL);
 	    }
-	},
-	UPDATE_INTERVAL);
+	});
+}
+
+function start_updates(){
+    stream();
 }
@@ -0,0 +1,212 @@
+'''
+On-disk cache of the series plotted by ms_plot, so a restart loads the
+history from disk and only fetches the newer points from the MS.
+
+Every metadata has two append-only files in the cache directory, <id>.ts
+(int64 timestamps) and <id>.val (float64 values), that are memory-mapped to
+be read: the start of the retention window is found with a binary search
+over the mapped timestamps and only the points after it are copied.
+index.json keeps the time range covered by every series and when it was
+last used. When the files grow over the size cap the least recently used
+series are removed, except the ones plotted now.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import numpy as np
+
+log = logging.getLogger('cache')
+
+DEFAULT_DIR = os.path.expanduser("~/.periscope/ms_plot_cache")
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Seconds between two writes of the index
+FLUSH_INTERVAL = 10.0
+# Bytes per point, a timestamp and a value
+POINT_BYTES = 16
+INDEX = "index.json"
+SAFE_ID = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def file_name(md_id):
+    '''The file name of md_id, its sha1 when it is not a safe name.'''
+    if SAFE_ID.match(md_id) and not md_id.startswith('.'):
+        return md_id
+    return hashlib.sha1(md_id.encode('utf-8')).hexdigest()
+
+
+class SeriesCache(object):
+    '''The series of the metadata, stored in directory.
+
+    Params:
+        directory: the cache directory, created if needed
+        max_bytes: the size cap of the cached points
+    '''
+
+    def __init__(self, directory=DEFAULT_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = self._read_index()
+        # The series loaded or appended since the cache was opened
+        self.active = set()
+        self.dirty = False
+        self.flushed = time.time()
+
+    def _path(self, md_id, ext):
+        return os.path.join(self.directory, file_name(md_id) + ext)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _count(self, md_id):
+        '''The number of complete points on disk, an interrupted append
+        may have written more timestamps than values.'''
+        try:
+            return min(os.path.getsize(self._path(md_id, ".ts")),
+                       os.path.getsize(self._path(md_id, ".val"))) / 8
+        except OSError:
+            return 0
+
+    def _map(self, md_id, count):
+        return (np.memmap(self._path(md_id, ".ts"), dtype=np.int64,
+                          mode='r', shape=(count,)),
+                np.memmap(self._path(md_id, ".val"), dtype=np.float64,
+                          mode='r', shape=(count,)))
+
+    def _touch(self, md_id, **entry):
+        self.index.setdefault(md_id, {}).update(entry, used=time.time())
+        self.active.add(md_id)
+        self.dirty = True
+
+    def _refresh(self, md_id):
+        '''Updates the entry of md_id from its files, the index may be
+        older than them. Returns the number of points.'''
+        count = self._count(md_id)
+        if not count:
+            self.index.pop(md_id, None)
+            self._touch(md_id, first=None, last=None, count=0)
+            return 0
+        tss = self._map(md_id, count)[0]
+        self._touch(md_id, first=int(tss[0]), last=int(tss[-1]), count=count)
+        return count
+
+    def last_ts(self, md_id):
+        '''The latest cached timestamp of md_id, None if none is.'''
+        entry = self.index.get(md_id)
+        return entry["last"] if entry and entry.get("count") else None
+
+    def load(self, md_id, since=None):
+        '''Returns the cached (timestamps, values) of md_id after since
+        (microseconds), all of them if since is None.'''
+        count = self._refresh(md_id)
+        if not count:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        tss, vals = self._map(md_id, count)
+        start = 0 if since is None else int(np.searchsorted(tss, since,
+                                                             side='right'))
+        loaded = (np.array(tss[start:]), np.array(vals[start:]))
+        del tss, vals
+        if start and 2 * start >= count:
+            # Most of the file is older than the window, drop it
+            self._rewrite(md_id, *loaded)
+        return loaded
+
+    def _rewrite(self, md_id, tss, vals):
+        used = self.index.get(md_id, {}).get("used")
+        for ext, array in ((".ts", tss), (".val", vals)):
+            path = self._path(md_id, ext)
+            array.tofile(path + ".tmp")
+            os.rename(path + ".tmp", path)
+        self._touch(md_id, first=int(tss[0]) if len(tss) else None,
+                    last=int(tss[-1]) if len(tss) else None, count=len(tss))
+        if used is not None:
+            # Trimming a series is no use of it
+            self.index[md_id]["used"] = used
+
+    def append(self, md_id, tss, vals):
+        '''Appends the points of md_id, newer than the cached ones.'''
+        if not len(tss):
+            return
+        tss = np.asarray(tss, dtype=np.int64)
+        vals = np.asarray(vals, dtype=np.float64)
+        if md_id not in self.active:
+            self._refresh(md_id)
+        entry = self.index[md_id]
+        count = entry["count"]
+        if count and tss[0] <= entry["last"]:
+            newer = tss > entry["last"]
+            tss, vals = tss[newer], vals[newer]
+            if not len(tss):
+                return
+        for ext, array in ((".ts", tss), (".val", vals)):
+            with open(self._path(md_id, ext), 'ab') as f:
+                # Drop what an interrupted append left after the last
+                # complete point
+                f.truncate(count * 8)
+                array.tofile(f)
+        self._touch(md_id, first=entry["first"] if count else int(tss[0]),
+                    last=int(tss[-1]), count=count + len(tss))
+        self.evict()
+        if time.time() - self.flushed > FLUSH_INTERVAL:
+            self.flush()
+
+    def size(self):
+        '''The bytes of the cached points.'''
+        return sum(entry.get("count", 0) for entry in
+                   self.index.values()) * POINT_BYTES
+
+    def evict(self):
+        '''Removes the least recently used series, but the active ones,
+        until the cache fits its size cap. Then halves the largest active
+        series while they alone are over it.'''
+        size = self.size()
+        if size <= self.max_bytes:
+            return
+        for md_id, entry in sorted(self.index.items(),
+                                   key=lambda item: item[1].get("used", 0)):
+            if size <= self.max_bytes:
+                break
+            if md_id in self.active:
+                continue
+            log.info("Evicting %s from the cache" % md_id)
+            for ext in (".ts", ".val"):
+                try:
+                    os.remove(self._path(md_id, ext))
+                except OSError:
+                    pass
+            size -= entry.get("count", 0) * POINT_BYTES
+            del self.index[md_id]
+            self.dirty = True
+        while size > self.max_bytes:
+            md_id = max(self.active, key=lambda md_id:
+                        self.index.get(md_id, {}).get("count", 0))
+            count = self.index[md_id]["count"]
+            if count < 2:
+                break
+            log.info("Trimming %s in the cache" % md_id)
+            tss, vals = self._map(md_id, count)
+            self._rewrite(md_id, np.array(tss[count / 2:]),
+                          np.array(vals[count / 2:]))
+            del tss, vals
+            size = self.size()
+
+    def flush(self):
+        '''Writes the index if it changed.'''
+        self.flushed = time.time()
+        if not self.dirty:
+            return
+        path = os.path.join(self.directory, INDEX)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(self.index, f)
+        os.rename(path + ".tmp", path)
+        self.dirty = False
@@ -0,0 +1,74 @@
+'''
+Reduces a series to about as many points as the panel has pixels, so the
+cost of drawing a line does not grow with the length of the series.
+
+minmax keeps the lowest and the highest point of every pixel column, spikes
+are never lost. lttb (Largest-Triangle-Three-Buckets) keeps the point of
+every bucket that makes the largest triangle with its neighbours, which
+follows the shape of the line more closely.
+'''
+
+import numpy as np
+
+
+def minmax(x, y, xmin, xmax, pixels):
+    '''Keeps the lowest and the highest point of every one of pixels
+    columns between xmin and xmax. x must be sorted.'''
+    count = len(x)
+    if count <= 2 * pixels or xmax <= xmin:
+        return x, y
+    columns = np.floor((x - xmin) / float(xmax - xmin) *
+                       pixels).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, columns[1:] != columns[:-1]])
+    lengths = np.diff(np.r_[starts, count])
+    index = np.arange(count)
+    # The index of the first minimum and maximum of every column
+    lows = np.repeat(np.minimum.reduceat(y, starts), lengths)
+    highs = np.repeat(np.maximum.reduceat(y, starts), lengths)
+    first_low = np.minimum.reduceat(np.where(y == lows, index, count), starts)
+    first_high = np.minimum.reduceat(np.where(y == highs, index, count),
+                                     starts)
+    keep = np.union1d(first_low, first_high)
+    keep = keep[keep < count]
+    return x[keep], y[keep]
+
+
+def lttb(x, y, threshold):
+    '''Keeps threshold points of the series with
+    Largest-Triangle-Three-Buckets.'''
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return x, y
+    xf = x.astype(np.float64)
+    every = (count - 2) / float(threshold - 2)
+    # The first and the last points are kept, the others are split in
+    # threshold - 2 buckets
+    edges = (np.arange(threshold - 1) * every).astype(np.int64) + 1
+    edges = np.r_[edges, count]
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = count - 1
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) - 1 \
+            else count
+        avg_x = xf[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs((xf[selected] - avg_x) * (y[start:end] - y[selected]) -
+                       (xf[selected] - xf[start:end]) * (avg_y - y[selected]))
+        selected = start + int(areas.argmax())
+        keep[bucket + 1] = selected
+    return x[keep], y[keep]
+
+
+METHODS = ('minmax', 'lttb', 'none')
+
+
+def downsample(x, y, xmin, xmax, pixels, method='minmax'):
+    '''Reduces the series for a panel pixels wide showing xmin to xmax.'''
+    if method == 'minmax':
+        return minmax(x, y, xmin, xmax, pixels)
+    if method == 'lttb':
+        return lttb(x, y, pixels)
+    return x, y
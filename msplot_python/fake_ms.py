@@ -0,0 +1,158 @@
+'''
+Usage:
+  fake_ms.py [-p PORT] [-r RATE] [--no-stream]
+
+Options:
+  -p PORT --port=PORT   Port to listen on [default: 8888].
+  -r RATE --rate=RATE   Points per second of every series [default: 1].
+  --no-stream           Answer 404 to /stream, like an MS without it.
+
+A local stand-in for a Measurement Store, to try ms_plot and the stream
+client without BLiPP and an MS. Every metadata id has a point every 1/RATE
+seconds, except the ids starting with "idle" which never get new points.
+
+    GET  /data/<id>?limit=N       the last N points, newest first
+    GET  /data/<id>?ts=gt=TS      the points after TS, newest first
+    POST /stream                  {"since": {id: TS or null}, "wait": S}
+                                  answers as soon as one of the ids has
+                                  points after its TS (null: after now), or
+                                  after S seconds, with {id: [points]}
+    GET  /stats                   {"requests": N, "points": M}
+
+Every answer allows any origin (CORS), so ms_plot.js can be pointed at it
+from a file:// page.
+'''
+
+import BaseHTTPServer
+import json
+import math
+import SocketServer
+import threading
+import time
+import urlparse
+
+from docopt import docopt
+
+MAX_WAIT = 60
+DEFAULT_LIMIT = 10
+
+
+class FakeMS(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, rate=1.0, stream=True):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeMSHandler)
+        self.rate = rate
+        self.stream = stream
+        self.requests = 0
+        self.points_sent = 0
+        self.lock = threading.Lock()
+
+    def points(self, md_id, since, until, limit=None):
+        '''The points of md_id after since up to until (microseconds),
+        newest first.'''
+        if md_id.startswith("idle"):
+            return []
+        step = 1000000 / self.rate
+        last = int(math.floor(until / step))
+        first = int(math.floor(since / step)) + 1
+        if limit is not None:
+            first = max(first, last - limit + 1)
+        return [ {"ts": int(index * step), "value": index % 100}
+                 for index in range(last, first - 1, -1) ]
+
+    def next_point(self, since):
+        step = 1000000 / self.rate
+        return (math.floor(since / step) + 1) * step
+
+
+class FakeMSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_cors_headers()
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cors_headers(self):
+        # ms_plot.js is opened from file:// and queries the MS cross origin
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods',
+                         'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+
+    def count(self, points):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.points_sent += points
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        now = time.time() * 1000000
+        if url.path == '/stats':
+            self.reply(200, {"requests": self.server.requests,
+                             "points": self.server.points_sent})
+            return
+        if not url.path.startswith('/data/'):
+            self.count(0)
+            self.reply(404, {"error": "not found"})
+            return
+        md_id = url.path[len('/data/'):]
+        if url.query.startswith('ts=gt='):
+            points = self.server.points(md_id, int(url.query[6:]), now)
+        else:
+            query = urlparse.parse_qs(url.query)
+            limit = int(query.get('limit', [DEFAULT_LIMIT])[0])
+            points = self.server.points(md_id, 0, now, limit)
+        self.count(len(points))
+        self.reply(200, points)
+
+    def do_OPTIONS(self):
+        # The CORS preflight of the browsers
+        self.send_response(204)
+        self.send_cors_headers()
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/stream' or not self.server.stream:
+            self.count(0)
+            self.reply(404, {"error": "not found"})
+            return
+        request = json.loads(body)
+        now = time.time() * 1000000
+        since = dict((md_id, now if ts is None else ts)
+                     for md_id, ts in request["since"].items())
+        end = time.time() + min(request.get("wait", MAX_WAIT), MAX_WAIT)
+        while True:
+            now = time.time() * 1000000
+            points = dict((md_id, self.server.points(md_id, ts, now))
+                          for md_id, ts in since.items())
+            points = dict((md_id, pts) for md_id, pts in points.items()
+                          if pts)
+            if points or time.time() >= end:
+                break
+            live = [ ts for md_id, ts in since.items()
+                     if not md_id.startswith("idle") ]
+            wake = min(self.server.next_point(ts) for ts in live) / 1000000 \
+                if live else end
+            time.sleep(max(0.01, min(wake, end) - time.time()))
+        self.count(sum(len(pts) for pts in points.values()))
+        self.reply(200, points)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    server = FakeMS(('127.0.0.1', int(args['--port'])),
+                    float(args['--rate']), not args['--no-stream'])
+    print "Fake MS on http://127.0.0.1:%d" % server.server_address[1]
+    server.serve_forever()
@@ -1,17 +1,41 @@
 '''
 Usage:
   ms_plot <query-url>
+  ms_plot render --query=URL --out=DIR [options]
+
+Options:
+  --query=URL           UNIS /metadata URL (with its query) of the metadata
+  --out=DIR             Directory the figures are written to
+  --format=FORMAT       png or svg [default: png]
+  --per=GROUP           One figure per host, or per grid of panels
+                        [default: host]
+  --grid=N              Panels per figure with --per grid [default: 16]
+  --since=SECONDS       Seconds of points shown [default: 86400]
+  --processes=N         Rendering processes, 0 for one per CPU [default: 0]
+  --fetch-workers=N     Concurrent fetches from the MSes [default: 16]
+  --units=FILE          JSON file of more units, {prefix: [label, scale]}
+  -c CERT --cert=CERT   SSL cert location
+  -k KEY --key=KEY      SSL key location
 
 '''
 
 from docopt import docopt
 import requests
 import matplotlib
-from consts import ET_TO_YLABEL, ET_TO_TRANS
+import units
+from series import Series, parse_points
+from downsample import downsample
+from poller import Poller
+from cache import SeriesCache, DEFAULT_DIR, DEFAULT_MAX_BYTES
 from datetime import datetime
-matplotlib.use('GTKAgg') # do this before importing pylab
+import numpy as np
+import os
+from matplotlib.transforms import Bbox
+# Without a display (e.g. rendering reports on a server) only Agg works, do
+# this before importing pyplot
+if not os.environ.get('DISPLAY'):
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import time
 
 def setup_figure(fig):
     fig.subplotpars.hspace = 0.5
@@ -24,79 +48,227 @@ def setup_figure(fig):
 
 mds = []
 data = {}
-axes = {}
-AXES = {}
+panels = {}
+poller = None
+cache = None
 cert_key = None
-fig = setup_figure(plt.figure())
+fig = None
 YTICKNUM = 6
 XTICKNUM = 4
+# Milliseconds between two refreshes
+INTERVAL = 1000
+# Long poll the /stream of the MSes, the MSes without one are polled
+STREAM = True
+# Seconds every poll of the MSes waits for the fetches, the refreshes only
+# show the points fetched by then
+DEADLINE = 1.0
+# When new points fall outside a panel, its limits grow by this fraction of
+# the data range beyond them, so the whole figure is drawn again rarely
+HEADROOM = 0.5
+# The smallest x range of a panel, in microseconds
+MIN_XSPAN = 60 * 1000000
+# Seconds of points kept per series (None for all of them) and the most
+# points kept
+RETENTION = 24 * 3600
+MAX_POINTS = 200000
+# How the points are reduced to the pixel width of the panels, 'minmax',
+# 'lttb' or 'none'
+DOWNSAMPLE = 'minmax'
+# The directory of the on-disk cache of the series (None for no cache) and
+# its size cap in bytes
+CACHE_DIR = DEFAULT_DIR
+CACHE_SIZE = DEFAULT_MAX_BYTES
 def main(arguments):
     r = requests.get(arguments['<query-url>'], cert=cert_key, verify=False)
-    tss = [ x["ts"] for x in r.json() ]
-    vals = [ x["value"] for x in r.json() ]
+    tss, vals = parse_points(r.json())
     plt.plot(tss, vals)
     plt.show()
 
+def load_cached():
+    '''Loads the cached points of every metadata in the retention window,
+    returns them and the last cached timestamps.'''
+    cached, last = {}, {}
+    for md in mds:
+        since = cache.last_ts(md["id"])
+        if since is not None and RETENTION is not None:
+            since -= int(RETENTION * 1000000)
+        else:
+            since = None
+        cached[md["id"]] = cache.load(md["id"], since)
+        if cache.last_ts(md["id"]) is not None:
+            last[md["id"]] = cache.last_ts(md["id"])
+    return cached, last
+
 def plot_all():
-    global mds
+    global mds, poller, cache, fig
+    # A new figure of its own, not added to the panels of the last plot
+    data.clear()
+    panels.clear()
+    fig = setup_figure(plt.figure())
     plotnum = 0
     numrows = len(mds)/2
     if len(mds)%2==1:
         numrows += 1
+    # The cached history is loaded from disk and only the newer points are
+    # fetched, concurrently, then the poller keeps fetching in the
+    # background
+    cached, last = {}, {}
+    if CACHE_DIR:
+        cache = SeriesCache(CACHE_DIR, CACHE_SIZE)
+        cached, last = load_cached()
+    poller = Poller(mds, cert_key, INTERVAL / 1000., DEADLINE, stream=STREAM,
+                    last=last)
+    poller.poll(poller.timeout, every=True)
+    initial = poller.take()
     for md in mds:
-        data[md["id"]] = {}
+        series = data[md["id"]] = Series(retention=RETENTION,
+                                         max_points=MAX_POINTS)
         plotnum += 1
-        tss, vals = get_data(md, "?limit=10")
-        vals = map(ET_TO_TRANS[md["eventType"]], vals)
-        xticks = get_ticks(tss, XTICKNUM)
+        if md["id"] in cached:
+            tss, vals = cached[md["id"]]
+            series.append(tss, transform(md, vals))
+        if md["id"] in initial:
+            tss, vals = initial[md["id"]]
+            series.append(tss, transform(md, vals))
+            if cache:
+                cache.append(md["id"], tss, vals)
         ax = fig.add_subplot(numrows, 2, plotnum,
-                             xticklabels = get_ts_labels(xticks),
-                             xticks=xticks,
-                             ylabel = ET_TO_YLABEL[md["eventType"]])
-        ax.set_autoscale_on(True)
-        ax.autoscale_view(tight=False)
-        line, = ax.plot(tss, vals, '-bo')
-        AXES[md["id"]] = ax
-        axes[md["id"]] = line
-        td = data[md["id"]]
-        td["tss"] = tss
-        td["vals"] = vals
-        ax.set_title(':'.join(md["eventType"].split(':')[-3:]))
-    import gobject
-    gobject.idle_add(animate)
+                             ylabel = units.label(md["eventType"]))
+        ax.set_autoscale_on(False)
+        # Drawn by the blitting only, not part of the cached backgrounds
+        line, = ax.plot([], [], '-bo', animated=True)
+        name = ':'.join(md["eventType"].split(':')[-3:])
+        panel = panels[md["id"]] = Panel(ax, line, series, name)
+        panel.fit()
+        panel.update()
+    fig.canvas.mpl_connect('draw_event', on_draw)
+    fig.canvas.mpl_connect('close_event', on_close)
+    poller.start()
+    timer = fig.canvas.new_timer(interval=INTERVAL)
+    timer.add_callback(animate)
+    timer.start()
     plt.show()
 
 
+class Panel(object):
+    '''The axes and the single line of one series, titled with the running
+    statistics of the series. The limits only grow (with some headroom)
+    when new points fall outside of them.'''
+
+    def __init__(self, ax, line, series, name):
+        self.ax = ax
+        self.line = line
+        self.series = series
+        self.name = name
+        # The statistics change with every point, the title is drawn by the
+        # blitting with the line
+        self.title = ax.set_title(name, animated=True, fontsize='small')
+        self.background = None
+        self.region = None
+
+    def cache_background(self, renderer):
+        '''Keeps what the figure drew under the axes and the title.'''
+        top = self.title.get_window_extent(renderer).y1
+        bbox = self.ax.bbox
+        self.region = Bbox.from_extents(bbox.x0, bbox.y0, bbox.x1,
+                                        max(bbox.y1, top + 2))
+        self.title.set_clip_box(self.region)
+        self.background = self.ax.figure.canvas.copy_from_bbox(self.region)
+
+    def draw(self):
+        self.ax.draw_artist(self.line)
+        self.ax.draw_artist(self.title)
+
+    def fit(self):
+        '''Grows the limits to the series, returns True if they changed.'''
+        series = self.series
+        if not len(series):
+            return False
+        changed = False
+        first, last = series.first_ts(), series.last_ts()
+        xmin, xmax = self.ax.get_xlim()
+        if first < xmin or last > xmax:
+            span = max(last - first, MIN_XSPAN)
+            xmin, xmax = first, last + span * HEADROOM
+            xticks = get_ticks(np.array([xmin, xmax]), XTICKNUM)
+            self.ax.set_xlim(xmin, xmax)
+            self.ax.set_xticks(xticks)
+            self.ax.set_xticklabels(get_ts_labels(xticks))
+            changed = True
+        ymin, ymax = self.ax.get_ylim()
+        if series.vmin < ymin or series.vmax > ymax or changed:
+            span = (series.vmax - series.vmin) or abs(series.vmax) or 1.0
+            self.ax.set_ylim(series.vmin - span * HEADROOM / 2,
+                             series.vmax + span * HEADROOM / 2)
+            changed = True
+        return changed
+
+    def update(self):
+        '''Sets the line to the series, reduced to the panel width.'''
+        xmin, xmax = self.ax.get_xlim()
+        pixels = max(int(self.ax.bbox.width), 1)
+        self.line.set_data(*downsample(self.series.tss, self.series.vals,
+                                       xmin, xmax, pixels, DOWNSAMPLE))
+        self.title.set_text("%s\n%s" % (self.name, self.series.stats))
+
+
+def on_draw(event):
+    # The whole figure was drawn (resize, limits changed), cache the
+    # background of every panel and put the lines and titles back on top
+    for panel in panels.values():
+        panel.cache_background(event.renderer)
+        # The panel may have been resized
+        panel.update()
+        panel.draw()
+
+
+def on_close(event):
+    poller.stop()
+    if cache:
+        cache.flush()
+
+
 def animate():
-    plotnum = 0
-    while True:
-        time.sleep(1)
-        for md in mds:
-            plotnum += 1
-            td = data[md["id"]]
-            tss = td["tss"]
-            vals = td["vals"]
-            xtraq = "?ts=gt=%d"%(int(tss[-1]))
-            newtss, newvals = get_data(md, xtraq)
-            newvals = map(ET_TO_TRANS[md["eventType"]], newvals)
-            tss.extend(newtss)
-            vals.extend(newvals)
-            ax = AXES[md["id"]]
-            xticks = get_ticks(tss, XTICKNUM)
-            ax.set_xticks(xticks)
-            ax.set_xticklabels(get_ts_labels(xticks))
-            ax.plot(tss, vals, '-bo')
-        fig.canvas.draw()
+    # Only the points the poller already fetched, the GUI never waits
+    fetched = poller.take()
+    updated = []
+    for md in mds:
+        if md["id"] not in fetched:
+            continue
+        newtss, newvals = fetched[md["id"]]
+        data[md["id"]].append(newtss, transform(md, newvals))
+        if cache:
+            cache.append(md["id"], newtss, newvals)
+        updated.append(panels[md["id"]])
+    if not updated:
+        return
+    refit = [ panel.fit() for panel in updated ]
+    for panel in updated:
+        panel.update()
+    if any(refit) or not fig.canvas.supports_blit:
+        fig.canvas.draw_idle()
+        return
+    # Only the panels with new points are drawn again
+    for panel in updated:
+        if panel.background is None:
+            fig.canvas.draw_idle()
+            return
+    for panel in updated:
+        fig.canvas.restore_region(panel.background)
+        panel.draw()
+        fig.canvas.blit(panel.region)
 
 def get_data(metadata, xtraq=""):
     ms_url = metadata["parameters"]["config"]["ms_url"]
     r = requests.get(ms_url + "/data/" + metadata["id"] + xtraq, cert=cert_key, verify=False)
     return extract_data(r)
 
+def transform(metadata, vals):
+    return units.transform(metadata["eventType"], vals)
+
 def get_ticks(xdata, num_ticks):
-    sd = sorted(xdata)
-    top = float(sd[-1])
-    bot = float(sd[0])
+    top = float(np.max(xdata))
+    bot = float(np.min(xdata))
     skip = (top-bot)/float(num_ticks)
     if skip==0:
         top *= 1.1
@@ -115,18 +287,25 @@ def get_tick_labels(ticks):
 
 def extract_data(r):
     if not r:
-        return ([], [])
-    tss = [ r.json()[i]["ts"] for i in range(len(r.json())-1, -1, -1) ]
-    vals = [ float(r.json()[i]["value"]) for i in range(len(r.json())-1, -1, -1) ]
-    return tss, vals
+        return parse_points([])
+    # Parse the body once, the MS sends the newest points first
+    return parse_points(r.json())
 
 def get_ts_labels(tss):
-    labels = tss[:]
-    for i in range(len(labels)):
-        labels[i] = datetime.fromtimestamp(labels[i]/1000000).strftime('%H:%M:%S')
-    return labels
+    return [ datetime.fromtimestamp(ts/1000000).strftime('%H:%M:%S')
+             for ts in tss ]
 
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version = 'ms_plot 0.1')
-    main(arguments)
+    if arguments['--cert']:
+        cert_key = (arguments['--cert'],
+                    arguments['--key'] or arguments['--cert'])
+    if arguments['--units']:
+        units.load_units(arguments['--units'])
+    if arguments['render']:
+        # render imports this module
+        import render
+        render.main(arguments, cert_key)
+    else:
+        main(arguments)
@@ -1,17 +1,32 @@
 '''
-Usage: plotcmd.py <ms-url> [-c CERT] [-k KEY] [-u UNIS]
+Usage: plotcmd.py <ms-url> [-c CERT] [-k KEY] [-u UNIS] [-r SECONDS] [-d METHOD] [--poll]
+                 [--cache=DIR] [--cache-size=MB] [--no-cache] [--units=FILE]
 
 Options:
   -u UNIS --unis-url=UNIS   UNIS url [default: https://unis.incntre.iu.edu:8443].
   -c CERT --cert=CERT       SSL cert location
   -k KEY --key=KEY          SSL key location
+  -r SECONDS --retention=SECONDS  Seconds of points kept per plot [default: 86400].
+  -d METHOD --downsample=METHOD   Reduce the points to the plot width with
+                                  minmax, lttb or none [default: minmax].
+  --poll                    Poll the MS instead of long polling its /stream.
+  --cache=DIR               Directory of the on-disk cache of the series
+                            [default: ~/.periscope/ms_plot_cache].
+  --cache-size=MB           Size cap of the cache [default: 256].
+  --no-cache                Do not keep the series on disk.
+  --units=FILE              JSON file of more units of the eventType
+                            prefixes, {prefix: [label, scale]}.
 
 '''
 from dict_cmd import DictCmd
 from docopt import docopt
 from blipp.utils import query_string_from_dict
+import os
 import requests
 import ms_plot
+from render import Fetcher, DEFAULT_SINCE
+from stats import RunningStats
+import units
 
 class PlotCmd(DictCmd):
     def __init__(self, args):
@@ -24,6 +39,14 @@ class PlotCmd(DictCmd):
             self.cert_key = None
 
         ms_plot.cert_key = self.cert_key
+        ms_plot.RETENTION = float(args['--retention'])
+        ms_plot.DOWNSAMPLE = args['--downsample']
+        ms_plot.STREAM = not args['--poll']
+        ms_plot.CACHE_DIR = None if args['--no-cache'] \
+            else os.path.expanduser(args['--cache'])
+        ms_plot.CACHE_SIZE = int(float(args['--cache-size']) * 1024 * 1024)
+        if args['--units']:
+            units.load_units(args['--units'])
         self.md_list = [] # list of metadata object from MS
         DictCmd.__init__(self, {})
 
@@ -63,6 +86,28 @@ class PlotCmd(DictCmd):
         for md in self.md_list:
             print md["id"]
 
+    def do_stats(self, md_id):
+        '''stats [id]
+        print the running statistics of every metadata in self.md_list,
+        or of the one with the given id. The series of the last plot
+        are used, the others are fetched for the retention window.
+        '''
+        mds = [ md for md in self.md_list if not md_id or md["id"] == md_id ]
+        missing = [ md for md in mds if md["id"] not in ms_plot.data ]
+        fetched = {}
+        if missing:
+            fetcher = Fetcher(missing, self.cert_key,
+                              ms_plot.RETENTION or DEFAULT_SINCE)
+            for md in missing:
+                stats = fetched[md["id"]] = RunningStats()
+                stats.update(ms_plot.transform(md, fetcher.fetch(md)[1]))
+            fetcher.close()
+        for md in mds:
+            stats = ms_plot.data[md["id"]].stats if md["id"] in ms_plot.data \
+                else fetched[md["id"]]
+            print col.HEADER + md["id"] + col.ENDC, md["eventType"]
+            print "    " + str(stats)
+
     def do_plot(self, none):
         ms_plot.mds = self.md_list
         ms_plot.plot_all()
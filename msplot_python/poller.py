@@ -0,0 +1,246 @@
+'''
+Background polling of the Measurement Stores for ms_plot.
+
+The metadata are grouped by the MS they are stored in
+(parameters.config.ms_url) and every MS gets one keep-alive requests
+Session, so the connections (and the TLS handshakes with a client
+certificate) are reused between the polls. Every tick the new points of all
+the metadata are fetched concurrently; the tick waits at most its deadline,
+a slow fetch stays in flight and delivers its points to a later tick. The
+GUI only takes the points that were already fetched and never waits on the
+network.
+
+With stream, every MS gets one long poll instead (POST /stream with the
+last timestamp of each of its metadata, see fake_ms.py) that is answered as
+soon as any of them has new points, so the load follows the rate of the
+data rather than the number of panels. The metadata of an MS without
+/stream are polled, each at its own interval: the interval doubles after
+every poll that brings no points, up to max_interval, and drops back to
+interval when points arrive.
+'''
+
+import json
+import logging
+import multiprocessing.pool
+import threading
+import time
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from series import parse_points
+
+log = logging.getLogger('poller')
+
+DEFAULT_INTERVAL = 1.0
+DEFAULT_WORKERS = 16
+# Seconds a single request may take, it can span several ticks
+DEFAULT_TIMEOUT = 10.0
+# The points fetched for a metadata that has none yet
+INITIAL_QUERY = "?limit=10"
+# Idle metadata are polled less and less often, down to once every
+DEFAULT_MAX_INTERVAL = 30.0
+# Seconds the MS may hold a long poll before answering with no points
+STREAM_WAIT = 25
+# The answers of an MS that has no /stream
+NO_STREAM = (404, 405, 501)
+
+
+def ms_url(metadata):
+    return metadata["parameters"]["config"]["ms_url"]
+
+
+def group_by_ms(mds):
+    '''Returns a dict of MS URL and the list of its metadata.'''
+    groups = {}
+    for md in mds:
+        groups.setdefault(ms_url(md), []).append(md)
+    return groups
+
+
+def new_session(cert_key=None, connections=DEFAULT_WORKERS):
+    '''A session keeping up to connections connections to one MS.'''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.cert = cert_key
+    session.verify = False
+    return session
+
+
+class Poller(object):
+    '''Fetches the new points of every metadata in the background.
+
+    Params:
+        mds: the metadata to poll
+        cert_key: the client certificate and key, or None
+        interval: seconds between the ticks
+        deadline: seconds a tick waits for its fetches, defaults to interval
+        workers: the number of concurrent fetches
+        timeout: seconds a single request may take
+        stream: long poll the /stream of every MS, polling the metadata of
+            the MSes without one
+        max_interval: the longest interval between two polls of an idle
+            metadata
+        last: the last timestamp already known of some metadata, only the
+            newer points of these are fetched
+    '''
+
+    def __init__(self, mds, cert_key=None, interval=DEFAULT_INTERVAL,
+                 deadline=None, workers=DEFAULT_WORKERS,
+                 timeout=DEFAULT_TIMEOUT, stream=False,
+                 max_interval=DEFAULT_MAX_INTERVAL, last=None):
+        self.mds = list(mds)
+        self.interval = interval
+        self.deadline = interval if deadline is None else deadline
+        self.timeout = timeout
+        self.stream = stream
+        self.max_interval = max(interval, max_interval)
+        self.groups = group_by_ms(self.mds)
+        self.sessions = dict((url, new_session(cert_key, workers))
+                             for url in self.groups)
+        self.last = dict(last or {})
+        self.pending = {}
+        self.inflight = set()
+        # The metadata polled by the background thread, the others are
+        # streamed
+        self.polled = set() if stream else set(md["id"] for md in self.mds)
+        self.next_poll = {}
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.pool = multiprocessing.pool.ThreadPool(workers)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _add(self, md_id, tss, vals):
+        '''Queues the points of md_id newer than the last ones, returns
+        their number.'''
+        with self.lock:
+            last = self.last.get(md_id)
+            if last is not None and len(tss) and tss[0] <= last:
+                newer = tss > last
+                tss, vals = tss[newer], vals[newer]
+            if len(tss):
+                self.last[md_id] = int(tss[-1])
+                self.pending.setdefault(md_id, []).append((tss, vals))
+        return len(tss)
+
+    def _backoff(self, md_id, count):
+        '''Schedules the next poll of md_id after a poll that brought count
+        points.'''
+        idle = 0 if count else min(self.idle.get(md_id, 0) + 1, 32)
+        self.idle[md_id] = idle
+        self.next_poll[md_id] = time.time() + \
+            min(self.interval * 2 ** idle, self.max_interval)
+
+    def fetch(self, md):
+        '''Fetches the points of md newer than the last ones fetched.'''
+        count = 0
+        try:
+            last = self.last.get(md["id"])
+            xtraq = INITIAL_QUERY if last is None else "?ts=gt=%d" % last
+            url = ms_url(md)
+            r = self.sessions[url].get(url + "/data/" + md["id"] + xtraq,
+                                       timeout=self.timeout)
+            tss, vals = parse_points(r.json() if r else [])
+            count = self._add(md["id"], tss, vals)
+        except Exception, exp:
+            log.warning("Fetching %s failed: %s" % (md["id"], exp))
+        finally:
+            with self.lock:
+                self._backoff(md["id"], count)
+                self.inflight.discard(md["id"])
+
+    def poll(self, deadline=None, every=False):
+        '''Starts fetching the polled metadata that are due, or every
+        metadata, that are not in flight and waits for them until the
+        deadline.'''
+        deadline = self.deadline if deadline is None else deadline
+        now = time.time()
+        with self.lock:
+            mds = [ md for md in self.mds if md["id"] not in self.inflight and
+                    (every or (md["id"] in self.polled and
+                               self.next_poll.get(md["id"], 0) <= now)) ]
+            self.inflight.update(md["id"] for md in mds)
+        results = [ self.pool.apply_async(self.fetch, (md,)) for md in mds ]
+        end = time.time() + deadline
+        for result in results:
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            result.wait(remaining)
+
+    def take(self):
+        '''Returns the points fetched since the last call, a dict of
+        metadata id and (timestamps, values), without waiting.'''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        taken = {}
+        for md_id, batches in pending.items():
+            if len(batches) == 1:
+                taken[md_id] = batches[0]
+            else:
+                taken[md_id] = (np.concatenate([ b[0] for b in batches ]),
+                                np.concatenate([ b[1] for b in batches ]))
+        return taken
+
+    def run(self):
+        while not self._stop.is_set():
+            start = time.time()
+            self.poll()
+            self._stop.wait(max(0, self.interval - (time.time() - start)))
+
+    def listen(self, url):
+        '''Long polls the /stream of the MS at url until stop is called.
+        Falls back to polling its metadata if it has no /stream.'''
+        session = self.sessions[url]
+        ids = [ md["id"] for md in self.groups[url] ]
+        while not self._stop.is_set():
+            with self.lock:
+                since = dict((md_id, self.last.get(md_id)) for md_id in ids)
+            try:
+                r = session.post(url + "/stream",
+                                 data=json.dumps({"since": since,
+                                                  "wait": STREAM_WAIT}),
+                                 headers={"Content-Type": "application/json"},
+                                 timeout=STREAM_WAIT + self.timeout)
+                if r.status_code in NO_STREAM:
+                    log.info("%s has no /stream, polling it" % url)
+                    with self.lock:
+                        self.polled.update(ids)
+                    return
+                r.raise_for_status()
+                for md_id, points in r.json().items():
+                    if md_id in since:
+                        self._add(md_id, *parse_points(points))
+            except Exception, exp:
+                if self._stop.is_set():
+                    return
+                log.warning("Streaming from %s failed: %s" % (url, exp))
+                self._stop.wait(self.interval)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start(self):
+        '''Polls, and streams, in background threads until stop is
+        called.'''
+        self._threads.append(self._spawn(self.run))
+        if self.stream:
+            for url in self.groups:
+                self._spawn(self.listen, url)
+
+    def stop(self):
+        '''Stops polling after the current tick. The long polls are
+        abandoned.'''
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self.pool.close()
+        for session in self.sessions.values():
+            session.close()
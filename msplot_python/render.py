@@ -0,0 +1,192 @@
+'''
+Headless rendering of metrics to PNG or SVG files, e.g. nightly reports of
+every BLiPP host on a server without a display.
+
+The metadata are grouped in figures, one per host (the subject of the
+metadata) or grids of a fixed number of panels. The points of the figures
+are fetched concurrently by threads, over one keep-alive session per MS,
+and every figure is handed to a pool of processes drawing with Agg as soon
+as its points are in, so the fetches and the drawing overlap.
+'''
+
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import re
+import time
+
+import requests
+# Before matplotlib.backends, ms_plot picks the backend
+from ms_plot import (setup_figure, transform, get_ticks, get_ts_labels,
+                     XTICKNUM)
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from downsample import downsample
+from poller import group_by_ms, ms_url, new_session
+from series import parse_points
+from stats import RunningStats
+import units
+
+log = logging.getLogger('render')
+
+FORMATS = ('png', 'svg')
+GROUPS = ('host', 'grid')
+DEFAULT_GRID = 16
+DEFAULT_SINCE = 24 * 3600
+DEFAULT_FETCH_WORKERS = 16
+# Inches of a figure row of two panels, and its width
+PANEL_HEIGHT = 2.5
+FIGURE_WIDTH = 16
+DPI = 80
+SAFE_NAME = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def host_of(metadata):
+    '''The host the metadata is about, the last part of its subject.'''
+    href = metadata.get("subject", {}).get("href", "")
+    return href.rstrip('/').split('/')[-1] or "unknown"
+
+
+def group_figures(mds, per='host', grid=DEFAULT_GRID):
+    '''Returns a list of figure name and the metadata it shows.'''
+    if per == 'host':
+        figures = {}
+        for md in mds:
+            figures.setdefault(host_of(md), []).append(md)
+        return sorted(figures.items())
+    return [ ("grid%04d" % (start / grid), mds[start:start + grid])
+             for start in range(0, len(mds), grid) ]
+
+
+class Fetcher(object):
+    '''Fetches the points of the metadata after since, over one session
+    per MS.'''
+
+    def __init__(self, mds, cert_key=None, since=DEFAULT_SINCE,
+                 workers=DEFAULT_FETCH_WORKERS, timeout=30.0):
+        self.sessions = dict((url, new_session(cert_key, workers))
+                             for url in group_by_ms(mds))
+        self.since = int((time.time() - since) * 1000000)
+        self.timeout = timeout
+
+    def fetch(self, md):
+        url = ms_url(md)
+        try:
+            r = self.sessions[url].get(url + "/data/" + md["id"] +
+                                       "?ts=gt=%d" % self.since,
+                                       timeout=self.timeout)
+            r.raise_for_status()
+            return parse_points(r.json())
+        except Exception, exp:
+            log.warning("Fetching %s failed: %s" % (md["id"], exp))
+            return parse_points([])
+
+    def fetch_figure(self, figure):
+        '''Returns the figure with the points of every metadata.'''
+        name, mds = figure
+        return name, [ (md,) + self.fetch(md) for md in mds ]
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+
+def render_figure(job):
+    '''Draws the panels of a figure to path with Agg, returns the path.'''
+    name, panels, path, fmt = job
+    rows = max((len(panels) + 1) / 2, 1)
+    height = PANEL_HEIGHT * rows
+    fig = setup_figure(Figure(figsize=(FIGURE_WIDTH, height)))
+    FigureCanvasAgg(fig)
+    # Half an inch above the panels for the name, whatever the height
+    fig.subplots_adjust(top=1 - 0.5 / height, bottom=0.4 / height)
+    fig.suptitle(name)
+    pixels = FIGURE_WIDTH * DPI / 2
+    for plotnum, (md, tss, vals) in enumerate(panels):
+        ax = fig.add_subplot(rows, 2, plotnum + 1,
+                             ylabel=units.label(md["eventType"]))
+        name = ':'.join(md["eventType"].split(':')[-3:])
+        ax.set_title(name, fontsize='small')
+        if not len(tss):
+            continue
+        vals = transform(md, vals)
+        stats = RunningStats()
+        stats.update(vals)
+        ax.set_title("%s\n%s" % (name, stats), fontsize='small')
+        xmin, xmax = tss[0], tss[-1]
+        ax.plot(*downsample(tss, vals, xmin, xmax, pixels), color='b')
+        if xmax > xmin:
+            ax.set_xlim(xmin, xmax)
+        xticks = get_ticks(tss, XTICKNUM)
+        ax.set_xticks(xticks)
+        ax.set_xticklabels(get_ts_labels(xticks))
+    fig.savefig(path, format=fmt, dpi=DPI)
+    return path
+
+
+def render(mds, out, fmt='png', per='host', grid=DEFAULT_GRID,
+           since=DEFAULT_SINCE, processes=None,
+           fetch_workers=DEFAULT_FETCH_WORKERS, cert_key=None):
+    '''Renders the metadata to one file per figure in the directory out.
+
+    Params:
+        mds: the metadata to render
+        out: the output directory, created if needed
+        fmt: png or svg
+        per: 'host' for a figure per host, 'grid' for figures of grid panels
+        since: seconds of points shown
+        processes: the number of rendering processes, defaults to the
+            number of CPUs
+        fetch_workers: the number of concurrent fetches
+
+    Returns:
+        the paths of the files written
+    '''
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    figures = group_figures(mds, per, grid)
+    # Forked before any thread is started
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    fetcher = Fetcher(mds, cert_key, since, fetch_workers)
+    threads = multiprocessing.pool.ThreadPool(fetch_workers)
+    results = []
+    try:
+        for name, panels in threads.imap_unordered(fetcher.fetch_figure,
+                                                   figures):
+            path = os.path.join(out, "%s.%s" % (SAFE_NAME.sub('_', name),
+                                                fmt))
+            results.append(pool.apply_async(render_figure,
+                                            ((name, panels, path, fmt),)))
+        paths = []
+        for result in results:
+            try:
+                paths.append(result.get())
+            except Exception, exp:
+                log.warning("Rendering a figure failed: %s" % exp)
+    finally:
+        threads.close()
+        pool.close()
+        pool.join()
+        fetcher.close()
+    return paths
+
+
+def main(arguments, cert_key=None):
+    fmt = arguments['--format']
+    if fmt not in FORMATS:
+        raise SystemExit("--format must be one of %s" % ", ".join(FORMATS))
+    if arguments['--per'] not in GROUPS:
+        raise SystemExit("--per must be one of %s" % ", ".join(GROUPS))
+    r = requests.get(arguments['--query'], cert=cert_key, verify=False)
+    r.raise_for_status()
+    mds = r.json()
+    start = time.time()
+    paths = render(mds, arguments['--out'], fmt, arguments['--per'],
+                   int(arguments['--grid']), float(arguments['--since']),
+                   int(arguments['--processes']) or None,
+                   int(arguments['--fetch-workers']), cert_key)
+    elapsed = time.time() - start
+    print "Rendered %d panels in %d figures in %.1fs (%.0f panels/min)" % (
+        len(mds), len(paths), elapsed, len(mds) / elapsed * 60)
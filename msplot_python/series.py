@@ -0,0 +1,138 @@
+'''
+Columnar storage of the time series plotted by ms_plot.
+
+The points of every metadata are kept in two NumPy arrays, int64 timestamps
+(microseconds, as sent by the MS) and float64 values, that grow by doubling
+so appending a batch of new points costs amortized O(batch). The range of
+the values is tracked as the points are appended.
+
+A series may keep only the points of a retention window and at most a
+number of points. The arrays are then used as a ring buffer that is
+compacted when its end is reached: the retained points stay contiguous
+and can be plotted without a copy.
+
+The running statistics (stats.RunningStats) of every value appended, also
+the evicted ones, are kept in stats.
+'''
+
+import numpy as np
+
+from stats import RunningStats
+
+INITIAL_CAPACITY = 64
+
+
+def parse_points(points):
+    '''Splits the points of an MS /data response, newest first, into
+    arrays of timestamps and values, oldest first.'''
+    count = len(points)
+    tss = np.fromiter((point["ts"] for point in reversed(points)),
+                      dtype=np.int64, count=count)
+    vals = np.fromiter((point["value"] for point in reversed(points)),
+                       dtype=np.float64, count=count)
+    return tss, vals
+
+
+class Series(object):
+    '''The points of one metadata, oldest first.
+
+    Params:
+        capacity: the initial number of points the arrays hold
+        retention: only keep the points of the last retention seconds, None
+            to keep them all
+        max_points: keep at most this many points, None for no limit
+    '''
+
+    def __init__(self, capacity=INITIAL_CAPACITY, retention=None,
+                 max_points=None):
+        self._tss = np.empty(capacity, dtype=np.int64)
+        self._vals = np.empty(capacity, dtype=np.float64)
+        self._start = 0
+        self._end = 0
+        self.retention = retention
+        self.max_points = max_points
+        self.vmin = None
+        self.vmax = None
+        self.stats = RunningStats()
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def size(self):
+        return self._end - self._start
+
+    @property
+    def tss(self):
+        '''The timestamps, a view valid until the next append.'''
+        return self._tss[self._start:self._end]
+
+    @property
+    def vals(self):
+        '''The values, a view valid until the next append.'''
+        return self._vals[self._start:self._end]
+
+    def first_ts(self):
+        '''The earliest timestamp, None if the series is empty.'''
+        if not self.size:
+            return None
+        return int(self._tss[self._start])
+
+    def last_ts(self):
+        '''The latest timestamp, None if the series is empty.'''
+        if not self.size:
+            return None
+        return int(self._tss[self._end - 1])
+
+    def append(self, tss, vals):
+        '''Appends arrays (or sequences) of timestamps and values.'''
+        count = len(tss)
+        if not count:
+            return
+        if self._end + count > len(self._tss):
+            self._make_room(count)
+        end = self._end + count
+        self._tss[self._end:end] = tss
+        self._vals[self._end:end] = vals
+        batch = self._vals[self._end:end]
+        self.vmin = batch.min() if self.vmin is None \
+            else min(self.vmin, batch.min())
+        self.vmax = batch.max() if self.vmax is None \
+            else max(self.vmax, batch.max())
+        self._end = end
+        self.stats.update(batch)
+        self._evict()
+
+    def _make_room(self, count):
+        size = self.size
+        needed = size + count
+        capacity = len(self._tss)
+        if 2 * needed <= capacity:
+            # Compact in place, at least half of the arrays is free so this
+            # happens at most once per size appends. A series bounded by
+            # its retention settles at this capacity.
+            tss, vals = self._tss, self._vals
+        else:
+            capacity = max(2 * capacity, 2 * needed)
+            tss = np.empty(capacity, dtype=np.int64)
+            vals = np.empty(capacity, dtype=np.float64)
+        tss[:size] = self._tss[self._start:self._end]
+        vals[:size] = self._vals[self._start:self._end]
+        self._tss, self._vals = tss, vals
+        self._start, self._end = 0, size
+
+    def _evict(self):
+        start = self._start
+        if self.retention is not None:
+            oldest = self._tss[self._end - 1] - int(self.retention * 1000000)
+            start = self._start + int(np.searchsorted(self.tss, oldest))
+        if self.max_points is not None:
+            start = max(start, self._end - self.max_points)
+        if start == self._start:
+            return
+        evicted = self._vals[self._start:start]
+        self._start = start
+        # The range only has to be computed again when an extreme left
+        if evicted.min() <= self.vmin or evicted.max() >= self.vmax:
+            self.vmin = self.vals.min()
+            self.vmax = self.vals.max()
@@ -0,0 +1,130 @@
+'''
+Running statistics of the series plotted by ms_plot, updated as the points
+arrive so nothing has to go over the history again.
+
+The count, the range, the mean and the variance are merged batch by batch
+(Welford, with Chan's update for a batch), in constant memory. The
+percentiles are approximate: a compactor sketch (KLL) keeps up to k values
+per level, a full level is sorted and every other value moves up one level
+where it weighs twice as much. The memory is O(k log(n / k)) and the rank
+error is a few percent with the default k.
+'''
+
+import numpy as np
+
+DEFAULT_K = 256
+PERCENTILES = (50, 95, 99)
+
+
+class QuantileSketch(object):
+    '''Approximate quantiles of a stream of values.
+
+    Params:
+        k: the number of values a level holds before it is compacted
+    '''
+
+    def __init__(self, k=DEFAULT_K):
+        self.k = k
+        self.levels = [ np.empty(0) ]
+        self.random = np.random.RandomState()
+
+    def update(self, vals):
+        '''Adds an array of values.'''
+        self.levels[0] = np.concatenate((self.levels[0], vals))
+        level = 0
+        while len(self.levels[level]) >= self.k:
+            items = np.sort(self.levels[level])
+            # An odd value out stays at its level
+            kept = items[len(items) - len(items) % 2:]
+            items = items[:len(items) - len(items) % 2]
+            self.levels[level] = kept
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            promoted = items[self.random.randint(2)::2]
+            self.levels[level + 1] = np.concatenate((self.levels[level + 1],
+                                                     promoted))
+            level += 1
+
+    def quantiles(self, qs):
+        '''The approximate values at the quantiles qs (0 to 1), None if no
+        value was added.'''
+        vals = np.concatenate(self.levels)
+        if not len(vals):
+            return [ None for q in qs ]
+        weights = np.concatenate([ np.full(len(items), 2 ** level)
+                                   for level, items in
+                                   enumerate(self.levels) ])
+        order = np.argsort(vals, kind='mergesort')
+        vals = vals[order]
+        ranks = np.cumsum(weights[order])
+        positions = np.searchsorted(ranks, np.asarray(qs) * ranks[-1])
+        return [ float(vals[min(position, len(vals) - 1)])
+                 for position in positions ]
+
+
+class RunningStats(object):
+    '''The count, min, max, mean, variance and approximate percentiles of
+    every value added.'''
+
+    def __init__(self, k=DEFAULT_K):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sketch = QuantileSketch(k)
+        self._percentiles = None
+
+    def update(self, vals):
+        '''Adds an array of values.'''
+        vals = np.asarray(vals, dtype=np.float64)
+        count = len(vals)
+        if not count:
+            return
+        mean = vals.mean()
+        m2 = ((vals - mean) ** 2).sum()
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        low, high = vals.min(), vals.max()
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.sketch.update(vals)
+        self._percentiles = None
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+    def percentiles(self):
+        '''A dict of the PERCENTILES and their approximate values, computed
+        again only after an update.'''
+        if self._percentiles is None:
+            self._percentiles = dict(zip(PERCENTILES, self.sketch.quantiles(
+                [ p / 100. for p in PERCENTILES ])))
+        return self._percentiles
+
+    def summary(self):
+        '''A dict of all the statistics.'''
+        summary = {"count": self.count, "min": self.min, "max": self.max,
+                   "mean": self.mean if self.count else None,
+                   "std": self.std if self.count else None}
+        for p, value in self.percentiles().items():
+            summary["p%d" % p] = value
+        return summary
+
+    def __str__(self):
+        if not self.count:
+            return "no points"
+        percentiles = self.percentiles()
+        return "n %d  %.3g +- %.3g  p%s %s  [%.3g, %.3g]" % (
+            self.count, self.mean, self.std,
+            "/".join("%d" % p for p in PERCENTILES),
+            "/".join("%.3g" % percentiles[p] for p in PERCENTILES),
+            self.min, self.max)
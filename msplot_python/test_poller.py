@@ -0,0 +1,118 @@
+'''
+Tests of the Poller against the local stand-in MS (fake_ms.py), streaming
+and falling back to polling when the MS has no /stream.
+
+    python -m unittest test_poller
+'''
+
+import threading
+import time
+import unittest
+
+from fake_ms import FakeMS
+from poller import Poller
+
+# Points per second of every fake series
+RATE = 20.0
+
+
+def metadata(url, ids):
+    return [ {"id": md_id, "parameters": {"config": {"ms_url": url}}}
+             for md_id in ids ]
+
+
+class PollerTest(unittest.TestCase):
+    stream = True
+
+    def setUp(self):
+        self.server = FakeMS(('127.0.0.1', 0), RATE, self.stream)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.poller = None
+
+    def tearDown(self):
+        if self.poller is not None:
+            self.poller.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def start(self, ids, interval=0.1):
+        self.poller = Poller(metadata(self.url, ids), interval=interval,
+                             stream=True, max_interval=1.0, timeout=5.0)
+        self.poller.poll(5.0, every=True)
+        initial = self.poller.take()
+        self.poller.start()
+        return initial
+
+    def collect(self, seconds):
+        '''The points taken from the poller during seconds, by id.'''
+        taken = {}
+        end = time.time() + seconds
+        while time.time() < end:
+            time.sleep(0.1)
+            for md_id, (tss, vals) in self.poller.take().items():
+                taken.setdefault(md_id, []).extend(tss)
+        return taken
+
+
+class StreamTest(PollerTest):
+
+    def test_stream(self):
+        ids = [ "live%d" % i for i in range(5) ]
+        initial = self.start(ids)
+        self.assertEqual(sorted(initial), ids)
+        requests = self.server.requests
+        taken = self.collect(1.5)
+        self.assertEqual(sorted(taken), ids)
+        for md_id in ids:
+            tss = taken[md_id]
+            # Every point once, in order, after the initial ones
+            self.assertEqual(tss, sorted(set(tss)))
+            self.assertTrue(tss[0] > initial[md_id][0][-1])
+            self.assertTrue(len(tss) >= RATE)
+        # The metadata are streamed, not polled
+        self.assertFalse(self.poller.polled)
+        # One long poll per batch of points, not one request per metadata
+        # and tick
+        self.assertTrue(self.server.requests - requests <= 2 * RATE * 1.5)
+
+    def test_idle(self):
+        initial = self.start(["idle0", "live0"])
+        self.assertEqual(sorted(initial), ["live0"])
+        taken = self.collect(1.0)
+        self.assertEqual(sorted(taken), ["live0"])
+
+
+class NoStreamTest(PollerTest):
+    stream = False
+
+    def test_fallback(self):
+        ids = [ "live%d" % i for i in range(3) ]
+        self.start(ids)
+        taken = self.collect(1.5)
+        self.assertEqual(self.poller.polled, set(ids))
+        self.assertEqual(sorted(taken), ids)
+        for md_id in ids:
+            self.assertEqual(taken[md_id], sorted(set(taken[md_id])))
+            self.assertTrue(len(taken[md_id]) >= RATE)
+
+    def test_backoff(self):
+        self.start(["idle0", "live0"])
+        fetched = {}
+        fetch = self.poller.fetch
+        def counting_fetch(md):
+            fetched[md["id"]] = fetched.get(md["id"], 0) + 1
+            fetch(md)
+        self.poller.fetch = counting_fetch
+        self.collect(1.5)
+        # The idle metadata waits longer and longer between its polls, the
+        # live one is polled every interval
+        self.assertTrue(self.poller.idle["idle0"] >= 2)
+        self.assertEqual(self.poller.idle["live0"], 0)
+        self.assertTrue(fetched["idle0"] * 2 < fetched["live0"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+'''
+The units of the eventTypes plotted by ms_plot: the label of the y axis and
+the transform of the values the MS sends.
+
+Units are registered for eventType prefixes, e.g.
+"ps:tools:blipp:linux:memory", in a trie of the ':' separated parts. An
+eventType gets the unit of its longest registered prefix, so the eventTypes
+nobody listed still plot with the unit of their family, or raw under the
+root unit "". A resolved eventType is cached until the next registration,
+and a transform is applied to a whole array of values at once.
+
+More units can be registered with register_unit, or read from a JSON file
+of {prefix: [label, scale]} with load_units (ms_plot --units).
+'''
+
+import json
+
+import numpy as np
+
+from consts import UNITS
+
+SEP = ':'
+
+
+class Unit(object):
+    '''A y axis label and the transform of the values, a scale factor or a
+    function of a float64 array returning an array.'''
+
+    def __init__(self, label, scale=1.0, func=None):
+        self.label = label
+        self.scale = scale
+        self.func = func
+
+    def apply(self, vals):
+        vals = np.asarray(vals, dtype=np.float64)
+        if self.func is not None:
+            return self.func(vals)
+        if self.scale == 1.0:
+            return vals
+        return vals * self.scale
+
+
+class UnitRegistry(object):
+    '''The units of the eventType prefixes.'''
+
+    def __init__(self, units=()):
+        # Every node is a dict of the next parts and their nodes, the unit
+        # of the prefix ending at a node is under None
+        self.trie = {}
+        self.resolved = {}
+        for unit in units:
+            self.register(*unit)
+
+    def register(self, prefix, label, scale=1.0, func=None):
+        '''Registers the unit of the eventTypes starting with the parts of
+        prefix, "" for all of them.'''
+        node = self.trie
+        for part in prefix.split(SEP) if prefix else []:
+            node = node.setdefault(part, {})
+        node[None] = Unit(label, scale, func)
+        self.resolved = {}
+
+    def resolve(self, event_type):
+        '''The unit of the longest registered prefix of event_type.'''
+        unit = self.resolved.get(event_type)
+        if unit is not None:
+            return unit
+        node = self.trie
+        unit = node.get(None)
+        for part in event_type.split(SEP):
+            node = node.get(part)
+            if node is None:
+                break
+            unit = node.get(None, unit)
+        if unit is None:
+            raise KeyError("No unit for %s" % event_type)
+        self.resolved[event_type] = unit
+        return unit
+
+    def label(self, event_type):
+        return self.resolve(event_type).label
+
+    def transform(self, event_type, vals):
+        '''The array of vals in the unit of event_type.'''
+        return self.resolve(event_type).apply(vals)
+
+    def load(self, filename):
+        '''Registers the units of a JSON file of {prefix: [label, scale]}.'''
+        with open(filename) as f:
+            units = json.load(f)
+        for prefix, unit in units.items():
+            if isinstance(unit, basestring):
+                unit = [unit]
+            self.register(prefix, *unit)
+
+
+registry = UnitRegistry(UNITS)
+register_unit = registry.register
+load_units = registry.load
+resolve = registry.resolve
+label = registry.label
+transform = registry.transform
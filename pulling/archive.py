@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+A local archive of the pulled and encoded documents.
+
+Documents are stored once per content, gzip compressed and named by the
+sha1 of their content, under objects/. An append-only index records every
+archived document with its URN, kind ('raw' as pulled, 'encoded' as sent to
+UNIS), document type, time and, for the encoded documents, the digest of
+the raw document they were encoded from.
+
+Run as a script the archive re-encodes the raw documents (after an encoder
+upgrade) and pushes the encoded ones to UNIS without pulling anything:
+
+    archive.py -a ~/.periscope/archive list
+    archive.py -a ~/.periscope/archive reencode -e unisencoder
+    archive.py -a ~/.periscope/archive push -u http://unis:8888
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing.pool
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import time
+
+from encoder import EncoderPool
+from uploader import Uploader, DEFAULT_WORKERS as DEFAULT_UPLOAD_WORKERS
+
+
+log = logging.getLogger('archive')
+
+RAW = 'raw'
+ENCODED = 'encoded'
+
+# The UNIS collection the documents of every type are pushed to
+COLLECTIONS = {'ps': 'topologies', 'rspec3': 'domains'}
+# The document types the encoder is given the URN of ('-m')
+PASS_URN = ('rspec3',)
+
+COPY_CHUNK = 64 * 1024
+
+
+class Archive(object):
+    """
+    A content addressed store of documents indexed by URN and time.
+
+    Params:
+        directory: the archive directory, created if missing
+    """
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.objects = os.path.join(self.directory, 'objects')
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+        self.index_file = os.path.join(self.directory, 'index')
+        self.index = []
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file) as index:
+            for line in index:
+                try:
+                    self.index.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a crash
+                    log.warning("Skipping a broken index line in %s" % \
+                        self.index_file)
+
+    def path(self, digest):
+        """
+        The file holding the document of digest.
+        """
+        return os.path.join(self.objects, digest[:2], digest[2:] + '.gz')
+
+    def put(self, urn, kind, document, doc_type, source=None):
+        """
+        Archives one document.
+
+        Params:
+            urn: the URN of the source of the document
+            kind: RAW or ENCODED
+            document: the document as a string or a file like object
+                positioned at its start
+            doc_type: the unisencoder document type ('ps', 'rspec3')
+            source: the digest of the raw document an encoded one comes from
+
+        Returns:
+            the digest of the document
+        """
+        if isinstance(document, basestring):
+            chunks = [document]
+        else:
+            chunks = iter(lambda: document.read(COPY_CHUNK), '')
+        sha1 = hashlib.sha1()
+        size = 0
+        tmpf = tempfile.NamedTemporaryFile(dir=self.objects, delete=False)
+        try:
+            gz = gzip.GzipFile(fileobj=tmpf, mode='wb')
+            for chunk in chunks:
+                sha1.update(chunk)
+                size += len(chunk)
+                gz.write(chunk)
+            gz.close()
+            tmpf.close()
+            digest = sha1.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                os.remove(tmpf.name)
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    try:
+                        os.makedirs(os.path.dirname(path))
+                    except OSError:
+                        # Created by another thread
+                        pass
+                os.rename(tmpf.name, path)
+        except:
+            tmpf.close()
+            if os.path.exists(tmpf.name):
+                os.remove(tmpf.name)
+            raise
+        entry = {'urn': urn, 'kind': kind, 'type': doc_type,
+                 'digest': digest, 'size': size, 'time': time.time()}
+        if source is not None:
+            entry['source'] = source
+        with self._lock:
+            with open(self.index_file, 'a') as index:
+                index.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.index.append(entry)
+        return digest
+
+    def get(self, digest):
+        """
+        The document of digest.
+        """
+        with gzip.open(self.path(digest), 'rb') as doc:
+            return doc.read()
+
+    def entries(self, urn=None, kind=None, since=None, until=None):
+        """
+        The index entries matching all the given criteria, oldest first.
+
+        Params:
+            urn: the URN of the source
+            kind: RAW or ENCODED
+            since: the earliest archive time (seconds since the epoch)
+            until: the latest archive time
+        """
+        with self._lock:
+            entries = list(self.index)
+        return [entry for entry in entries
+                if (urn is None or entry['urn'] == urn) and
+                (kind is None or entry['kind'] == kind) and
+                (since is None or entry['time'] >= since) and
+                (until is None or entry['time'] <= until)]
+
+    def latest(self, kind, urn=None, until=None):
+        """
+        The latest entry of every URN.
+
+        Returns:
+            a dict of URN and index entry
+        """
+        latest = {}
+        for entry in self.entries(urn, kind, until=until):
+            latest[entry['urn']] = entry
+        return latest
+
+
+def reencode(archive, unisencoder, workers, entry=None, urn=None,
+             until=None):
+    """
+    Encodes the latest raw document of every URN again and archives the
+    results.
+
+    Returns:
+        a tuple of (number of documents encoded, number of failures)
+    """
+    documents = archive.latest(RAW, urn, until)
+    if not documents:
+        return 0, 0
+    workers = min(workers, len(documents))
+    encoder_pool = EncoderPool(workers, unisencoder, entry)
+
+    # One document per worker in memory at a time
+    def encode(item):
+        key, raw = item
+        status, body = encoder_pool.encode(
+            raw['type'], key if raw['type'] in PASS_URN else None,
+            archive.get(raw['digest']))
+        if status != 0:
+            log.error("Encoding %s failed with status %s" % (key, status))
+            return False
+        archive.put(key, ENCODED, body, raw['type'], raw['digest'])
+        return True
+
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        results = pool.map(encode, documents.items(), chunksize=1)
+    finally:
+        pool.close()
+        encoder_pool.close()
+    return results.count(True), results.count(False)
+
+
+def push(archive, unis_url, uploader, urn=None, until=None):
+    """
+    Pushes the latest encoded document of every URN to UNIS, on up to
+    uploader.workers uploads in parallel.
+
+    Returns:
+        a dict of URN and UploadResult
+    """
+    documents = archive.latest(ENCODED, urn, until)
+    if not documents:
+        return {}
+
+    # One document per upload in memory at a time
+    def upload(item):
+        key, encoded = item
+        url = '%s/%s' % (unis_url, COLLECTIONS[encoded['type']])
+        return uploader.upload_body(key, archive.get(encoded['digest']), url)
+
+    pool = multiprocessing.pool.ThreadPool(min(uploader.workers,
+                                               len(documents)))
+    try:
+        results = pool.map(upload, sorted(documents.items()), chunksize=1)
+    finally:
+        pool.close()
+    return dict((result.urn, result) for result in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Lists, re-encodes and pushes archived documents.")
+    parser.add_argument('-a', '--archive', required=True,
+        help='The archive directory.')
+    parser.add_argument('--urn', default=None,
+        help='Only this URN.')
+    parser.add_argument('--until', type=float, default=None,
+        help='Use the latest documents archived before this time (seconds '
+        'since the epoch).')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='List the archived documents.')
+    reencode_parser = commands.add_parser('reencode',
+        help='Encode the latest raw documents again.')
+    reencode_parser.add_argument('-e', '--encoder', default='unisencoder',
+        help='The unisencoder executable.')
+    reencode_parser.add_argument('-w', '--workers', type=int, default=4,
+        help='The number of encoder workers.')
+    reencode_parser.add_argument('--encoder-entry', default=None,
+        help='The unisencoder entry point (module:function).')
+    push_parser = commands.add_parser('push',
+        help='Push the latest encoded documents to UNIS.')
+    push_parser.add_argument('-u', '--unis_url', required=True,
+        help='The URL of the UNIS instance.')
+    push_parser.add_argument('--upload-workers', type=int, default=None,
+        help='The maximum number of parallel uploads to UNIS.')
+    push_parser.add_argument('--no-compress', action='store_true',
+        default=False, help='Do not gzip the documents sent to UNIS.')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+    logging.getLogger().addHandler(handler)
+
+    archive = Archive(args.archive)
+    if args.command == 'list':
+        for entry in archive.entries(args.urn, until=args.until):
+            print "%s %-7s %-6s %s %8d %s" % \
+                (time.strftime('%Y-%m-%d %H:%M:%S',
+                               time.localtime(entry['time'])),
+                 entry['kind'], entry['type'], entry['digest'],
+                 entry['size'], entry['urn'])
+    elif args.command == 'reencode':
+        encoded, failed = reencode(archive, args.encoder, args.workers,
+                                   args.encoder_entry, args.urn, args.until)
+        log.info("Encoded %d documents, %d failed" % (encoded, failed))
+        if failed:
+            return 1
+    else:
+        uploader = Uploader(
+            workers=args.upload_workers or DEFAULT_UPLOAD_WORKERS,
+            compress=not args.no_compress)
+        try:
+            results = push(archive, args.unis_url, uploader, args.urn,
+                           args.until)
+        finally:
+            uploader.close()
+        failed = [urn for urn, result in results.items() if not result.ok]
+        log.info("Pushed %d documents to UNIS, %d failed" % \
+            (len(results) - len(failed), len(failed)))
+        if failed:
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
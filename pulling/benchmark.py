@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+"""
+Benchmarks ps_pull.py, am_pull.py and pull.py against local stand-ins of
+their services, so the throughput of the pull scripts can be measured
+without perfSONAR, omni or UNIS.
+
+The stand-ins are:
+    - a SOAP Topology Service answering with NMWG topologies of a
+      configurable number of nodes, spread over several loopback addresses
+    - omni and unisencoder executables with a configurable latency
+    - a UNIS sink accepting and counting the documents
+
+The 'mixed' script runs pull.py with half of the sources being topology
+services and the other half aggregate managers, in one process.
+
+Every script is run at every number of sources, the report gives the runs
+per second, the sources per second, the p50 and p99 of every stage (from
+the metrics of the scripts) and the peak RSS of the script.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import os.path
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from metrics import percentile
+
+
+NMWG = "http://ggf.org/ns/nmwg/base/2.0/"
+NMTOPO = "http://ogf.org/schema/network/topology/base/20070828/"
+
+DEFAULT_SOURCES = '10,100,1000'
+DEFAULT_NODES = 50
+DEFAULT_HOSTS = 8
+DEFAULT_RUNS = 3
+SCRIPTS = ('ps', 'am')
+SCRIPT_FILES = {'ps': 'ps_pull.py', 'am': 'am_pull.py', 'mixed': 'pull.py'}
+
+
+def nmwg_response(nodes):
+    """
+    A SOAP Topology Service response with a topology of nodes nodes.
+    """
+    elements = []
+    for index in range(nodes):
+        elements.append(
+            '<nmtopo:node id="urn:ogf:network:domain=bench:node=n%d">'
+            '<nmtopo:name>n%d</nmtopo:name>'
+            '<nmtopo:port id="urn:ogf:network:domain=bench:node=n%d:'
+            'port=eth0"><nmtopo:capacity>10000000000</nmtopo:capacity>'
+            '</nmtopo:port></nmtopo:node>' % (index, index, index))
+    return (
+        '<SOAP-ENV:Envelope '
+        'xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">'
+        '<SOAP-ENV:Header/><SOAP-ENV:Body>'
+        '<nmwg:message xmlns:nmwg="%s" type="QueryResponse">'
+        '<nmwg:metadata id="meta0"/><nmwg:data metadataIdRef="meta0">'
+        '<nmtopo:topology xmlns:nmtopo="%s">'
+        '<nmtopo:domain id="urn:ogf:network:domain=bench">%s</nmtopo:domain>'
+        '</nmtopo:topology></nmwg:data></nmwg:message>'
+        '</SOAP-ENV:Body></SOAP-ENV:Envelope>' % \
+        (NMWG, NMTOPO, ''.join(elements)))
+
+
+def rspec(url, nodes):
+    """
+    An advertisement RSpec of nodes nodes.
+    """
+    elements = ''.join(
+        '<node component_id="urn:publicid:IDN+bench+node+n%d" '
+        'component_name="n%d"><interface component_id='
+        '"urn:publicid:IDN+bench+interface+n%d:eth0"/></node>' % \
+        (index, index, index) for index in range(nodes))
+    return '<rspec type="advertisement" source="%s">%s</rspec>' % \
+        (url, elements)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def consume(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+class FakeService(object):
+    """
+    An HTTP server run in a thread.
+
+    Params:
+        handler: the BaseHTTPRequestHandler class
+        host: the address to listen on, the port is picked by the system
+    """
+    def __init__(self, handler, host='127.0.0.1'):
+        self.server = _Server((host, 0), handler)
+        self.server.service = self
+        self.url = 'http://%s:%d' % self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _TopologyHandler(_Handler):
+    def do_POST(self):
+        self.consume()
+        self.reply(200, self.server.service.response)
+
+
+class FakeTopologyService(FakeService):
+    """
+    A perfSONAR Topology Service answering every query with the same
+    topology.
+
+    Params:
+        nodes: the number of nodes of the topology
+        host: the address to listen on
+    """
+    def __init__(self, nodes=DEFAULT_NODES, host='127.0.0.1'):
+        self.response = nmwg_response(nodes)
+        FakeService.__init__(self, _TopologyHandler, host)
+
+
+class _UNISHandler(_Handler):
+    def do_POST(self):
+        body = self.consume()
+        self.server.service.received(len(body))
+        self.reply(201)
+
+    do_PUT = do_POST
+
+    def do_DELETE(self):
+        self.server.service.received(0)
+        self.reply(204)
+
+
+class FakeUNIS(FakeService):
+    """
+    A UNIS instance accepting every document.
+
+    Attributes:
+        requests: the number of requests received
+        bytes: the number of body bytes received
+    """
+    def __init__(self, host='127.0.0.1'):
+        self.requests = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        FakeService.__init__(self, _UNISHandler, host)
+
+    def received(self, nbytes):
+        with self._lock:
+            self.requests += 1
+            self.bytes += nbytes
+
+
+def fake_omni(argv):
+    """
+    Stands in for 'omni.py -c conf -a url listresources --outputfile=file'.
+    """
+    parser = argparse.ArgumentParser(prog='fake-omni')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--nodes', type=int, default=DEFAULT_NODES)
+    parser.add_argument('-c')
+    parser.add_argument('-a')
+    parser.add_argument('--outputfile')
+    parser.add_argument('command')
+    args = parser.parse_args(argv)
+    time.sleep(args.latency)
+    with open(args.outputfile, 'w') as out:
+        out.write(rspec(args.a, args.nodes))
+    return 0
+
+
+def fake_encoder(argv):
+    """
+    Stands in for 'unisencoder -t type [-m urn] -o outfile infile', writes
+    a UNIS document with one node per node element of the input.
+    """
+    parser = argparse.ArgumentParser(prog='fake-encoder')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('-t')
+    parser.add_argument('-m', default=None)
+    parser.add_argument('-o')
+    parser.add_argument('infile')
+    args = parser.parse_args(argv)
+    with open(args.infile) as doc:
+        data = doc.read()
+    time.sleep(args.latency)
+    nodes = [{'id': 'urn:bench:%s:node=n%d' % (args.m or args.t, index),
+              'name': 'n%d' % index,
+              'ports': [{'id': 'urn:bench:%s:node=n%d:port=eth0' % \
+                             (args.m or args.t, index)}]}
+             for index in range(data.count(':node ') + data.count('<node '))]
+    with open(args.o, 'w') as out:
+        json.dump({'id': 'urn:bench:%s' % (args.m or args.t), 'nodes': nodes},
+                  out)
+    return 0
+
+
+def write_fake(workdir, name, args):
+    """
+    Writes an executable running this module as the fake name, the encoder
+    workers run their executable without a shell.
+    """
+    filename = os.path.join(workdir, name)
+    with open(filename, 'w') as script:
+        script.write('#!/bin/sh\nexec "%s" "%s" %s %s "$@"\n' % \
+            (sys.executable, os.path.abspath(__file__), name, args))
+    os.chmod(filename, 0755)
+    return filename
+
+
+def write_config(filename, sections, unis_url, encoder, omni=None):
+    """
+    Writes the configuration of one run.
+
+    Params:
+        sections: a dict of section name and list of (URN, URL)
+    """
+    lines = []
+    for section, sources in sorted(sections.items()):
+        lines += ['[%s]' % section]
+        lines += ['%s = %s' % source for source in sources]
+    lines += ['[UNIS]', 'url = %s' % unis_url,
+              '[UNISENCODER]', 'exec = %s' % encoder]
+    if omni is not None:
+        lines += ['[OMNI]', 'exec = %s' % omni, 'conf = none']
+    with open(filename, 'w') as conf:
+        conf.write('\n'.join(lines) + '\n')
+
+
+def run_script(script, config, metrics_file, extra_args):
+    """
+    Runs one pull script to completion.
+
+    Returns:
+        a tuple of (exit status, wall seconds, peak RSS in KB)
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        SCRIPT_FILES[script])
+    cmd = [sys.executable, path, '-c', config,
+           '--metrics-json', metrics_file] + extra_args
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.time() - start
+    return os.WEXITSTATUS(status), wall, usage.ru_maxrss
+
+
+def stage_percentiles(summaries):
+    """
+    The p50 and p99 of every stage over the sources of all the runs.
+
+    Returns:
+        a dict of stage name and (p50, p99) in seconds
+    """
+    seconds = {}
+    for summary in summaries:
+        for stages in summary['sources'].values():
+            for name, sample in stages.items():
+                seconds.setdefault(name, []).append(sample['seconds'])
+    return dict((name, (percentile(sorted(values), 0.5),
+                        percentile(sorted(values), 0.99)))
+                for name, values in seconds.items())
+
+
+def benchmark(script, count, runs, options, workdir):
+    """
+    Runs script runs times against count sources.
+
+    Returns:
+        a dict with the measurements
+    """
+    unis = FakeUNIS()
+    services = []
+    sections = {}
+    omni = None
+    # The mixed runs split the sources between both types
+    ts_count = {'ps': count, 'am': 0}.get(script, count - count / 2)
+    try:
+        if ts_count:
+            services = [FakeTopologyService(options.nodes, '127.0.0.%d' % \
+                            (host + 1)) for host in range(options.hosts)]
+            sections['perfSONAR_Topologies'] = [
+                ('bench-ts%d' % index,
+                 '%s/ts%d' % (services[index % len(services)].url, index))
+                for index in range(ts_count)]
+        if count - ts_count:
+            sections['Aggregate_Managers'] = [
+                ('bench-am%d' % index, 'http://am%d.bench' % index)
+                for index in range(count - ts_count)]
+            omni = write_fake(workdir, 'fake-omni', '--latency %s --nodes %d' \
+                              % (options.omni_latency, options.nodes))
+        encoder = write_fake(workdir, 'fake-encoder', '--latency %s' % \
+                             options.encoder_latency)
+        config = os.path.join(workdir, '%s-%d.conf' % (script, count))
+        write_config(config, sections, unis.url, encoder, omni)
+
+        walls, rss, summaries, failed = [], [], [], 0
+        for run in range(runs):
+            # One file per run, the metrics of a previous run must not be
+            # taken for the ones of a run that wrote none
+            metrics_file = os.path.join(workdir, 'metrics-%s-%d-%d.json' % \
+                                        (script, count, run))
+            if os.path.exists(metrics_file):
+                os.remove(metrics_file)
+            status, wall, peak = run_script(script, config, metrics_file,
+                                            options.extra)
+            walls.append(wall)
+            rss.append(peak)
+            try:
+                with open(metrics_file) as summary:
+                    summaries.append(json.load(summary))
+            except (IOError, ValueError), exp:
+                print >>sys.stderr, "No metrics from run %d of %s: %s" % \
+                    (run, script, exp)
+                status = status or 1
+            failed += status != 0
+    finally:
+        unis.close()
+        for service in services:
+            service.close()
+    return {'script': script, 'sources': count, 'runs': runs,
+            'failed_runs': failed, 'seconds': sum(walls),
+            'runs_per_second': runs / sum(walls),
+            'sources_per_second': runs * count / sum(walls),
+            'peak_rss_kb': max(rss), 'unis_requests': unis.requests,
+            'unis_bytes': unis.bytes,
+            'stages': stage_percentiles(summaries)}
+
+
+def report(results):
+    """
+    Formats the results as a table.
+    """
+    stages = ('pull', 'encode', 'upload')
+    header = '%-6s %7s %9s %10s %10s' % \
+        ('script', 'sources', 'runs/s', 'sources/s', 'rss (MB)')
+    for stage in stages:
+        header += ' %10s %10s' % (stage + ' p50', stage + ' p99')
+    lines = [header, '-' * len(header)]
+    for result in results:
+        line = '%-6s %7d %9.3f %10.1f %10.1f' % \
+            (result['script'], result['sources'], result['runs_per_second'],
+             result['sources_per_second'], result['peak_rss_kb'] / 1024.0)
+        for stage in stages:
+            p50, p99 = result['stages'].get(stage, (0.0, 0.0))
+            line += ' %8.1fms %8.1fms' % (p50 * 1000, p99 * 1000)
+        if result['failed_runs']:
+            line += '  (%d failed runs)' % result['failed_runs']
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'fake-omni':
+        sys.exit(fake_omni(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'fake-encoder':
+        sys.exit(fake_encoder(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(
+        description="Benchmarks ps_pull.py, am_pull.py and pull.py against "
+        "local stand-ins of their services.",
+        epilog="Arguments after -- are passed to the pull scripts, "
+        "e.g. -- --encoder-workers 4")
+    parser.add_argument('--script', choices=SCRIPTS + ('mixed', 'both'),
+        default='both', help='The script to benchmark, mixed runs pull.py '
+        'with both types of sources.')
+    parser.add_argument('--sources', type=str, default=DEFAULT_SOURCES,
+        help='Comma separated numbers of sources.')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+        help='The number of runs at every number of sources.')
+    parser.add_argument('--nodes', type=int, default=DEFAULT_NODES,
+        help='The number of nodes of every topology and rspec.')
+    parser.add_argument('--hosts', type=int, default=DEFAULT_HOSTS,
+        help='The number of loopback addresses the topology services are '
+        'spread over.')
+    parser.add_argument('--encoder-latency', type=float, default=0.0,
+        help='Seconds the fake unisencoder takes per document.')
+    parser.add_argument('--omni-latency', type=float, default=0.0,
+        help='Seconds the fake omni takes per aggregate manager.')
+    parser.add_argument('--json', type=str, default=None,
+        help='Also write the results to this JSON file.')
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        extra = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    options = parser.parse_args(argv)
+    options.extra = extra
+
+    scripts = SCRIPTS if options.script == 'both' else (options.script,)
+    counts = [int(count) for count in options.sources.split(',')]
+    workdir = tempfile.mkdtemp(prefix='pull-benchmark-')
+    results = []
+    try:
+        for script in scripts:
+            for count in counts:
+                results.append(benchmark(script, count, options.runs,
+                                         options, workdir))
+                print >>sys.stderr, "%s with %d sources: %.3f runs/s" % \
+                    (SCRIPT_FILES[script], count,
+                     results[-1]['runs_per_second'])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print report(results)
+    if options.json:
+        with open(options.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""
+Delta uploads of UNIS documents.
+
+The last document successfully pushed for every URN is kept on disk. A new
+document is compared with it resource by resource (domains, networks, nodes,
+ports, links and paths, keyed on their id or URN) and only the added,
+modified and removed resources are sent to their UNIS collections. The
+whole document is POSTed when there is no previous one, when it cannot be
+diffed, or when the changes exceed a fraction of its resources.
+
+Every resource is sent on its own with its child resources replaced by
+references, and the local references of the document ('#/ports/3') are made
+absolute ('http://unis/ports/<id>') so the resources do not depend on their
+position in the document.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+import urllib
+
+from uploader import Uploader, UploadResult
+
+
+log = logging.getLogger('delta')
+
+# The collections diffed resource by resource
+COLLECTIONS = ('domains', 'networks', 'nodes', 'ports', 'links', 'paths')
+# Keys set by UNIS itself and ignored in the comparison
+VOLATILE_KEYS = ('ts', 'selfRef')
+DEFAULT_THRESHOLD = 0.5
+
+FULL = 'full'
+DELTA = 'delta'
+UNCHANGED = 'unchanged'
+
+
+class NotDiffable(Exception):
+    """Raised when a document has to be sent in full."""
+    pass
+
+
+def href(base_url, collection, key):
+    """
+    The UNIS URL of a resource.
+    """
+    return '%s/%s/%s' % (base_url, collection, urllib.quote(key, safe=''))
+
+
+def resource_key(resource):
+    """
+    The id, or else the URN, of a resource, None if it has neither.
+    """
+    if not isinstance(resource, dict):
+        return None
+    return resource.get('id') or resource.get('urn')
+
+
+class Document(object):
+    """
+    A UNIS document split in its resources.
+
+    Params:
+        document: the parsed UNIS JSON
+        base_url: the UNIS URL the collections are under
+
+    Attributes:
+        root: the document itself
+        resources: a dict of (collection, key) and the resource
+    """
+    def __init__(self, document, base_url):
+        if not isinstance(document, dict):
+            raise NotDiffable("the document is not a JSON object")
+        self.root = document
+        self.base_url = base_url
+        self.resources = {}
+        self._pointers = {}
+        self._walk(document, '#')
+
+    def _walk(self, resource, pointer):
+        for collection in COLLECTIONS:
+            children = resource.get(collection)
+            if not isinstance(children, list):
+                continue
+            for index, child in enumerate(children):
+                child_pointer = '%s/%s/%d' % (pointer, collection, index)
+                key = resource_key(child)
+                if key is None:
+                    continue
+                if (collection, key) in self.resources:
+                    raise NotDiffable("duplicate %s %s" % (collection, key))
+                self.resources[(collection, key)] = child
+                self._pointers[child_pointer] = (collection, key)
+                self._walk(child, child_pointer)
+
+    def _resolve(self, value):
+        if isinstance(value, dict):
+            ref = value.get('href')
+            if isinstance(ref, basestring) and ref.startswith('#'):
+                if ref not in self._pointers:
+                    raise NotDiffable("unresolved reference %s" % ref)
+                value = dict(value)
+                value['href'] = href(self.base_url, *self._pointers[ref])
+                return value
+            return dict((key, self._resolve(item))
+                        for key, item in value.items())
+        if isinstance(value, list):
+            return [self._resolve(item) for item in value]
+        return value
+
+    def own(self, resource):
+        """
+        A resource without its child resources, which are replaced by
+        references, and with absolute references.
+        """
+        own = {}
+        for key, value in resource.items():
+            if key in COLLECTIONS and isinstance(value, list):
+                value = [{'href': href(self.base_url, key,
+                                       resource_key(child)),
+                          'rel': 'full'}
+                         if resource_key(child) is not None else child
+                         for child in value]
+            own[key] = value
+        return self._resolve(own)
+
+
+def _comparable(resource):
+    resource = copy.copy(resource)
+    for key in VOLATILE_KEYS:
+        resource.pop(key, None)
+    # The order of the child resources carries no meaning
+    for key in COLLECTIONS:
+        if isinstance(resource.get(key), list):
+            resource[key] = sorted(json.dumps(child, sort_keys=True)
+                                   for child in resource[key])
+    return json.dumps(resource, sort_keys=True)
+
+
+class Delta(object):
+    """
+    The changes between two documents.
+
+    Attributes:
+        added: a list of (collection, key, resource) to POST
+        modified: a list of (collection, key, resource) to PUT
+        removed: a list of (collection, key) to DELETE
+        root: the document itself if it changed, None otherwise
+        total: the number of resources in the new document
+    """
+    def __init__(self):
+        self.added = []
+        self.modified = []
+        self.removed = []
+        self.root = None
+        self.total = 0
+
+    def __len__(self):
+        return len(self.added) + len(self.modified) + len(self.removed) + \
+            (1 if self.root is not None else 0)
+
+
+def diff(old, new, base_url):
+    """
+    Computes the changes from the old to the new document.
+
+    Params:
+        old: the parsed UNIS JSON last pushed
+        new: the parsed UNIS JSON to push
+        base_url: the UNIS URL the collections are under
+
+    Returns:
+        a Delta
+
+    Raises:
+        NotDiffable if the documents have to be sent in full
+    """
+    old = Document(old, base_url)
+    new = Document(new, base_url)
+    if resource_key(old.root) != resource_key(new.root):
+        raise NotDiffable("the document id changed")
+    delta = Delta()
+    delta.total = len(new.resources) + 1
+    for (collection, key), resource in sorted(new.resources.items()):
+        own = new.own(resource)
+        if (collection, key) not in old.resources:
+            delta.added.append((collection, key, own))
+        elif _comparable(own) != \
+                _comparable(old.own(old.resources[(collection, key)])):
+            delta.modified.append((collection, key, own))
+    for collection, key in sorted(old.resources):
+        if (collection, key) not in new.resources:
+            delta.removed.append((collection, key))
+    own = new.own(new.root)
+    if _comparable(own) != _comparable(old.own(old.root)):
+        if resource_key(new.root) is None:
+            raise NotDiffable("the document has no id")
+        delta.root = own
+    return delta
+
+
+class DeltaStore(object):
+    """
+    The last document successfully pushed for every URN.
+
+    Params:
+        directory: where the documents are kept, created if missing
+    """
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _filename(self, urn):
+        return os.path.join(self.directory,
+                            hashlib.sha1(urn).hexdigest() + '.json')
+
+    def get(self, urn):
+        """
+        The last document pushed for urn as a string, None if there is none.
+        """
+        try:
+            with open(self._filename(urn), 'rb') as docf:
+                return docf.read()
+        except IOError:
+            return None
+
+    def put(self, urn, body):
+        """
+        Records body as the last document pushed for urn.
+        """
+        tmpf = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)
+        try:
+            tmpf.write(body)
+            tmpf.close()
+            os.rename(tmpf.name, self._filename(urn))
+        except:
+            tmpf.close()
+            os.remove(tmpf.name)
+            raise
+
+    def forget(self, urn):
+        """
+        Drops the document of urn, its next push will be in full.
+        """
+        try:
+            os.remove(self._filename(urn))
+        except OSError:
+            pass
+
+
+class DeltaUploader(Uploader):
+    """
+    An Uploader that sends only the changes since the last push of every
+    document.
+
+    Params:
+        store: the DeltaStore of the last pushed documents
+        threshold: send the whole document when the changes exceed this
+            fraction of its resources
+        the other params are those of Uploader
+    """
+    def __init__(self, store, threshold=DEFAULT_THRESHOLD, **kwargs):
+        Uploader.__init__(self, **kwargs)
+        self.store = store
+        self.threshold = threshold
+
+    def upload_body(self, urn, body, url):
+        """
+        Sends the changes of a document since its last push to UNIS, or the
+        whole document.
+
+        Params:
+            urn: the URN of the document
+            body: the UNIS JSON
+            url: the UNIS collection URL of the document
+
+        Returns:
+            an UploadResult
+        """
+        base_url, root = url.rstrip('/').rsplit('/', 1)
+        last = self.store.get(urn)
+        delta = None
+        if last is not None:
+            try:
+                delta = diff(json.loads(last), json.loads(body), base_url)
+            except (ValueError, NotDiffable), exp:
+                log.info("Sending %s in full: %s" % (urn, exp))
+        if delta is not None and len(delta) > self.threshold * delta.total:
+            log.info("Sending %s in full: %d of %d resources changed" % \
+                (urn, len(delta), delta.total))
+            delta = None
+
+        if delta is None:
+            result = Uploader.upload_body(self, urn, body, url)
+            result.mode = FULL
+        else:
+            result = self._upload_delta(urn, delta, base_url, root,
+                                        json.loads(body))
+        if result.ok:
+            self.store.put(urn, body)
+        else:
+            self.store.forget(urn)
+        return result
+
+    def _upload_delta(self, urn, delta, base_url, root, document):
+        result = UploadResult(urn)
+        result.mode = DELTA if len(delta) else UNCHANGED
+        start = time.time()
+        # The new resources first so that the references to them are valid
+        requests = []
+        for collection, _, resource in delta.added:
+            requests.append(('POST', '%s/%s' % (base_url, collection),
+                             resource))
+        for collection, key, resource in delta.modified:
+            requests.append(('PUT', href(base_url, collection, key),
+                             resource))
+        if delta.root is not None:
+            requests.append(('PUT', href(base_url, root,
+                                         resource_key(document)),
+                             delta.root))
+        for collection, key in delta.removed:
+            requests.append(('DELETE', href(base_url, collection, key), None))
+
+        result.ok = True
+        for method, url, resource in requests:
+            body = json.dumps(resource) if resource is not None else None
+            sent = self.request(urn, method, url, body)
+            result.attempts += sent.attempts
+            result.bytes += sent.bytes
+            result.sent_bytes += sent.sent_bytes
+            result.status = sent.status
+            # Somebody else already removed it
+            if method == 'DELETE' and sent.status == 404:
+                continue
+            if not sent.ok:
+                result.ok = False
+                result.error = sent.error
+                break
+        result.latency = time.time() - start
+        if not requests:
+            log.info("%s is unchanged since its last push" % urn)
+        elif result.ok:
+            log.info("Sent %s as %d changes (%d added, %d modified, "
+                     "%d removed) of %d resources in %.3fs" % \
+                (urn, len(delta), len(delta.added), len(delta.modified),
+                 len(delta.removed), delta.total, result.latency))
+        return result
@@ -0,0 +1,252 @@
+"""
+A pool of long lived unisencoder workers.
+
+Forking a shell and starting the encoder for every document dominates the
+encoding time. EncoderPool keeps a fixed number of encoder_worker.py
+processes warm and feeds them documents over pipes (see encoder_worker.py
+for the framing).
+"""
+
+import json
+import logging
+import os
+import os.path
+import Queue
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from resilience import DeadlineExceeded
+
+
+log = logging.getLogger('encoder')
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'encoder_worker.py')
+
+
+class EncoderError(Exception):
+    """Raised when a worker dies or breaks the protocol."""
+    pass
+
+
+class EncoderWorker(object):
+    """
+    One encoder worker process.
+
+    Params:
+        executable: the unisencoder executable
+        entry: the unisencoder entry point as 'module:function' or None
+    """
+    def __init__(self, executable, entry=None):
+        cmd = [sys.executable, WORKER, '--exec', executable]
+        if entry:
+            cmd += ['--entry', entry]
+        # In its own process group so that a hung unisencoder it started
+        # can be killed with it
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        preexec_fn=os.setsid)
+
+    def encode(self, doc_type, urn, data, timeout=None):
+        """
+        Encodes one document.
+
+        Params:
+            doc_type: the unisencoder document type ('ps', 'rspec3')
+            urn: the URN passed to the encoder, or None
+            data: the document
+            timeout: seconds to wait for the reply, None to wait forever
+
+        Returns:
+            a tuple of (exit status, UNIS JSON, seconds spent encoding)
+
+        Raises:
+            EncoderError if the worker died, DeadlineExceeded on timeout
+        """
+        header = {'type': doc_type, 'urn': urn, 'length': len(data)}
+        try:
+            self.process.stdin.write(json.dumps(header) + '\n')
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+            if timeout is not None:
+                ready, _, _ = select.select([self.process.stdout], [], [],
+                                            timeout)
+                if not ready:
+                    raise DeadlineExceeded("unisencoder did not answer for "
+                                           "%s in %.0fs" % (urn, timeout))
+            line = self.process.stdout.readline()
+        except IOError, exp:
+            raise EncoderError("Encoder worker died: %s" % exp)
+        if not line:
+            raise EncoderError("Encoder worker exited with %s" % \
+                self.process.poll())
+        # A reply that cannot be read leaves the pipe out of sync, the
+        # worker must not be used again
+        try:
+            reply = json.loads(line)
+            length = reply['length']
+            status, elapsed = reply['status'], reply['elapsed']
+            body = self.process.stdout.read(length)
+        except (ValueError, KeyError, TypeError, IOError), exp:
+            raise EncoderError("Bad reply from the encoder worker: %r (%s)" % \
+                (line[:200], exp))
+        if len(body) != length:
+            raise EncoderError("Encoder worker sent %d of %d bytes" % \
+                (len(body), length))
+        return (status, body, elapsed)
+
+    def kill(self):
+        """
+        Stops the worker right away.
+        """
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+
+    def close(self):
+        """
+        Stops the worker.
+        """
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+
+class EncoderPool(object):
+    """
+    A fixed size pool of warm encoder workers.
+
+    Params:
+        size: the number of workers
+        executable: the unisencoder executable
+        entry: the unisencoder entry point as 'module:function', if given
+            the encoder is loaded once inside every worker
+    """
+    def __init__(self, size, executable, entry=None):
+        self.size = size
+        self.executable = executable
+        self.entry = entry
+        self.workers = [EncoderWorker(executable, entry) for _ in range(size)]
+        self._idle = Queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+        # The latencies since the last report
+        self._stats_lock = threading.Lock()
+        self._latencies = []
+        self._first = None
+        self._last = 0.0
+
+    def encode(self, doc_type, urn, data, timeout=None):
+        """
+        Encodes one document on the next idle worker. A worker that dies,
+        breaks the protocol or times out is replaced.
+
+        Params:
+            same as EncoderWorker.encode
+
+        Returns:
+            a tuple of (exit status, UNIS JSON), the status is -1 if the
+            worker died
+
+        Raises:
+            DeadlineExceeded on timeout
+        """
+        worker = self._idle.get()
+        start = time.time()
+        try:
+            status, body, _ = worker.encode(doc_type, urn, data, timeout)
+        except (EncoderError, DeadlineExceeded), exp:
+            log.error("Encoding %s failed: %s" % (urn, exp))
+            # Out of sync, it may be blocked writing a reply nobody reads
+            worker.kill()
+            self.workers.remove(worker)
+            worker = EncoderWorker(self.executable, self.entry)
+            self.workers.append(worker)
+            if isinstance(exp, DeadlineExceeded):
+                raise
+            status, body = -1, ''
+        finally:
+            self._idle.put(worker)
+        self._record(start, time.time())
+        return status, body
+
+    def _record(self, start, end):
+        with self._stats_lock:
+            self._latencies.append(end - start)
+            if self._first is None or start < self._first:
+                self._first = start
+            self._last = max(self._last, end)
+
+    def report(self):
+        """
+        Logs the throughput and latency of the documents encoded since the
+        last report, e.g. at the end of every run, and starts over.
+
+        Returns:
+            a stats dict with 'documents', 'seconds' (from the first start to
+            the last end), 'throughput' (documents per second) and 'latency'
+            ('mean', 'p50', 'max' seconds per document), or None if nothing
+            was encoded
+        """
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            first, last = self._first, self._last
+            self._latencies, self._first, self._last = [], None, 0.0
+        if not latencies:
+            return None
+        elapsed = last - first
+        stats = {
+            'documents': len(latencies),
+            'seconds': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'latency': {
+                'mean': sum(latencies) / len(latencies),
+                'p50': latencies[len(latencies) / 2],
+                'max': latencies[-1],
+            },
+        }
+        log.info("Encoded %d documents in %.2fs (%.2f docs/s, latency "
+                 "mean %.3fs p50 %.3fs max %.3fs)" % \
+            (stats['documents'], elapsed, stats['throughput'],
+             stats['latency']['mean'], stats['latency']['p50'],
+             stats['latency']['max']))
+        return stats
+
+    def close(self):
+        """
+        Stops all the workers.
+        """
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+
+def encode_data(encoder_pool, data, doc_type, urn=None, timeout=None):
+    """
+    Encodes one document with an EncoderPool.
+
+    Params:
+        encoder_pool: the EncoderPool
+        data: the document
+        doc_type: the unisencoder document type
+        urn: the URN given to the encoder ('-m') or None
+        timeout: seconds to wait for the encoder, None to wait forever
+
+    Returns:
+        the UNIS JSON
+
+    Raises:
+        EncoderError if the encoder failed, DeadlineExceeded on timeout
+    """
+    status, body = encoder_pool.encode(doc_type, urn, data, timeout)
+    if status != 0:
+        raise EncoderError("unisencoder exited with status %s" % status)
+    return body
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+A long lived unisencoder worker, started and fed by encoder.EncoderPool.
+
+Requests and replies are framed on stdin/stdout as one JSON header line
+followed by a body of 'length' bytes:
+
+    request: {"type": "ps", "urn": "urn:...", "length": N}
+    reply:   {"status": 0, "length": M, "elapsed": seconds}
+
+The worker loads the encoder once. If an entry point ('module:function',
+called like a console_scripts entry point) is given the encoder runs inside
+this process, otherwise the encoder executable is run directly without a
+shell. The encoder only works on files, so every worker reuses a pair of
+scratch files in a private directory.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def load_entry(entry):
+    """
+    Imports 'module:function' and returns the function.
+    """
+    module, _, function = entry.partition(':')
+    mod = __import__(module, fromlist=[function])
+    return getattr(mod, function)
+
+
+def run_entry(func, argv):
+    """
+    Runs a console_scripts style function with argv, returns the exit code.
+    """
+    saved_argv = sys.argv
+    sys.argv = ['unisencoder'] + argv
+    try:
+        ret = func()
+    except SystemExit, exp:
+        ret = exp.code
+    finally:
+        sys.argv = saved_argv
+    if ret is None or ret is True:
+        return 0
+    if isinstance(ret, int):
+        return ret
+    return 1
+
+
+def encoder_args(doc_type, urn, infile, outfile):
+    """
+    The unisencoder command line for one document.
+    """
+    args = ['-t', doc_type]
+    if urn:
+        args += ['-m', urn]
+    return args + ['-o', outfile, infile]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="unisencoder worker")
+    parser.add_argument('--exec', dest='executable', default='unisencoder',
+        help='The unisencoder executable.')
+    parser.add_argument('--entry', default=None,
+        help='The unisencoder entry point as module:function.')
+    args = parser.parse_args()
+
+    # Keep stdout for the protocol only, anything the encoder prints
+    # goes to stderr.
+    requests = sys.stdin
+    replies = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    func = load_entry(args.entry) if args.entry else None
+    workdir = tempfile.mkdtemp(prefix='unisencoder-')
+    infile = os.path.join(workdir, 'in')
+    outfile = os.path.join(workdir, 'out')
+    try:
+        while True:
+            line = requests.readline()
+            if not line:
+                break
+            header = json.loads(line)
+            with open(infile, 'wb') as doc:
+                doc.write(requests.read(header['length']))
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            start = time.time()
+            argv = encoder_args(header['type'], header.get('urn'),
+                                infile, outfile)
+            if func is not None:
+                status = run_entry(func, argv)
+            else:
+                status = subprocess.call([args.executable] + argv)
+            elapsed = time.time() - start
+            body = ''
+            if status == 0 and os.path.exists(outfile):
+                with open(outfile, 'rb') as doc:
+                    body = doc.read()
+            replies.write(json.dumps({'status': status, 'length': len(body),
+                                      'elapsed': elapsed}) + '\n')
+            replies.write(body)
+            replies.flush()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
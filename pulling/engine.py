@@ -0,0 +1,785 @@
+"""
+The pull engine shared by all the kinds of sources.
+
+A source type knows how to pull one kind of source (perfSONAR topology
+services, GENI aggregate managers, ...) and which unisencoder document type
+and UNIS collection its documents go to. Everything else is shared: the
+settings read from the configuration file and the command line, the HTTP
+connections, the encoder workers, the uploads to UNIS, the state, the
+archive, the resilience policy and the concurrency limits.
+
+A source type subclasses SourceType and registers itself with
+register_source_type (see ps_pull.PSSource and am_pull.AMSource). The
+sources of every registered type are read from the type's section of the
+configuration file, so one file can list all of them and one Engine pulls
+them all concurrently (see pull.py).
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os.path
+import signal
+import threading
+import time
+
+from httppool import HTTPPool
+from httppool import DEFAULT_TIMEOUT, DEFAULT_MAX_CONNECTIONS
+from httppool import DEFAULT_MAX_PER_HOST
+from state import StateStore
+from encoder import EncoderPool, encode_data
+from payload import Payload, DEFAULT_SPOOL_SIZE
+from metrics import Metrics
+from resilience import Resilient, LatencyHistory
+from resilience import DEFAULT_DEADLINE, DEFAULT_RETRIES, DEFAULT_BACKOFF
+from uploader import Uploader, DEFAULT_WORKERS as DEFAULT_UPLOAD_WORKERS
+from archive import Archive, RAW, ENCODED
+from limiter import StageLimits, url_host
+from delta import DeltaStore, DeltaUploader, DEFAULT_THRESHOLD
+from pipeline import Pipeline, Stage, DEFAULT_QUEUE_SIZE
+from scheduler import Scheduler, parse_source
+from scheduler import DEFAULT_INTERVAL, DEFAULT_JITTER, DEFAULT_MAX_BACKOFF
+from scheduler import DEFAULT_RETRY_DELAY
+
+
+log = logging.getLogger('engine')
+
+# The location of the unisencoder
+DEFAULT_UNISENCODER = "unisencoder"
+
+DEFAULT_UNIS_URL = "http://129.79.244.8:8888"
+
+# The location of Omni script
+DEFAULT_OMNI = "~/workdir/geni/gcf-2.0/src/omni.py"
+# The location of Omni configuation file
+DEFAULT_OMNI_CONF = "~/.gcf/omni_config"
+
+# The highest number of concurrent pulls of the sources that are not bound
+# by a pool (omni started for every aggregate manager)
+DEFAULT_MAX_PULLS = 32
+
+# Configuration's sections names
+UNIS_SEC = 'UNIS'
+UNISENCODER_SEC = 'UNISENCODER'
+OMNI_SEC = 'OMNI'
+HTTP_SEC = 'HTTP'
+STATE_SEC = 'STATE'
+PIPELINE_SEC = 'PIPELINE'
+DAEMON_SEC = 'DAEMON'
+METRICS_SEC = 'METRICS'
+RESILIENCE_SEC = 'RESILIENCE'
+ARCHIVE_SEC = 'ARCHIVE'
+
+# The registered source types by name
+SOURCE_TYPES = {}
+
+
+def register_source_type(cls):
+    """
+    Makes a SourceType subclass available to the engine and to pull.py under
+    its name.
+    """
+    SOURCE_TYPES[cls.name] = cls
+    return cls
+
+
+class SourceType(object):
+    """
+    A kind of source. Subclasses set the class attributes and implement
+    configure, pull and encode_file.
+
+    Attributes:
+        name: the name of the type ('ps', 'am')
+        section: the configuration section listing the sources of the type
+        doc_type: the unisencoder document type of the pulled documents
+        collection: the UNIS collection the encoded documents are pushed to
+        pass_urn: give the URN of the source to the encoder
+        workers: the number of concurrent pulls with a fixed number of
+            workers
+        maximum: the highest number of concurrent pulls with adaptive limits
+        host_maximum: the highest number of concurrent pulls per host with
+            adaptive limits, None for no per host limit
+    """
+    name = None
+    section = None
+    doc_type = None
+    collection = None
+    pass_urn = False
+
+    workers = 1
+    maximum = DEFAULT_MAX_PULLS
+    host_maximum = None
+
+    @classmethod
+    def add_arguments(cls, parser):
+        """
+        Adds the command line arguments of the type to parser.
+        """
+        pass
+
+    @classmethod
+    def configure(cls, engine):
+        """
+        Returns the source type set up from engine.settings, sharing the
+        pools of engine.
+        """
+        raise NotImplementedError
+
+    def pull(self, urn, url, deadline=None):
+        """
+        Pulls the document of one source.
+
+        Params:
+            urn: the URN of the source
+            url: the URL of the source
+            deadline: seconds after which the pull is abandoned, or None
+
+        Returns:
+            a Payload with the document, raises an exception on failure
+        """
+        raise NotImplementedError
+
+    def encode_file(self, urn, filename, unisencoder):
+        """
+        Runs unisencoder on one pulled document, when there is no encoder
+        pool.
+
+        Returns:
+            the name of a temp file with the encoded document, raises an
+            exception on failure
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases the resources owned by the type.
+        """
+        pass
+
+
+class Settings(object):
+    """
+    The settings of the engine, the defaults overridden by the configuration
+    file and then by the command line.
+    """
+    def __init__(self):
+        self.unis_url = DEFAULT_UNIS_URL
+        self.upload_workers = DEFAULT_UPLOAD_WORKERS
+        self.compress = True
+        self.delta_dir = None
+        self.delta_threshold = DEFAULT_THRESHOLD
+        self.unisencoder = DEFAULT_UNISENCODER
+        self.encoder_workers = 0
+        self.encoder_entry = None
+        self.omni = DEFAULT_OMNI
+        self.omni_conf = DEFAULT_OMNI_CONF
+        self.omni_workers = 0
+        self.timeout = DEFAULT_TIMEOUT
+        self.max_connections = DEFAULT_MAX_CONNECTIONS
+        self.max_per_host = DEFAULT_MAX_PER_HOST
+        self.stream = False
+        self.state_file = None
+        self.force = False
+        self.queue_size = DEFAULT_QUEUE_SIZE
+        self.spool_size = DEFAULT_SPOOL_SIZE
+        self.pull_workers = None
+        self.pull_max_per_host = DEFAULT_MAX_PER_HOST
+        self.adaptive = True
+        self.interval = DEFAULT_INTERVAL
+        self.jitter = DEFAULT_JITTER
+        self.max_backoff = DEFAULT_MAX_BACKOFF
+        self.retry_delay = DEFAULT_RETRY_DELAY
+        self.metrics_json = None
+        self.metrics_prom = None
+        self.deadline = DEFAULT_DEADLINE
+        self.retries = DEFAULT_RETRIES
+        self.backoff = DEFAULT_BACKOFF
+        self.hedge = False
+        self.history_file = None
+        self.archive_dir = None
+
+    def read(self, config):
+        """
+        Reads the settings from a ConfigParser.
+        """
+        self.unis_url = config.get(UNIS_SEC,'url') \
+            if config.has_option(UNIS_SEC, 'url') \
+            else self.unis_url
+        self.upload_workers = config.getint(UNIS_SEC, 'workers') \
+            if config.has_option(UNIS_SEC, 'workers') \
+            else self.upload_workers
+        self.compress = config.getboolean(UNIS_SEC, 'compress') \
+            if config.has_option(UNIS_SEC, 'compress') \
+            else self.compress
+        self.delta_dir = config.get(UNIS_SEC, 'delta_dir') \
+            if config.has_option(UNIS_SEC, 'delta_dir') \
+            else self.delta_dir
+        self.delta_threshold = config.getfloat(UNIS_SEC, 'delta_threshold') \
+            if config.has_option(UNIS_SEC, 'delta_threshold') \
+            else self.delta_threshold
+        self.unisencoder = config.get(UNISENCODER_SEC,'exec') \
+            if config.has_option(UNISENCODER_SEC, 'exec') \
+            else self.unisencoder
+        self.encoder_workers = config.getint(UNISENCODER_SEC, 'workers') \
+            if config.has_option(UNISENCODER_SEC, 'workers') \
+            else self.encoder_workers
+        self.encoder_entry = config.get(UNISENCODER_SEC, 'entry') \
+            if config.has_option(UNISENCODER_SEC, 'entry') \
+            else self.encoder_entry
+        self.omni = config.get(OMNI_SEC, 'exec') \
+            if config.has_option(OMNI_SEC, 'exec') \
+            else self.omni
+        self.omni_conf = config.get(OMNI_SEC, 'conf') \
+            if config.has_option(OMNI_SEC, 'conf') \
+            else self.omni_conf
+        self.omni_workers = config.getint(OMNI_SEC, 'workers') \
+            if config.has_option(OMNI_SEC, 'workers') \
+            else self.omni_workers
+        self.timeout = config.getfloat(HTTP_SEC, 'timeout') \
+            if config.has_option(HTTP_SEC, 'timeout') \
+            else self.timeout
+        self.max_connections = config.getint(HTTP_SEC, 'max_connections') \
+            if config.has_option(HTTP_SEC, 'max_connections') \
+            else self.max_connections
+        self.max_per_host = config.getint(HTTP_SEC, 'max_per_host') \
+            if config.has_option(HTTP_SEC, 'max_per_host') \
+            else self.max_per_host
+        self.state_file = config.get(STATE_SEC, 'file') \
+            if config.has_option(STATE_SEC, 'file') \
+            else self.state_file
+        self.queue_size = config.getint(PIPELINE_SEC, 'queue_size') \
+            if config.has_option(PIPELINE_SEC, 'queue_size') \
+            else self.queue_size
+        self.spool_size = config.getint(PIPELINE_SEC, 'spool_size') \
+            if config.has_option(PIPELINE_SEC, 'spool_size') \
+            else self.spool_size
+        self.pull_workers = config.getint(PIPELINE_SEC, 'pull_workers') \
+            if config.has_option(PIPELINE_SEC, 'pull_workers') \
+            else self.pull_workers
+        self.pull_max_per_host = config.getint(PIPELINE_SEC, 'max_per_host') \
+            if config.has_option(PIPELINE_SEC, 'max_per_host') \
+            else self.pull_max_per_host
+        self.adaptive = config.getboolean(PIPELINE_SEC, 'adaptive') \
+            if config.has_option(PIPELINE_SEC, 'adaptive') \
+            else self.adaptive
+        self.interval = config.getfloat(DAEMON_SEC, 'interval') \
+            if config.has_option(DAEMON_SEC, 'interval') \
+            else self.interval
+        self.jitter = config.getfloat(DAEMON_SEC, 'jitter') \
+            if config.has_option(DAEMON_SEC, 'jitter') \
+            else self.jitter
+        self.max_backoff = config.getfloat(DAEMON_SEC, 'max_backoff') \
+            if config.has_option(DAEMON_SEC, 'max_backoff') \
+            else self.max_backoff
+        self.retry_delay = config.getfloat(DAEMON_SEC, 'retry_delay') \
+            if config.has_option(DAEMON_SEC, 'retry_delay') \
+            else self.retry_delay
+        self.metrics_json = config.get(METRICS_SEC, 'json') \
+            if config.has_option(METRICS_SEC, 'json') \
+            else self.metrics_json
+        self.metrics_prom = config.get(METRICS_SEC, 'prometheus') \
+            if config.has_option(METRICS_SEC, 'prometheus') \
+            else self.metrics_prom
+        self.deadline = config.getfloat(RESILIENCE_SEC, 'deadline') \
+            if config.has_option(RESILIENCE_SEC, 'deadline') \
+            else self.deadline
+        self.retries = config.getint(RESILIENCE_SEC, 'retries') \
+            if config.has_option(RESILIENCE_SEC, 'retries') \
+            else self.retries
+        self.backoff = config.getfloat(RESILIENCE_SEC, 'backoff') \
+            if config.has_option(RESILIENCE_SEC, 'backoff') \
+            else self.backoff
+        self.hedge = config.getboolean(RESILIENCE_SEC, 'hedge') \
+            if config.has_option(RESILIENCE_SEC, 'hedge') \
+            else self.hedge
+        self.history_file = config.get(RESILIENCE_SEC, 'history') \
+            if config.has_option(RESILIENCE_SEC, 'history') \
+            else self.history_file
+        self.archive_dir = config.get(ARCHIVE_SEC, 'dir') \
+            if config.has_option(ARCHIVE_SEC, 'dir') \
+            else self.archive_dir
+
+    def override(self, args):
+        """
+        Overrides the settings with the command line arguments that were
+        given. The scripts only define some of the arguments.
+        """
+        for name, attr in ARGUMENTS:
+            value = getattr(args, name, None)
+            if value is not None:
+                setattr(self, attr, value)
+        self.compress = self.compress and not getattr(args, 'no_compress',
+                                                      False)
+        self.adaptive = self.adaptive and not getattr(args, 'no_adaptive',
+                                                      False)
+        self.hedge = self.hedge or getattr(args, 'hedge', False)
+        self.stream = self.stream or getattr(args, 'stream', False)
+        self.force = self.force or getattr(args, 'force', False)
+
+
+# The command line arguments and the settings they override
+ARGUMENTS = [
+    ('unis_url', 'unis_url'),
+    ('upload_workers', 'upload_workers'),
+    ('delta_dir', 'delta_dir'),
+    ('delta_threshold', 'delta_threshold'),
+    ('encoder', 'unisencoder'),
+    ('encoder_workers', 'encoder_workers'),
+    ('encoder_entry', 'encoder_entry'),
+    ('omni', 'omni'),
+    ('omni_conf', 'omni_conf'),
+    ('omni_workers', 'omni_workers'),
+    ('timeout', 'timeout'),
+    ('max_connections', 'max_connections'),
+    ('max_per_host', 'max_per_host'),
+    ('state', 'state_file'),
+    ('queue_size', 'queue_size'),
+    ('pull_workers', 'pull_workers'),
+    ('metrics_json', 'metrics_json'),
+    ('metrics_prom', 'metrics_prom'),
+    ('deadline', 'deadline'),
+    ('retries', 'retries'),
+    ('archive', 'archive_dir'),
+]
+
+
+def is_valid_file(parser, arg, flag='r', mode=0666):
+    """
+    Auxilary function for argparser to check a file is valid input.
+    """
+    if flag.startswith('r'):
+        if not os.path.exists(arg):
+            parser.error("The file %s does not exist!"%arg)
+    return open(arg, flag, mode)
+
+
+def add_arguments(parser):
+    """
+    Adds the command line arguments shared by all the source types to
+    parser.
+    """
+    parser.add_argument('-c', '--config',
+        type=lambda x: is_valid_file(parser,x, 'r'))
+    parser.add_argument('-e', '--encoder', type=str, default=None,
+        help='The unisencoder executable.')
+    parser.add_argument('-w', '--encoder-workers', type=int, default=None,
+        help='Keep this many unisencoder workers warm instead of starting '
+        'the encoder for every document.')
+    parser.add_argument('--encoder-entry', type=str, default=None,
+        help='The unisencoder entry point (module:function) to load inside '
+        'the workers.')
+    parser.add_argument('-u', '--unis_url', type=str, default=None,
+        help='The URL of the UNIS instance')
+    parser.add_argument('--upload-workers', type=int, default=None,
+        help='The maximum number of parallel uploads to UNIS.')
+    parser.add_argument('--no-compress', action='store_true', default=False,
+        help='Do not gzip the documents sent to UNIS.')
+    parser.add_argument('--archive', type=str, default=None,
+        help='Keep the pulled and encoded documents in this archive '
+        'directory (see archive.py).')
+    parser.add_argument('--delta-dir', type=str, default=None,
+        help='Keep the documents pushed to UNIS in this directory and only '
+        'send their changes on the next runs.')
+    parser.add_argument('--delta-threshold', type=float, default=None,
+        help='Send the whole document when more than this fraction of its '
+        'resources changed.')
+    parser.add_argument('-l', '--log',
+        type=lambda x: is_valid_file(parser,x, 'w'),
+        help='Log file.')
+    parser.add_argument('--metrics-json', type=str, default=None,
+        help='Write a JSON summary of every run to this file.')
+    parser.add_argument('--metrics-prom', type=str, default=None,
+        help='Write the metrics of every run in the Prometheus text format '
+        'to this file.')
+    parser.add_argument('--deadline', type=float, default=None,
+        help='Give up on a source after this many seconds.')
+    parser.add_argument('--retries', type=int, default=None,
+        help='The number of retries of a failing source.')
+    parser.add_argument('--hedge', action='store_true', default=False,
+        help='Start a second request for the sources slower than their '
+        '95th percentile latency.')
+    parser.add_argument('-d', '--daemon', action='store_true', default=False,
+        help='Keep running and pull every source at its interval.')
+    parser.add_argument('-s', '--state', type=str, default=None,
+        help='State file to skip the URNs that did not change since the '
+        'last push.')
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+        help='Encode and push all URNs even if they did not change.')
+    parser.add_argument('--no-adaptive', action='store_true', default=False,
+        help='Run a fixed number of workers per stage instead of adapting '
+        'the concurrency to the observed latencies and errors.')
+    parser.add_argument('--queue-size', type=int, default=None,
+        help='The number of documents waiting before every stage.')
+
+
+def setup_logging(log_file=None):
+    """
+    Logs to log_file (an open file) or to stderr. The helper modules
+    (httppool, uploader, ...) log through the root logger.
+    """
+    formatter = logging.Formatter('[%(levelname)s] %(message)s')
+    root_log = logging.getLogger()
+    root_log.setLevel(logging.INFO)
+    handler = logging.StreamHandler(log_file)
+    handler.setFormatter(formatter)
+    root_log.addHandler(handler)
+
+
+def read_sources(config, types):
+    """
+    Reads the sources of the given types from their configuration sections.
+
+    Returns:
+        a tuple of (dict of URN and (type name, URL), dict of URN and pull
+        interval for the sources that have one)
+    """
+    sources = {}
+    intervals = {}
+    for name in types:
+        section = SOURCE_TYPES[name].section
+        if not config.has_section(section):
+            continue
+        for urn, value in config.items(section):
+            if urn in sources:
+                raise Exception("%s is listed in both %s and %s" % \
+                    (urn, SOURCE_TYPES[sources[urn][0]].section, section))
+            url, interval = parse_source(value)
+            sources[urn] = (name, url)
+            if interval is not None:
+                intervals[urn] = interval
+    return sources, intervals
+
+
+def _bounded(func, slots):
+    """
+    Returns func(urn, value) running at most slots at a time.
+    """
+    semaphore = threading.BoundedSemaphore(slots)
+
+    def call(urn, value):
+        with semaphore:
+            return func(urn, value)
+    return call
+
+
+def _interleave(items, key):
+    """
+    Alternates the items of every key so that all the types of sources start
+    being pulled right away.
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    for group in itertools.izip_longest(*groups.values()):
+        for item in group:
+            if item is not None:
+                yield item
+
+
+def pipeline_sources(sources, source_types, unis_url, unisencoder, uploader,
+                     encoder_pool=None, state=None, force=False,
+                     encode_workers=None, queue_size=DEFAULT_QUEUE_SIZE,
+                     spool_size=DEFAULT_SPOOL_SIZE, metrics=None,
+                     resilient=None, archive=None, limits=None):
+    """
+    Pulls, encodes and pushes the documents of sources of any type as a
+    pipeline, every document moves to the next stage as soon as it is done
+    with the previous one. The encode and upload stages are shared by all
+    the types, the pulls of every type are limited on their own.
+
+    Params:
+        sources: a dict of URN and (source type name, URL)
+        source_types: a dict of name and SourceType for the types of the
+            sources
+        unis_url: the UNIS instance
+        unisencoder: the unisencoder executable
+        uploader: the Uploader for UNIS
+        encoder_pool: an EncoderPool, if None the encoder is invoked once per
+            document
+        state: a StateStore to skip the unchanged documents, or None
+        force: push the documents even if they did not change
+        encode_workers: the number of concurrent encodings, defaults to the
+            encoder pool size or the number of CPUs
+        queue_size: the number of documents waiting before every stage
+        spool_size: the size above which an encoded document handed to the
+            upload stage is spilled to disk
+        metrics: a Metrics to record every stage of every source
+        resilient: the Resilient policy (deadline, retries, hedging) of the
+            pulls, the encodings get the same deadline and retries
+        archive: an Archive keeping the pulled and encoded documents, or
+            None
+        limits: a dict with the StageLimits of the 'encode' and 'upload'
+            stages and, for 'pull', a dict of source type name and the
+            StageLimits of its pulls, also limited per host. None for a fixed
+            number of workers.
+
+    Returns:
+        a tuple of (dict of URN and UploadResult, dict of URN and
+        (stage, error message) for the failed sources)
+    """
+    digests = {}
+    raw_digests = {}
+    kinds = dict((urn, source_types[name])
+                 for urn, (name, _) in sources.items())
+    if resilient is None:
+        resilient = Resilient()
+
+    # The time every pull has to finish by, its retries and hedged
+    # attempts only get what is left
+    ends = {}
+
+    def pull(urn, url):
+        end = ends.get(urn)
+        deadline = max(end - time.time(), 0) if end is not None else None
+        return kinds[urn].pull(urn, url, deadline)
+
+    def pull_source(urn, url):
+        if resilient.deadline:
+            ends[urn] = time.time() + resilient.deadline
+        # The side effects only run for the attempt that won, the late
+        # ones are discarded by resilient.call
+        payload = resilient.call(urn, pulls[kinds[urn].name], urn, url)
+        try:
+            if state is not None:
+                digests[urn] = state.check(urn, payload.open(), force)
+                if digests[urn] is None:
+                    payload.close()
+                    return None
+            if archive is not None:
+                raw_digests[urn] = archive.put(urn, RAW, payload.open(),
+                                               kinds[urn].doc_type)
+        except:
+            payload.close()
+            raise
+        return payload
+
+    def encode(urn, payload):
+        source = kinds[urn]
+        if encoder_pool is not None:
+            # A hung worker is replaced when the encoding is abandoned
+            end = encode_ends.get(urn)
+            timeout = max(end - time.time(), 0) if end is not None else None
+            encoded = Payload(encode_data(encoder_pool, payload.read(),
+                source.doc_type, urn if source.pass_urn else None, timeout),
+                spool_size)
+        else:
+            encoded = Payload.from_file(source.encode_file(urn,
+                payload.filename(), unisencoder), spool_size)
+        if archive is not None:
+            archive.put(urn, ENCODED, encoded.open(), source.doc_type,
+                        raw_digests.get(urn))
+        return encoded
+
+    def upload(urn, payload):
+        try:
+            result = uploader.upload_body(urn, payload.read(),
+                "%s/%s" % (unis_url, kinds[urn].collection))
+        finally:
+            payload.close()
+        if not result.ok:
+            raise Exception(result.error)
+        if state is not None:
+            state.update(urn, digests[urn])
+        return result
+
+    # Every type has its own pull slots, the slow omni calls must not take
+    # the ones of the topology services
+    pulls = {}
+    pull_workers = 0
+    for name in set(name for name, _ in sources.values()):
+        if limits is not None:
+            pulls[name] = limits['pull'][name].wrap(pull, url_host)
+            pull_workers += limits['pull'][name].maximum
+        else:
+            pulls[name] = _bounded(pull, source_types[name].workers)
+            pull_workers += source_types[name].workers
+
+    if encode_workers is None:
+        encode_workers = encoder_pool.size if encoder_pool is not None \
+            else multiprocessing.cpu_count()
+    upload_workers = uploader.workers
+    if limits is not None:
+        # The limits decide how many calls run, the stages only need enough
+        # threads for the highest limits
+        encode = limits['encode'].wrap(encode)
+        upload = limits['upload'].wrap(upload)
+        encode_workers = limits['encode'].maximum
+        upload_workers = limits['upload'].maximum
+    # Only the pulls talk to the remote sources, hedging the encoding
+    # would only double the local work
+    encode_policy = Resilient(resilient.deadline, resilient.retries,
+                              resilient.backoff)
+
+    encode_ends = {}
+
+    def encode_source(urn, payload):
+        if encode_policy.deadline:
+            encode_ends[urn] = time.time() + encode_policy.deadline
+        # Every retry reads the pulled document again, it is only released
+        # after the last one
+        try:
+            return encode_policy.call(urn, encode, urn, payload)
+        finally:
+            payload.close()
+
+    stages = [
+        Stage('pull', pull_source, pull_workers),
+        Stage('encode', encode_source, encode_workers),
+        Stage('upload', upload, upload_workers),
+    ]
+    items = _interleave(((urn, url) for urn, (_, url) in sources.items()),
+                        lambda item: kinds[item[0]].name)
+    return Pipeline(stages, queue_size, metrics).run(items)
+
+
+class Engine(object):
+    """
+    The pools, connections and policies shared by the sources of all the
+    given types, kept warm between the cycles of the daemon.
+
+    Params:
+        settings: the Settings
+        types: the names of the source types to pull
+        job: the name of the job in the metrics
+    """
+    def __init__(self, settings, types, job='pull'):
+        self.settings = settings
+        self.job = job
+        self.http_pool = None
+        self.encoder_pool = None
+        self.source_types = {}
+        if settings.delta_dir is not None:
+            self.uploader = DeltaUploader(DeltaStore(settings.delta_dir),
+                settings.delta_threshold, workers=settings.upload_workers,
+                compress=settings.compress)
+        else:
+            self.uploader = Uploader(workers=settings.upload_workers,
+                                     compress=settings.compress)
+        try:
+            if settings.encoder_workers > 0:
+                self.encoder_pool = EncoderPool(settings.encoder_workers,
+                    settings.unisencoder, settings.encoder_entry)
+            for name in types:
+                self.source_types[name] = SOURCE_TYPES[name].configure(self)
+        except:
+            self.close()
+            raise
+        self.state = StateStore(settings.state_file) \
+            if settings.state_file is not None else None
+        self.archive = Archive(settings.archive_dir) \
+            if settings.archive_dir is not None else None
+        self.history = LatencyHistory(settings.history_file)
+        self.resilient = Resilient(settings.deadline, settings.retries,
+                                   settings.backoff, settings.hedge,
+                                   self.history)
+        self.limits = None
+        if settings.adaptive:
+            # Learned once and kept between the cycles of the daemon
+            encode_maximum = settings.encoder_workers or \
+                multiprocessing.cpu_count()
+            self.limits = {
+                'pull': dict((name, StageLimits('pull %s' % name,
+                                                source.maximum,
+                                                host_maximum=\
+                                                    source.host_maximum))
+                             for name, source in self.source_types.items()),
+                'encode': StageLimits('encode', encode_maximum,
+                                      encode_maximum),
+                'upload': StageLimits('upload', settings.upload_workers),
+            }
+
+    def shared_http_pool(self):
+        """
+        The HTTPPool shared by the source types that speak HTTP, created on
+        first use.
+        """
+        if self.http_pool is None:
+            self.http_pool = HTTPPool(self.settings.max_connections,
+                                      self.settings.max_per_host,
+                                      self.settings.timeout)
+        return self.http_pool
+
+    def run_cycle(self, sources):
+        """
+        Pulls, encodes and pushes the given sources once and saves the
+        state, the latencies and the metrics.
+
+        Params:
+            sources: a dict of URN and (source type name, URL)
+
+        Returns:
+            a tuple of (dict of URN and UploadResult, dict of URN and
+            (stage, error message) for the failed sources)
+        """
+        settings = self.settings
+        metrics = Metrics(self.job)
+        results, errors = pipeline_sources(sources, self.source_types,
+            settings.unis_url, settings.unisencoder, self.uploader,
+            self.encoder_pool, self.state, settings.force,
+            queue_size=settings.queue_size, spool_size=settings.spool_size,
+            metrics=metrics, resilient=self.resilient, archive=self.archive,
+            limits=self.limits)
+        metrics.finish()
+        if self.encoder_pool is not None:
+            self.encoder_pool.report()
+        if self.limits is not None:
+            stage_limits = self.limits['pull'].values() + \
+                [self.limits['encode'], self.limits['upload']]
+            for limit in stage_limits:
+                log.info("Concurrency: %s" % limit.report())
+        self.history.save()
+        if self.state is not None:
+            self.state.save()
+        if settings.metrics_json is not None:
+            metrics.write_json(settings.metrics_json)
+        if settings.metrics_prom is not None:
+            metrics.write_prometheus(settings.metrics_prom)
+        log.info("Pushed %d documents to UNIS, %d failed" % \
+            (len(results), len(errors)))
+        for urn, (stage, error) in sorted(errors.items()):
+            log.error("%s failed in %s: %s" % (urn, stage, error))
+        return results, errors
+
+    def run(self, sources, intervals=None, daemon=False):
+        """
+        Runs one cycle, or keeps pulling every source at its interval until
+        SIGTERM if daemon is set.
+
+        Params:
+            sources: a dict of URN and (source type name, URL)
+            intervals: a dict of URN and pull interval for the daemon, the
+                sources without one use the default interval
+
+        Returns:
+            a dict of URN and (stage, error message) for the sources that
+            failed in the last cycle
+        """
+        if not daemon:
+            return self.run_cycle(sources)[1]
+        intervals = intervals or {}
+        scheduled = dict((urn, (url, intervals.get(urn)))
+                         for urn, (_, url) in sources.items())
+
+        def run_due(due):
+            return self.run_cycle(dict((urn, sources[urn])
+                                       for urn in due))[1]
+        scheduler = Scheduler(scheduled, run_due, self.settings.interval,
+                              self.settings.jitter,
+                              self.settings.max_backoff,
+                              self.settings.retry_delay)
+        signal.signal(signal.SIGTERM, lambda signum, frame: \
+            scheduler.stop())
+        scheduler.run()
+        return {}
+
+    def close(self):
+        """
+        Stops the workers and closes the connections.
+        """
+        self.uploader.close()
+        for source in self.source_types.values():
+            source.close()
+        if self.encoder_pool is not None:
+            self.encoder_pool.close()
+        if self.http_pool is not None:
+            self.http_pool.close()
@@ -0,0 +1,247 @@
+"""
+A small thread safe HTTP client that keeps connections alive per host.
+
+The pullers talk to dozens of remote services. Opening a fresh TCP (and TLS)
+connection for every request dominates the run time, so HTTPPool keeps idle
+connections around per (scheme, host, port), caps the number of requests in
+flight per host and globally, asks for gzip compressed responses and enforces
+a timeout on every request.
+"""
+
+import httplib
+import logging
+import socket
+import threading
+import urlparse
+import zlib
+
+
+log = logging.getLogger('httppool')
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_MAX_PER_HOST = 4
+
+
+class HTTPPoolError(Exception):
+    """Raised when a request could not be completed."""
+    pass
+
+
+READ_CHUNK = 64 * 1024
+
+
+def body_decoder(encoding):
+    """
+    Returns a zlib decompressor for the Content-Encoding or None.
+    """
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.decompressobj()
+    return None
+
+
+class PooledResponse(object):
+    """
+    A file like view of a response body that decodes compressed bodies on
+    the fly and gives the connection back to its pool when closed.
+    """
+    def __init__(self, pool, key, conn, response, limits):
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._limits = limits
+        self._decoder = body_decoder(self.headers.get('content-encoding'))
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self, size):
+        # Joined once, appending every chunk to the buffer would copy it
+        # again for every chunk of a large body
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while not self._eof and (size < 0 or length < size):
+            raw = self._response.read(READ_CHUNK)
+            if not raw:
+                self._eof = True
+                chunk = self._decoder.flush() \
+                    if self._decoder is not None else ''
+            elif self._decoder is not None:
+                chunk = self._decoder.decompress(raw)
+            else:
+                chunk = raw
+            chunks.append(chunk)
+            length += len(chunk)
+        self._buffer = ''.join(chunks)
+
+    def read(self, size=-1):
+        """
+        Reads up to size decoded bytes, or everything if size is negative.
+        """
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """
+        Releases the connection and the concurrency slots.
+        """
+        if self._conn is None:
+            return
+        if self._eof and not self._response.will_close:
+            self._pool._put_connection(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+        for limit in self._limits:
+            limit.release()
+
+
+class HTTPPool(object):
+    """
+    Keeps alive HTTP connections per host and limits concurrency.
+
+    Params:
+        max_connections: the maximum number of requests in flight globally
+        max_per_host: the maximum number of requests in flight per host
+        timeout: socket timeout in seconds for every request
+        compress: send 'Accept-Encoding: gzip' and decode the responses
+    """
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_per_host=DEFAULT_MAX_PER_HOST, timeout=DEFAULT_TIMEOUT,
+                 compress=True):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.compress = compress
+        self._global = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._host_limits = {}
+
+    def _host_limit(self, key):
+        with self._lock:
+            if key not in self._host_limits:
+                self._host_limits[key] = \
+                    threading.BoundedSemaphore(self.max_per_host)
+            return self._host_limits[key]
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _get_connection(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(key), False
+
+    def _put_connection(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Sends one HTTP request, reusing an idle connection to the host when
+        there is one.
+
+        Params:
+            method: HTTP method
+            url: the full URL
+            body: the request body or None
+            headers: a dict of extra request headers
+
+        Returns:
+            a tuple of (status, response headers dict, decoded body)
+        """
+        response = self.open(method, url, body, headers)
+        try:
+            data = response.read()
+        except (httplib.HTTPException, socket.error, zlib.error), exp:
+            raise HTTPPoolError("%s %s failed: %s" % (method, url, exp))
+        finally:
+            response.close()
+        return (response.status, response.headers, data)
+
+    def open(self, method, url, body=None, headers=None):
+        """
+        Sends one HTTP request and returns the response as a file like
+        object, so large bodies can be consumed incrementally.
+
+        The host and global concurrency slots are held until the response
+        is closed, and the connection is only reused if the body was read
+        to the end.
+
+        Params:
+            same as request
+
+        Returns:
+            a PooledResponse
+        """
+        parsed = urlparse.urlsplit(url)
+        scheme = parsed.scheme or 'http'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        req_headers = {}
+        if self.compress:
+            req_headers['Accept-Encoding'] = 'gzip'
+        req_headers.update(headers or {})
+
+        # The host slot first, a request waiting for a busy host must not
+        # hold a global slot the other hosts could use
+        host_limit = self._host_limit(key)
+        host_limit.acquire()
+        self._global.acquire()
+        try:
+            conn, response = self._send(key, method, path, body, req_headers)
+        except:
+            self._global.release()
+            host_limit.release()
+            raise
+        # Released in the reverse order
+        return PooledResponse(self, key, conn, response,
+                              (self._global, host_limit))
+
+    def _send(self, key, method, path, body, headers, retry=True):
+        if retry:
+            conn, reused = self._get_connection(key)
+        else:
+            conn, reused = self._new_connection(key), False
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error), exp:
+            conn.close()
+            if reused and not isinstance(exp, socket.timeout):
+                # The server may have closed an idle keep-alive connection
+                # under us, try once more on a fresh connection.
+                log.debug("Retrying %s %s on a new connection: %s" % \
+                    (method, key[1], exp))
+                return self._send(key, method, path, body, headers,
+                                  retry=False)
+            raise HTTPPoolError("%s %s://%s:%s%s failed: %s" % \
+                (method, key[0], key[1], key[2], path, exp))
+        return conn, response
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
@@ -0,0 +1,228 @@
+"""
+Adaptive concurrency limits.
+
+A fixed number of workers is too few on a small host pulling slow services
+and too many for a remote aggregate manager on a big one. An
+AdaptiveLimiter tunes the number of calls in flight from what it observes:
+the limit grows by one per round of successful calls (additive increase)
+and is cut by a factor when a call fails or takes much longer than the
+baseline latency of the limiter (multiplicative decrease).
+
+StageLimits combines a limiter for a whole pipeline stage with one limiter
+per remote host, so one overloaded host only slows down its own calls. The
+calls of a stage cover different hosts and document sizes, so their spread
+of latencies is the workload and not a sign of overload: the stage limit
+only backs off on errors, the latency is left to the per host limits.
+"""
+
+import logging
+import threading
+import time
+import urlparse
+
+
+log = logging.getLogger('limiter')
+
+DEFAULT_INITIAL = 4
+DEFAULT_MAXIMUM = 32
+# A call slower than TOLERANCE times the baseline latency counts as a sign
+# of overload
+DEFAULT_TOLERANCE = 2.0
+DEFAULT_DECREASE = 0.7
+# How fast the baseline latency follows latencies above it
+BASELINE_DRIFT = 0.05
+SMOOTHING = 0.2
+
+
+def url_host(urn, url):
+    """
+    The host of a source URL, to limit the pulls per host.
+    """
+    return urlparse.urlparse(url).netloc
+
+
+class AdaptiveLimiter(object):
+    """
+    An AIMD limit on the number of concurrent calls, driven by the latency
+    and the outcome of the calls.
+
+    Params:
+        name: the name of the limiter, used in the logs
+        initial: the limit to start with
+        minimum: the lowest limit
+        maximum: the highest limit
+        tolerance: the latency, as a multiple of the baseline latency, above
+            which the limit is decreased
+        decrease: the factor the limit is multiplied by on a decrease
+        latency: decrease the limit on slow calls, if False only the failed
+            calls (errors and timeouts) decrease it
+    """
+    def __init__(self, name, initial=DEFAULT_INITIAL, minimum=1,
+                 maximum=DEFAULT_MAXIMUM, tolerance=DEFAULT_TOLERANCE,
+                 decrease=DEFAULT_DECREASE, latency=True):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.latency = latency
+        self.inflight = 0
+        self.baseline = None
+        self.smoothed = None
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits until a call may start.
+        """
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+
+    def release(self, seconds, ok):
+        """
+        Records the end of a call and adjusts the limit.
+
+        Params:
+            seconds: the latency of the call
+            ok: False if the call failed, None to leave the limit as is
+        """
+        with self._cond:
+            saturated = self.inflight >= int(self.limit)
+            self.inflight -= 1
+            if ok is None:
+                self._cond.notify_all()
+                return
+            if ok:
+                if self.baseline is None or seconds < self.baseline:
+                    self.baseline = seconds
+                else:
+                    self.baseline += (seconds - self.baseline) * \
+                        BASELINE_DRIFT
+                self.smoothed = seconds if self.smoothed is None else \
+                    self.smoothed + (seconds - self.smoothed) * SMOOTHING
+            slow = self.latency and \
+                seconds > self.tolerance * self.baseline
+            if not ok or slow:
+                self._decrease(seconds, ok)
+            elif saturated:
+                # Only grow a limit that is actually reached
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self, seconds, ok):
+        now = time.time()
+        # The calls that were in flight when the limit was cut report the
+        # same overload, cut once per round trip
+        if now - self._last_decrease < (self.smoothed or seconds):
+            return
+        self._last_decrease = now
+        limit = max(self.minimum, self.limit * self.decrease)
+        if int(limit) < int(self.limit):
+            log.info("%s: limit %d -> %d (%s, %.3fs, baseline %.3fs)" % \
+                (self.name, self.limit, limit, 'ok' if ok else 'error',
+                 seconds, self.baseline or 0))
+        self.limit = limit
+
+    def call(self, func, *args):
+        """
+        Calls func(*args) within the limit.
+        """
+        self.acquire()
+        start = time.time()
+        ok = False
+        try:
+            ret = func(*args)
+            ok = True
+            return ret
+        finally:
+            self.release(time.time() - start, ok)
+
+    def wrap(self, func):
+        """
+        Returns func(urn, value) limited, for pipeline stages.
+        """
+        def limited(urn, value):
+            return self.call(func, urn, value)
+        return limited
+
+
+class StageLimits(object):
+    """
+    The adaptive limits of one pipeline stage, overall and per host.
+
+    Params:
+        name: the stage name
+        maximum: the highest number of concurrent calls of the stage, also
+            the number of threads the stage needs
+        initial: the stage limit to start with
+        host_maximum: the highest number of concurrent calls per host, None
+            for no per host limit
+        host_initial: the per host limit to start with
+    """
+    def __init__(self, name, maximum=DEFAULT_MAXIMUM, initial=DEFAULT_INITIAL,
+                 host_maximum=None, host_initial=DEFAULT_INITIAL):
+        self.name = name
+        self.maximum = maximum
+        # The calls of the stage are not comparable, only the errors tell
+        self.stage = AdaptiveLimiter(name, initial, maximum=maximum,
+                                     latency=False)
+        self.host_maximum = host_maximum
+        self.host_initial = host_initial
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def host(self, host):
+        """
+        The limiter of host, created on first use.
+        """
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = AdaptiveLimiter(
+                    '%s %s' % (self.name, host),
+                    min(self.host_initial, self.host_maximum),
+                    maximum=self.host_maximum)
+            return self.hosts[host]
+
+    def wrap(self, func, host=None):
+        """
+        Returns func(urn, value) limited by the stage limit and, if host is
+        given, by the limit of the host returned by host(urn, value).
+        """
+        if host is None or self.host_maximum is None:
+            return self.stage.wrap(func)
+
+        def limited(urn, value):
+            # The host slot first, a busy host must not hold stage slots
+            # the other hosts could use
+            host_limiter = self.host(host(urn, value))
+            host_limiter.acquire()
+            self.stage.acquire()
+            start = time.time()
+            ok = False
+            try:
+                ret = func(urn, value)
+                ok = True
+                return ret
+            finally:
+                seconds = time.time() - start
+                # The errors are the business of the host, one broken source
+                # must not slow down the others
+                self.stage.release(seconds, True if ok else None)
+                host_limiter.release(seconds, ok)
+        return limited
+
+    def report(self):
+        """
+        Returns the current limits as a string, for the logs.
+        """
+        with self._lock:
+            hosts = sorted(self.hosts.items())
+        text = "%s limit %.1f" % (self.name, self.stage.limit)
+        if hosts:
+            text += " (%s)" % ', '.join("%s %.1f" % (host, limiter.limit)
+                                        for host, limiter in hosts)
+        return text
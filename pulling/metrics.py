@@ -0,0 +1,174 @@
+"""
+Per stage and per source measurements of a pull run.
+
+Every stage of every source records its wall time, the number of bytes it
+produced and its outcome. A run is exported as a JSON summary and as a
+Prometheus text format file (for the node_exporter textfile collector).
+"""
+
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger('metrics')
+
+OK = 'ok'
+ERROR = 'error'
+SKIPPED = 'skipped'
+
+
+def percentile(values, fraction):
+    """
+    The nearest rank percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def _atomic_write(filename, content):
+    filename = os.path.expanduser(filename)
+    dirname = os.path.dirname(os.path.abspath(filename))
+    tmpf = tempfile.NamedTemporaryFile(dir=dirname, delete=False)
+    try:
+        tmpf.write(content)
+        tmpf.close()
+        # Readers such as node_exporter expect a readable file
+        os.chmod(tmpf.name, 0644)
+        os.rename(tmpf.name, filename)
+    except:
+        tmpf.close()
+        os.remove(tmpf.name)
+        raise
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Metrics(object):
+    """
+    Collects the measurements of one run.
+
+    Params:
+        job: the name of the script, exported as the 'job' label
+    """
+    def __init__(self, job):
+        self.job = job
+        self.started = time.time()
+        self.finished = None
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def record(self, stage, urn, seconds, nbytes, outcome, error=None):
+        """
+        Records one stage of one source.
+
+        Params:
+            stage: the stage name
+            urn: the source URN
+            seconds: the wall time of the stage
+            nbytes: the number of bytes produced or handled
+            outcome: OK, ERROR or SKIPPED
+            error: the error message of a failed stage
+        """
+        with self._lock:
+            self.samples.append({'stage': stage, 'urn': urn,
+                                 'seconds': seconds, 'bytes': nbytes,
+                                 'outcome': outcome, 'error': error})
+
+    def finish(self):
+        """
+        Marks the end of the run.
+        """
+        self.finished = time.time()
+
+    def summary(self):
+        """
+        Returns the run summary as a dict with the per stage aggregates
+        ('stages') and the per source measurements ('sources').
+        """
+        finished = self.finished or time.time()
+        stages = {}
+        sources = {}
+        with self._lock:
+            samples = list(self.samples)
+        for sample in samples:
+            stage = stages.setdefault(sample['stage'], {
+                'count': 0, 'bytes': 0, 'seconds': [],
+                OK: 0, ERROR: 0, SKIPPED: 0})
+            stage['count'] += 1
+            stage['bytes'] += sample['bytes']
+            stage['seconds'].append(sample['seconds'])
+            stage[sample['outcome']] += 1
+            source = {'seconds': sample['seconds'], 'bytes': sample['bytes'],
+                      'outcome': sample['outcome']}
+            if sample['error'] is not None:
+                source['error'] = sample['error']
+            sources.setdefault(sample['urn'], {})[sample['stage']] = source
+        for stage in stages.values():
+            seconds = sorted(stage.pop('seconds'))
+            stage['seconds_total'] = sum(seconds)
+            stage['seconds_p50'] = percentile(seconds, 0.5)
+            stage['seconds_p95'] = percentile(seconds, 0.95)
+            stage['seconds_max'] = seconds[-1]
+        return {'job': self.job, 'started': self.started,
+                'finished': finished, 'seconds': finished - self.started,
+                'stages': stages, 'sources': sources}
+
+    def prometheus(self):
+        """
+        Returns the run in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        job = _label(self.job)
+        lines = [
+            '# HELP pull_run_seconds Wall time of the last run.',
+            '# TYPE pull_run_seconds gauge',
+            'pull_run_seconds{job="%s"} %f' % (job, summary['seconds']),
+            '# HELP pull_run_timestamp_seconds End time of the last run.',
+            '# TYPE pull_run_timestamp_seconds gauge',
+            'pull_run_timestamp_seconds{job="%s"} %f' % \
+                (job, summary['finished']),
+            '# HELP pull_stage_total Sources per stage and outcome.',
+            '# TYPE pull_stage_total gauge',
+        ]
+        for name, stage in sorted(summary['stages'].items()):
+            for outcome in (OK, ERROR, SKIPPED):
+                lines.append('pull_stage_total{job="%s",stage="%s",'
+                             'outcome="%s"} %d' % \
+                    (job, _label(name), outcome, stage[outcome]))
+        for metric, key, help_text in (
+                ('pull_source_seconds', 'seconds',
+                 'Wall time per stage and source.'),
+                ('pull_source_bytes', 'bytes',
+                 'Bytes per stage and source.')):
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s gauge' % metric)
+            for urn, stages in sorted(summary['sources'].items()):
+                for name, sample in sorted(stages.items()):
+                    lines.append('%s{job="%s",stage="%s",urn="%s",'
+                                 'outcome="%s"} %s' % \
+                        (metric, job, _label(name), _label(urn),
+                         sample['outcome'], sample[key]))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, filename):
+        """
+        Writes the run summary as JSON.
+        """
+        _atomic_write(filename, json.dumps(self.summary(), indent=2,
+                                           sort_keys=True))
+
+    def write_prometheus(self, filename):
+        """
+        Writes the run in the Prometheus text format.
+        """
+        _atomic_write(filename, self.prometheus())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+A long lived omni worker, started and fed by omnipool.OmniPool.
+
+Requests and replies are framed on stdin/stdout as one JSON header line,
+replies are followed by a body of 'length' bytes:
+
+    request: {"url": "https://am.example.net/am"}
+    reply:   {"status": 0, "length": M, "elapsed": seconds, "error": null}
+
+The worker imports omni from the directory of the omni executable (gcf's
+src directory) and loads the omni configuration and the user credentials
+once, every request is then a single listresources call. If omni cannot be
+imported the executable is run for every request instead.
+"""
+
+import argparse
+import copy
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+
+def load_omni(executable, conf):
+    """
+    Imports omni and loads its configuration and credentials.
+
+    Returns:
+        a function called with an AM URL returning the advertisement rspec
+    """
+    src = os.path.dirname(os.path.realpath(os.path.expanduser(executable)))
+    if src not in sys.path:
+        sys.path.insert(0, src)
+    import omni
+    framework, config, _, opts = omni.initialize(
+        ['-c', os.path.expanduser(conf), 'listresources'])
+
+    def listresources(url):
+        options = copy.copy(opts)
+        # Recent gcf releases accept several aggregates
+        options.aggregate = [url] if isinstance(opts.aggregate, list) \
+            else url
+        options.output = False
+        _, rspec = omni.API_call(framework, config, ['listresources'],
+                                 options)
+        if isinstance(rspec, dict):
+            rspec = rspec.values()[0] if len(rspec) == 1 else None
+        if not rspec:
+            raise Exception("no advertisement received from %s" % url)
+        return rspec
+    return listresources
+
+
+def exec_omni(executable, conf, workdir):
+    """
+    Returns a function running the omni executable for every AM URL.
+    """
+    outfile = os.path.join(workdir, 'rspec')
+
+    def listresources(url):
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        status = subprocess.call([os.path.expanduser(executable), '-c',
+                                  os.path.expanduser(conf), '-a', url,
+                                  'listresources', '--outputfile=%s' % outfile])
+        if status != 0:
+            raise Exception("omni exited with status %s" % status)
+        with open(outfile, 'rb') as rspec:
+            return rspec.read()
+    return listresources
+
+
+def main():
+    parser = argparse.ArgumentParser(description="omni worker")
+    parser.add_argument('--omni', required=True,
+        help='The omni executable.')
+    parser.add_argument('--conf', required=True,
+        help='The omni configuration file.')
+    args = parser.parse_args()
+
+    # Keep stdout for the protocol only, omni is talkative
+    requests = sys.stdin
+    replies = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    workdir = tempfile.mkdtemp(prefix='omni-')
+    try:
+        listresources = load_omni(args.omni, args.conf)
+    # omni exits on configuration and credential errors
+    except (Exception, SystemExit):
+        traceback.print_exc()
+        print >>sys.stderr, "Cannot load omni from %s, running it for " \
+            "every aggregate manager" % args.omni
+        listresources = exec_omni(args.omni, args.conf, workdir)
+    try:
+        while True:
+            line = requests.readline()
+            if not line:
+                break
+            header = json.loads(line)
+            start = time.time()
+            body, status, error = '', 0, None
+            try:
+                body = listresources(header['url'])
+            except SystemExit, exp:
+                status, error = 1, "omni exited with status %s" % exp.code
+            except Exception, exp:
+                traceback.print_exc()
+                status, error = 1, str(exp)
+            replies.write(json.dumps({'status': status, 'length': len(body),
+                                      'elapsed': time.time() - start,
+                                      'error': error}) + '\n')
+            replies.write(body)
+            replies.flush()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+A pool of long lived omni workers.
+
+Starting omni for every aggregate manager reloads the interpreter, the omni
+configuration and the user credentials before a single RPC is sent.
+OmniPool keeps a fixed number of omni_worker.py processes that load them
+once and serve listresources requests over pipes (see omni_worker.py for the
+framing).
+"""
+
+import json
+import logging
+import os
+import os.path
+import Queue
+import select
+import signal
+import subprocess
+import sys
+import time
+
+from resilience import DeadlineExceeded
+
+
+log = logging.getLogger('omnipool')
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'omni_worker.py')
+
+
+class OmniError(Exception):
+    """Raised when a worker dies or breaks the protocol."""
+    pass
+
+
+class OmniWorker(object):
+    """
+    One omni worker process.
+
+    Params:
+        omni: the omni executable
+        omni_conf: the omni configuration file
+    """
+    def __init__(self, omni, omni_conf):
+        # In its own process group so that a hung omni it started can be
+        # killed with it
+        self.process = subprocess.Popen(
+            [sys.executable, WORKER, '--omni', omni, '--conf', omni_conf],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            preexec_fn=os.setsid)
+
+    def listresources(self, url, timeout=None):
+        """
+        Gets the advertisement rspec of one aggregate manager.
+
+        Params:
+            url: the URL of the aggregate manager
+            timeout: seconds to wait for the reply, None to wait forever
+
+        Returns:
+            a tuple of (status, rspec or error message)
+
+        Raises:
+            OmniError if the worker died, DeadlineExceeded on timeout
+        """
+        try:
+            self.process.stdin.write(json.dumps({'url': url}) + '\n')
+            self.process.stdin.flush()
+            if timeout is not None:
+                ready, _, _ = select.select([self.process.stdout], [], [],
+                                            timeout)
+                if not ready:
+                    raise DeadlineExceeded("omni did not answer for %s in "
+                                           "%.0fs" % (url, timeout))
+            line = self.process.stdout.readline()
+        except IOError, exp:
+            raise OmniError("omni worker died: %s" % exp)
+        if not line:
+            raise OmniError("omni worker exited with %s" % \
+                self.process.poll())
+        reply = json.loads(line)
+        body = self.process.stdout.read(reply['length'])
+        if reply['status'] != 0:
+            return (reply['status'], reply['error'])
+        return (0, body)
+
+    def kill(self):
+        """
+        Stops the worker right away.
+        """
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+
+    def close(self):
+        """
+        Stops the worker.
+        """
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+
+class OmniPool(object):
+    """
+    A fixed size pool of omni workers.
+
+    Params:
+        size: the number of workers
+        omni: the omni executable
+        omni_conf: the omni configuration file
+    """
+    def __init__(self, size, omni, omni_conf):
+        self.size = size
+        self.omni = omni
+        self.omni_conf = omni_conf
+        self.workers = [OmniWorker(omni, omni_conf) for _ in range(size)]
+        self._idle = Queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def listresources(self, url, timeout=None):
+        """
+        Gets the advertisement rspec of one aggregate manager on the next
+        idle worker. A worker that dies or times out is replaced.
+
+        Params:
+            url: the URL of the aggregate manager
+            timeout: seconds to wait for the reply, None to wait forever
+
+        Returns:
+            a tuple of (status, rspec or error message), the status is -1 if
+            the worker died
+
+        Raises:
+            DeadlineExceeded on timeout
+        """
+        worker = self._idle.get()
+        start = time.time()
+        try:
+            status, body = worker.listresources(url, timeout)
+        except (OmniError, DeadlineExceeded), exp:
+            log.error("Pulling %s failed: %s" % (url, exp))
+            worker.kill()
+            self.workers.remove(worker)
+            worker = OmniWorker(self.omni, self.omni_conf)
+            self.workers.append(worker)
+            if isinstance(exp, DeadlineExceeded):
+                raise
+            status, body = -1, str(exp)
+        finally:
+            self._idle.put(worker)
+        log.info("Pulled %s in %.3fs" % (url, time.time() - start))
+        return status, body
+
+    def close(self):
+        """
+        Stops all the workers.
+        """
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
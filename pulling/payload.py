@@ -0,0 +1,128 @@
+"""
+Documents handed from one pipeline stage to the next.
+
+A Payload keeps its document in memory and only spills it to an anonymous
+temp file once it grows over a size threshold, so most documents never touch
+the disk. Tools that need a path (unisencoder) get a named copy that is
+removed when the payload is closed, or at exit at the latest.
+"""
+
+import atexit
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+
+log = logging.getLogger('payload')
+
+# Documents bigger than this are spilled to disk
+DEFAULT_SPOOL_SIZE = 8 * 1024 * 1024
+
+COPY_CHUNK = 64 * 1024
+
+_named_files = set()
+_named_lock = threading.Lock()
+
+
+def _remove_named(filename):
+    with _named_lock:
+        _named_files.discard(filename)
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+@atexit.register
+def cleanup():
+    """
+    Removes the named copies of the payloads that were never closed.
+    """
+    for filename in list(_named_files):
+        _remove_named(filename)
+
+
+class Payload(object):
+    """
+    A document kept in memory up to max_size bytes, on disk above it.
+
+    Params:
+        data: the initial content
+        max_size: the size above which the document is spilled to disk
+    """
+    def __init__(self, data=None, max_size=DEFAULT_SPOOL_SIZE):
+        self._spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self._named = None
+        self.size = 0
+        if data:
+            self.write(data)
+
+    @classmethod
+    def from_file(cls, filename, max_size=DEFAULT_SPOOL_SIZE, remove=True):
+        """
+        Reads a file into a new payload.
+
+        Params:
+            filename: the file to read
+            max_size: same as Payload
+            remove: delete the file once it is read
+        """
+        payload = cls(max_size=max_size)
+        try:
+            with open(filename, 'rb') as source:
+                for chunk in iter(lambda: source.read(COPY_CHUNK), ''):
+                    payload.write(chunk)
+        finally:
+            if remove:
+                os.remove(filename)
+        return payload
+
+    @property
+    def spilled(self):
+        """True if the document was spilled to disk."""
+        return self._spool._rolled
+
+    def write(self, data):
+        """
+        Appends data to the document.
+        """
+        self._spool.write(data)
+        self.size += len(data)
+
+    def open(self):
+        """
+        Returns the document as a file like object positioned at the start.
+        """
+        self._spool.seek(0)
+        return self._spool
+
+    def read(self):
+        """
+        Returns the whole document.
+        """
+        return self.open().read()
+
+    def filename(self):
+        """
+        Returns the name of a file with the document, for the tools that
+        only work on files. The file is removed when the payload is closed.
+        """
+        if self._named is None:
+            tmpf = tempfile.NamedTemporaryFile(delete=False)
+            with _named_lock:
+                _named_files.add(tmpf.name)
+            shutil.copyfileobj(self.open(), tmpf, COPY_CHUNK)
+            tmpf.close()
+            self._named = tmpf.name
+        return self._named
+
+    def close(self):
+        """
+        Releases the memory or the disk space used by the document.
+        """
+        self._spool.close()
+        if self._named is not None:
+            _remove_named(self._named)
+            self._named = None
@@ -0,0 +1,140 @@
+"""
+A pipeline of stages connected by bounded queues.
+
+Every item moves to the next stage as soon as the previous stage is done with
+it, so one slow source only delays itself. The queues between the stages are
+bounded, a slow stage makes the stages before it wait instead of piling up
+documents in memory.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from metrics import OK, ERROR, SKIPPED
+
+
+log = logging.getLogger('pipeline')
+
+DEFAULT_QUEUE_SIZE = 16
+
+# Marks the end of the items in a queue
+_STOP = object()
+
+
+class Stage(object):
+    """
+    One step of a pipeline.
+
+    Params:
+        name: the name of the stage, used in the logs and the error report
+        func: called as func(urn, value) and returns the value passed to the
+            next stage. Returning None drops the item, raising an exception
+            records an error for the URN.
+        workers: the number of threads running func
+    """
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+class Pipeline(object):
+    """
+    Runs items through stages.
+
+    Params:
+        stages: a list of Stage
+        queue_size: the maximum number of items waiting before every stage
+        metrics: a Metrics recording every stage of every item, the bytes
+            are the 'size' of the value returned by the stage, or of its
+            input if the returned value has none
+    """
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE, metrics=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.metrics = metrics
+
+    def _record(self, stage, urn, start, value, output, outcome, error=None):
+        if self.metrics is None:
+            return
+        nbytes = getattr(output, 'size', None)
+        if nbytes is None:
+            nbytes = getattr(value, 'size', 0)
+        self.metrics.record(stage.name, urn, time.time() - start, nbytes,
+                            outcome, error)
+
+    def run(self, items):
+        """
+        Runs the items through all the stages.
+
+        Params:
+            items: an iterable of (URN, value) tuples
+
+        Returns:
+            a tuple of (dict of URN and the value returned by the last stage,
+            dict of URN and (stage name, error message) for failed items)
+        """
+        queues = [Queue.Queue(self.queue_size) for _ in self.stages]
+        queues.append(Queue.Queue())
+        results = {}
+        errors = {}
+        remaining = [stage.workers for stage in self.stages]
+        lock = threading.Lock()
+
+        def work(index):
+            stage = self.stages[index]
+            inbox, outbox = queues[index], queues[index + 1]
+            while True:
+                item = inbox.get()
+                if item is _STOP:
+                    break
+                urn, value = item
+                start = time.time()
+                try:
+                    output = stage.func(urn, value)
+                except Exception, exp:
+                    log.error("%s failed in stage %s: %s" % \
+                        (urn, stage.name, exp))
+                    self._record(stage, urn, start, value, None, ERROR,
+                                 str(exp))
+                    with lock:
+                        errors[urn] = (stage.name, str(exp))
+                    continue
+                if output is None:
+                    self._record(stage, urn, start, value, None, SKIPPED)
+                else:
+                    self._record(stage, urn, start, value, output, OK)
+                    outbox.put((urn, output))
+            with lock:
+                remaining[index] -= 1
+                last = remaining[index] == 0
+            if last:
+                # Let every worker of the next stage know we are done
+                workers = self.stages[index + 1].workers \
+                    if index + 1 < len(self.stages) else 1
+                for _ in range(workers):
+                    outbox.put(_STOP)
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=work, args=(index,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_STOP)
+
+        while True:
+            item = queues[-1].get()
+            if item is _STOP:
+                break
+            results[item[0]] = item[1]
+        for thread in threads:
+            thread.join()
+        return results, errors
@@ -10,31 +10,38 @@ import argparse
 import ConfigParser
 from lxml import etree
 import logging
-import itertools
-import multiprocessing
-import subprocess
 import tempfile
 import os.path
+import sys
 import urllib2
 
+from httppool import HTTPPoolError, READ_CHUNK
+from payload import Payload, DEFAULT_SPOOL_SIZE
+from resilience import run_command
+from engine import SourceType, Settings, Engine, register_source_type
+from engine import read_sources, add_arguments, setup_logging
+
 # Setting basic logging
 log = logging.getLogger('ps_pull')
 log.setLevel(logging.DEBUG)
 
-# The location of the unisencoder
-DEFAULT_UNISENCODER = "unisencoder"
-
-DEFAULT_UNIS_URL = "http://129.79.244.8:8888"
-
 NMTOPO = "http://ogf.org/schema/network/topology/base/20070828/"
 
-CHUNKSIZE = 4
+# Topology Service query for the whole topology
+TS_QUERY = """
+    <nmwg:message type="TSQueryRequest" id="msg1"
+    xmlns:nmwg="http://ggf.org/ns/nmwg/base/2.0/"
+    xmlns:xquery="http://ggf.org/ns/nmwg/tools/org/perfsonar/service/lookup/xquery/1.0/">
+    <nmwg:metadata id="meta1">
+    <nmwg:eventType>http://ggf.org/ns/nmwg/topology/20070809</nmwg:eventType>
+    </nmwg:metadata>
+    <nmwg:data metadataIdRef="meta1" id="d1" />
+    </nmwg:message>
+    """
 
 
-# Configuration's sections names
+# Configuration's section listing the topology services
 PS_SEC = 'perfSONAR_Topologies'
-UNIS_SEC = 'UNIS'
-UNISENCODER_SEC = 'UNISENCODER'
 
 def make_envelope(content):
     """
@@ -53,69 +60,124 @@ def make_envelope(content):
     """ % content
     return envelope
 
-def send_receive(url, envelope):
+def send_receive(url, envelope, http_pool=None, stream=False):
     """
     Communicate with web service.
+
+    Params:
+        url: the web service accesspoint
+        envelope: the SOAP envelope to be sent
+        http_pool: an HTTPPool to reuse connections, if None a new urllib2
+            connection is opened
+        stream: if True a file like response is returned instead of the
+            body, the caller has to close it
     """
-    req = urllib2.Request(url=url, data=envelope,
-        headers={
-            'Content-type': 'text/xml; charset="UTF-8"',
-            'SOAPAction': 'http://ggf.org/ns/nmwg/base/2.0/message/'
-        }
-    )
-    file_handler = urllib2.urlopen(req)
-    return file_handler.read()
+    headers = {
+        'Content-type': 'text/xml; charset="UTF-8"',
+        'SOAPAction': 'http://ggf.org/ns/nmwg/base/2.0/message/'
+    }
+    if http_pool is None:
+        req = urllib2.Request(url=url, data=envelope, headers=headers)
+        file_handler = urllib2.urlopen(req)
+        if stream:
+            return file_handler
+        return file_handler.read()
+    if stream:
+        response = http_pool.open('POST', url, envelope, headers)
+        if response.status != 200:
+            response.close()
+            raise HTTPPoolError("%s returned HTTP status %s" % \
+                (url, response.status))
+        return response
+    status, _, body = http_pool.request('POST', url, envelope, headers)
+    if status != 200:
+        raise HTTPPoolError("%s returned HTTP status %s" % (url, status))
+    return body
 
 
-def pull_topology(name_url):
+def pull_topology(name_url, http_pool=None):
     """
     Pulls a topology from perfSONAR Topology Service.
     
     Params:
         name_url: a tuple of URN and accesspoint
+        http_pool: an HTTPPool shared between the pulls
     """
     log.info("Pulling topology from %s: %s" % (name_url[0], name_url[1]))
-    query = """
-    <nmwg:message type="TSQueryRequest" id="msg1"
-    xmlns:nmwg="http://ggf.org/ns/nmwg/base/2.0/"
-    xmlns:xquery="http://ggf.org/ns/nmwg/tools/org/perfsonar/service/lookup/xquery/1.0/">
-    <nmwg:metadata id="meta1">
-    <nmwg:eventType>http://ggf.org/ns/nmwg/topology/20070809</nmwg:eventType>
-    </nmwg:metadata>
-    <nmwg:data metadataIdRef="meta1" id="d1" />
-    </nmwg:message>
+    envelope = make_envelope(TS_QUERY)
+    return (name_url[0], send_receive(name_url[1], envelope, http_pool))
+
+def extract_topology(stream, sink):
     """
-    envelope = make_envelope(query)
-    return (name_url[0], send_receive(name_url[1], envelope))
+    Incrementally parses a SOAP response and writes the first nmtopo:topology
+    element to sink.
 
-def pull_topologies(services):
+    Elements outside of the topology are cleared as soon as they are parsed,
+    so the memory used is bounded by the size of the topology element rather
+    than the size of the response.
+
+    Params:
+        stream: a file like object with the SOAP response
+        sink: a file like object to write the topology to
+
+    Returns:
+        True if a topology was found
     """
-    Pulling topology information from the given list of services.
-    
+    tag = "{%s}topology" % NMTOPO
+    depth = 0
+    for event, elem in etree.iterparse(stream, events=('start', 'end')):
+        if elem.tag == tag:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                sink.write(etree.tostring(elem))
+                return True
+        elif event == 'end' and depth == 0:
+            elem.clear()
+            parent = elem.getparent()
+            while parent is not None and elem.getprevious() is not None:
+                del parent[0]
+    return False
+
+def stream_topology(name_url, sink, http_pool=None):
+    """
+    Pulls a topology from perfSONAR Topology Service and writes the topology
+    element to sink while the response is being received.
+
     Params:
-        services: a dict of URN : service accesspoint
-    Return:
-        a dict of URN: filename; where the file name contains the topology info
-        in case of failure the error code is returned
+        name_url: a tuple of URN and accesspoint
+        sink: a file like object for the topology
+        http_pool: an HTTPPool shared between the pulls
+
+    Returns:
+        True if the response has a topology
     """
-    output_files = {}    
-    pool = multiprocessing.Pool(None)
-    tasks = list(services.items())
-    for ret in pool.imap(pull_topology, tasks):
-        if not isinstance(ret, tuple):
-            return ret
-        name = ret[0]
-        response = ret[1]
-        tree = etree.fromstring(response)
-        topology = tree.find(".//{%s}topology" % NMTOPO)
-        if topology is None:
-            print "No topology was found for service", name
-            log.error("No topology was found for service %s " % name)
-        else:
-            tmpf = tempfile.NamedTemporaryFile(delete=False)
-            tmpf.write(etree.tostring(topology))
-            output_files[name] = tmpf.name
-    return output_files
+    log.info("Streaming topology from %s: %s" % (name_url[0], name_url[1]))
+    envelope = make_envelope(TS_QUERY)
+    response = send_receive(name_url[1], envelope, http_pool, stream=True)
+    try:
+        found = extract_topology(response, sink)
+        # Drain the rest of the envelope so the connection can be reused
+        while response.read(READ_CHUNK):
+            pass
+    finally:
+        response.close()
+    return found
+
+def find_topology(response):
+    """
+    Extracts the topology from a SOAP response.
+
+    Returns:
+        the serialized topology element or None if there is none
+    """
+    tree = etree.fromstring(response)
+    topology = tree.find(".//{%s}topology" % NMTOPO)
+    if topology is None:
+        return None
+    return etree.tostring(topology)
 
 def encode_topology_to_unis(urn, filename, unisencoder):
     """
@@ -129,74 +191,84 @@ def encode_topology_to_unis(urn, filename, unisencoder):
     """
     log.info("Encoding topology %s from file %s" % (urn, filename))
     tmpf = tempfile.NamedTemporaryFile(delete=False)
+    tmpf.close()
     # TODO (AH): Add urn
-    ret = subprocess.call("%s -t ps -o %s %s" % \
-        (unisencoder, tmpf.name, filename), shell=True)
+    ret = run_command("%s -t ps -o %s %s" % \
+        (unisencoder, tmpf.name, filename))
     if ret == 0:
         return (urn, tmpf.name)
     else:
+        os.remove(tmpf.name)
         return ret
 
 
-def encode_topology_to_unis_wrapper(params):
+class PSSource(SourceType):
     """
-    This a work around to make multiprocessing work with more than one variable.
+    The perfSONAR Topology services, pulled over the shared HTTPPool.
+
+    Params:
+        http_pool: the HTTPPool for the topology services
+        stream: extract the topologies while the responses are received
+        spool_size: the size above which a topology is spilled to disk
     """
-    return encode_topology_to_unis(params[0][0], params[0][1], params[1])
+    name = 'ps'
+    section = PS_SEC
+    doc_type = 'ps'
+    collection = 'topologies'
 
+    def __init__(self, http_pool, stream=False,
+                 spool_size=DEFAULT_SPOOL_SIZE):
+        self.http_pool = http_pool
+        self.stream = stream
+        self.spool_size = spool_size
+        # The pool bounds the requests in flight
+        self.workers = http_pool.max_connections
+        self.maximum = http_pool.max_connections
+        self.host_maximum = http_pool.max_per_host
 
-def encode_topologies_to_unis(topologies, unisencoder):
-    """
-    Invokes UNISENCODER to encode topologies to UNIS format.
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument('--timeout', type=float, default=None,
+            help='Timeout in seconds for every request to a topology '
+            'service.')
+        parser.add_argument('--max-connections', type=int, default=None,
+            help='The maximum number of concurrent requests.')
+        parser.add_argument('--max-per-host', type=int, default=None,
+            help='The maximum number of concurrent requests per host.')
+        parser.add_argument('--stream', action='store_true', default=False,
+            help='Extract the topologies while the responses are received, '
+            'memory is then bounded by the topology size.')
 
-    Params:
-       topologies: a dict of rspecs URNs and full filename
+    @classmethod
+    def configure(cls, engine):
+        return cls(engine.shared_http_pool(), engine.settings.stream,
+                   engine.settings.spool_size)
 
-    Returns:
-      a dict of URNs and the name of UNIS temp files
-    """
-    log.info("Encoding all topologies to UNIS")
-    output_files = {}
-    pool = multiprocessing.Pool(None)
-    tasks = itertools.izip(topologies.items(),
-                           itertools.repeat(unisencoder))
-    for ret in pool.imap(encode_topology_to_unis_wrapper,
-        tasks, chunksize=CHUNKSIZE):
-        if isinstance(ret, tuple):
-            output_files[ret[0]] = ret[1]
-        else:
-            return ret
-    pool.close()
-    return output_files
-
-
-def send_to_unis(unis_files, unis_url):
-    """
-    HTTP POST to the UNIS Instance.
-    
-    Params:
-        unis_files: index of URN and name of the file to be sent
-        unis_url: the UNIS instance 
-    
-    Returns:
-        None
-    """
-    for unisf in unis_files.values():
-        log.info("Sending %s to UNIS %s" % (unisf, unis_url))
-        subprocess.call(
-        'curl -X POST -H "Content-Type: application/perfsonar+json" -d@%s %s' % \
-         (unisf, unis_url + "/topologies"),
-         shell=True)
+    def pull(self, urn, url, deadline=None):
+        payload = Payload(max_size=self.spool_size)
+        try:
+            if self.stream:
+                found = stream_topology((urn, url), payload, self.http_pool)
+            else:
+                topology = find_topology(pull_topology((urn, url),
+                                                       self.http_pool)[1])
+                found = topology is not None
+                if found:
+                    payload.write(topology)
+            if not found:
+                raise Exception("No topology was found for service %s" % urn)
+        except:
+            payload.close()
+            raise
+        return payload
 
+    def encode_file(self, urn, filename, unisencoder):
+        ret = encode_topology_to_unis(urn, filename, unisencoder)
+        if not isinstance(ret, tuple):
+            raise Exception("unisencoder exited with status %s" % ret)
+        return ret[1]
 
-def is_valid_file(parser, arg, flag='r', mode=0666):
-    """
-    Auxilary function for argparser to check a file is valid input.
-    """
-    if flag.startswith('r'):
-        if not os.path.exists(arg):
-            parser.error("The file %s does not exist!"%arg)
-    return open(arg, flag, mode)
+register_source_type(PSSource)
 
 
 def main():
@@ -207,35 +279,16 @@ def main():
         description="Pulls topologies from perfSONAR Topology Services"
         "then encode them to UNIS format and pushes it to UNIS service"
     )
-    parser.add_argument('-c', '--config',
-        type=lambda x: is_valid_file(parser,x, 'r'))
+    add_arguments(parser)
     parser.add_argument('-a', '--psservice_accesspoint', type=str, default=None,
         help='The accesspoints of the perfSONAR Topology services.')
     parser.add_argument('--urn', type=str, default=None,
         help='The URN of the perfSONAR topology service.')
-    parser.add_argument('-e', '--encoder', type=str, default=None,
-        help='The unisencoder executable.')
-    parser.add_argument('-u', '--unis_url', type=str, default=None,
-        help='The URL of the UNIS instance')
-    parser.add_argument('-l', '--log',
-        type=lambda x: is_valid_file(parser,x, 'w'),
-        help='Log file.')
+    PSSource.add_arguments(parser)
     args = parser.parse_args()
+    setup_logging(args.log)
     
-    formatter = logging.Formatter('[%(levelname)s] %(message)s')
-    if args.log is None:
-        handler_stream = logging.StreamHandler()
-        handler_stream.setFormatter(formatter)
-        log.addHandler(handler_stream)
-    else:
-        file_handler = logging.FileHandler(args.log)
-        file_handler.setFormatter(formatter)
-        log.addHandler(file_handler)
-    
-    # Assume the default values first
-    unis_url = DEFAULT_UNIS_URL
-    unisencoder = DEFAULT_UNISENCODER
-    
+    settings = Settings()
     if args.config is not None:
         # Read configurarion
         config = ConfigParser.ConfigParser()
@@ -245,38 +298,26 @@ def main():
         if not config.has_section(PS_SEC):
             raise Exception("No perfSONAR Topology services are defined in "
                             "the configuration file")
-        psservices = {}
-        if config.has_section(PS_SEC):
-            for urn, url in config.items(PS_SEC):
-                psservices[urn] = url
-        unis_url = config.get(UNIS_SEC,'url') \
-            if config.has_option(UNIS_SEC, 'url') \
-            else unis_url
-        unisencoder = config.get(UNISENCODER_SEC,'exec') \
-            if config.has_option(UNISENCODER_SEC, 'exec') \
-            else unisencoder
+        psservices, intervals = read_sources(config, [PSSource.name])
+        settings.read(config)
     elif args.psservice_accesspoint is not None and args.urn is not None:
-        psservices = {}
-        psservices[args.urn] = [args.psservice_accesspoint]
+        psservices = {args.urn: (PSSource.name, args.psservice_accesspoint)}
+        intervals = {}
     else:
         parser.error("Either a configuration file or a "
             "perfSONAR Topology Service should be provided")
     
-    # Read command line arguments
     # Command line arguments overrides values on a configuration file
-    unis_url = args.unis_url or unis_url
-    unisencoder = args.encoder or unisencoder
-    
-    # Start pulling rspecs from aggregate managers
-    topologies = pull_topologies(psservices)
-    if not isinstance(topologies, dict):
-        return topologies
-    unis_files = encode_topologies_to_unis(topologies, unisencoder)
-    if not isinstance(unis_files, dict):
-        return unis_files
-    send_to_unis(unis_files, unis_url)
+    settings.override(args)
     
-    # TODO: clean up temp files
+    # Pull, encode and push every topology as soon as it is ready
+    engine = Engine(settings, [PSSource.name], 'ps_pull')
+    try:
+        errors = engine.run(psservices, intervals, args.daemon)
+    finally:
+        engine.close()
+    if errors:
+        return 1
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
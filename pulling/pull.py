@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Pulls the sources of all the types listed in one configuration file
+(perfSONAR topology services, aggregate managers, ...) in a single process,
+sharing the pools, the connections and the uploads to UNIS between them.
+"""
+
+import argparse
+import ConfigParser
+import logging
+import sys
+
+import ps_pull
+import am_pull
+from engine import Settings, Engine, SOURCE_TYPES
+from engine import read_sources, add_arguments, setup_logging
+
+
+log = logging.getLogger('pull')
+
+# The source types pulled, importing their modules registers them in
+# SOURCE_TYPES
+TYPES = [ps_pull.PSSource.name, am_pull.AMSource.name]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pulls the sources of every type listed in the "
+        "configuration file, encodes them to UNIS format and pushes them to "
+        "UNIS")
+    add_arguments(parser)
+    parser.add_argument('-t', '--types', type=str, default=None,
+        help='Only pull the sources of these comma separated types (%s).' % \
+        ', '.join(TYPES))
+    for name in TYPES:
+        SOURCE_TYPES[name].add_arguments(parser)
+    args = parser.parse_args()
+    setup_logging(args.log)
+
+    if args.config is None:
+        parser.error("A configuration file should be provided")
+    types = args.types.split(',') if args.types else TYPES
+    for name in types:
+        if name not in SOURCE_TYPES:
+            parser.error("Unknown source type %s" % name)
+    config = ConfigParser.ConfigParser()
+    config.readfp(args.config)
+    sources, intervals = read_sources(config, types)
+    if not sources:
+        raise Exception("No sources are defined in the configuration file")
+    settings = Settings()
+    settings.read(config)
+    settings.override(args)
+
+    # Only set up the types that have sources
+    engine = Engine(settings, sorted(set(name for name, _ in
+                                         sources.values())), 'pull')
+    try:
+        errors = engine.run(sources, intervals, args.daemon)
+    finally:
+        engine.close()
+    if errors:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,290 @@
+"""
+Deadlines, retries and hedged requests for the per source work.
+
+One hung source must not block a run, so every call gets a deadline after
+which it is abandoned, and a budget of retries. Sources that are slower than
+their usual 95th percentile can get a second, hedged, attempt started in
+parallel, the first attempt to succeed wins.
+"""
+
+import atexit
+import json
+import logging
+import os
+import os.path
+import Queue
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger('resilience')
+
+DEFAULT_DEADLINE = 600
+DEFAULT_RETRIES = 1
+DEFAULT_BACKOFF = 5.0
+# Latencies kept per source and needed before hedging
+HISTORY_SIZE = 50
+MIN_SAMPLES = 5
+
+
+# Process groups started by run_command that are still running, an abandoned
+# attempt must not leave them behind when we exit
+_running = set()
+_running_lock = threading.Lock()
+
+
+def _kill(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+@atexit.register
+def _kill_running():
+    with _running_lock:
+        for pid in _running:
+            _kill(pid)
+        _running.clear()
+
+
+def _discard(urn, value):
+    """
+    Closes the result of a late attempt (e.g. a Payload and its spool file)
+    that nobody will use.
+    """
+    close = getattr(value, 'close', None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception, exp:
+        log.warning("Closing a late result of %s failed: %s" % (urn, exp))
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call does not finish before its deadline."""
+    pass
+
+
+def run_command(cmd, timeout=None):
+    """
+    Runs a shell command, killing it with its children if it is still
+    running after timeout seconds.
+
+    Returns:
+        the exit status of the command
+
+    Raises:
+        DeadlineExceeded if the command was killed
+    """
+    process = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid)
+    with _running_lock:
+        _running.add(process.pid)
+    try:
+        if timeout is None:
+            return process.wait()
+        end = time.time() + timeout
+        delay = 0.01
+        while process.poll() is None:
+            if time.time() >= end:
+                _kill(process.pid)
+                process.wait()
+                raise DeadlineExceeded("'%s' killed after %ss" % \
+                    (cmd, timeout))
+            time.sleep(min(delay, max(end - time.time(), 0)))
+            delay = min(delay * 2, 0.5)
+        return process.returncode
+    finally:
+        with _running_lock:
+            _running.discard(process.pid)
+
+
+class LatencyHistory(object):
+    """
+    The recent successful latencies of every source.
+
+    Params:
+        filename: a JSON file to keep the history between runs, or None
+    """
+    def __init__(self, filename=None):
+        self.filename = os.path.expanduser(filename) if filename else None
+        self.latencies = {}
+        self._lock = threading.Lock()
+        if self.filename and os.path.exists(self.filename):
+            with open(self.filename) as history:
+                self.latencies = json.load(history)
+
+    def add(self, urn, seconds):
+        """
+        Records a successful call of urn.
+        """
+        with self._lock:
+            latencies = self.latencies.setdefault(urn, [])
+            latencies.append(seconds)
+            del latencies[:-HISTORY_SIZE]
+
+    def p95(self, urn):
+        """
+        The 95th percentile latency of urn or None without enough samples.
+        """
+        with self._lock:
+            latencies = sorted(self.latencies.get(urn, []))
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1,
+                             int(round(0.95 * (len(latencies) - 1))))]
+
+    def save(self):
+        """
+        Writes the history to its file, if it has one.
+        """
+        if not self.filename:
+            return
+        with self._lock:
+            content = json.dumps(self.latencies)
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        tmpf = tempfile.NamedTemporaryFile(dir=dirname, delete=False)
+        tmpf.write(content)
+        tmpf.close()
+        os.rename(tmpf.name, self.filename)
+
+
+class Resilient(object):
+    """
+    Runs calls with a deadline, a retry budget and optional hedging.
+
+    Params:
+        deadline: the seconds a call may take including its retries, None
+            for no deadline
+        retries: the number of retries after the first attempt
+        backoff: the delay in seconds before the first retry, doubled for
+            every other retry
+        hedge: start a second attempt when the first one is slower than the
+            95th percentile latency of the source
+        history: the LatencyHistory for hedging, a new one if None
+    """
+    def __init__(self, deadline=DEFAULT_DEADLINE, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, hedge=False, history=None):
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.history = history if history is not None else LatencyHistory()
+
+    def wrap(self, func):
+        """
+        Returns func(urn, value) made resilient, for pipeline stages.
+        """
+        def resilient(urn, value):
+            return self.call(urn, func, urn, value)
+        return resilient
+
+    def call(self, urn, func, *args):
+        """
+        Calls func(*args) for the source urn.
+
+        Returns:
+            what func returns
+
+        Raises:
+            DeadlineExceeded or the error of the last attempt
+        """
+        end = time.time() + self.deadline if self.deadline else None
+        delay = self.backoff
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = end - time.time() if end is not None else None
+            try:
+                return self._attempt(urn, func, args, timeout)
+            except DeadlineExceeded:
+                raise
+            except Exception, exp:
+                if attempt > self.retries:
+                    raise
+                if end is not None and time.time() + delay >= end:
+                    raise
+                log.warning("%s failed (attempt %d), retrying in %.1fs: %s" % \
+                    (urn, attempt, delay, exp))
+                time.sleep(delay)
+                delay *= 2
+
+    def _attempt(self, urn, func, args, timeout):
+        results = Queue.Queue()
+        # Set once a winner is returned or the call is abandoned, the
+        # attempts still running then are late
+        finished = []
+        lock = threading.Lock()
+
+        def run():
+            start = time.time()
+            try:
+                result = (True, func(*args), time.time() - start)
+            except Exception, exp:
+                result = (False, exp, time.time() - start)
+            with lock:
+                if not finished:
+                    results.put(result)
+                    return
+            if result[0]:
+                _discard(urn, result[1])
+
+        def finish():
+            with lock:
+                finished.append(True)
+            # The results that arrived but will never be read
+            while True:
+                try:
+                    ok, value, seconds = results.get_nowait()
+                except Queue.Empty:
+                    return
+                if ok:
+                    _discard(urn, value)
+
+        def start_thread():
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+
+        start = time.time()
+        start_thread()
+        running = 1
+        hedge_after = self.history.p95(urn) if self.hedge else None
+        error = None
+        while running:
+            wait = None
+            if timeout is not None:
+                wait = timeout - (time.time() - start)
+            if hedge_after is not None:
+                until_hedge = hedge_after - (time.time() - start)
+                wait = until_hedge if wait is None else min(wait, until_hedge)
+            try:
+                if wait is None:
+                    ok, value, seconds = results.get()
+                else:
+                    ok, value, seconds = results.get(timeout=max(wait, 0))
+            except Queue.Empty:
+                if hedge_after is not None and \
+                        time.time() - start >= hedge_after:
+                    log.info("%s is slower than its p95 (%.2fs), hedging" % \
+                        (urn, hedge_after))
+                    hedge_after = None
+                    start_thread()
+                    running += 1
+                    continue
+                # The attempts are abandoned, their threads are daemons and
+                # discard what they return
+                finish()
+                raise DeadlineExceeded("%s did not finish in %.0fs" % \
+                    (urn, timeout))
+            running -= 1
+            if ok:
+                self.history.add(urn, seconds)
+                finish()
+                return value
+            error = error or value
+        raise error
@@ -0,0 +1,130 @@
+"""
+Schedules the pulls of every source at its own interval for the daemon mode.
+
+The sources come from the existing configuration sections, the value of a
+source may be followed by its pull interval in seconds:
+
+    [perfSONAR_Topologies]
+    i2 = http://dcn-ts.internet2.edu:8012/perfSONAR_PS/services/topology 600
+
+Sources without an interval use the default one. Failing sources are retried
+with an exponential backoff, from a short retry delay up to max_backoff, and
+every delay is randomly jittered so the sources don't all end up being
+pulled at the same time.
+"""
+
+import heapq
+import logging
+import random
+import threading
+import time
+
+
+log = logging.getLogger('scheduler')
+
+DEFAULT_INTERVAL = 3600
+DEFAULT_JITTER = 0.1
+DEFAULT_MAX_BACKOFF = 6 * 3600
+DEFAULT_RETRY_DELAY = 60
+
+
+def parse_source(value):
+    """
+    Splits a source configuration value into its URL and interval.
+
+    Returns:
+        a tuple of (URL, interval in seconds or None)
+    """
+    parts = value.split()
+    if len(parts) > 1:
+        return parts[0], float(parts[1])
+    return value.strip(), None
+
+
+class Source(object):
+    """
+    A scheduled source.
+    """
+    def __init__(self, urn, url, interval):
+        self.urn = urn
+        self.url = url
+        self.interval = interval
+        self.failures = 0
+
+
+class Scheduler(object):
+    """
+    Pulls every source at its interval until stopped.
+
+    Params:
+        sources: a dict of URN and (URL, interval or None)
+        run_cycle: called with a dict of URN and URL for the sources that are
+            due, returns a dict whose keys are the URNs that failed
+        interval: the default interval in seconds
+        jitter: the fraction of the delay added or removed at random
+        max_backoff: the longest delay in seconds for a failing source
+        retry_delay: the delay in seconds before the first retry of a
+            failing source, doubled for every other failure
+    """
+    def __init__(self, sources, run_cycle, interval=DEFAULT_INTERVAL,
+                 jitter=DEFAULT_JITTER, max_backoff=DEFAULT_MAX_BACKOFF,
+                 retry_delay=DEFAULT_RETRY_DELAY):
+        self.sources = {}
+        for urn, (url, source_interval) in sources.items():
+            self.sources[urn] = Source(urn, url, source_interval or interval)
+        self.run_cycle = run_cycle
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.retry_delay = retry_delay
+        self._stop = threading.Event()
+
+    def delay(self, source):
+        """
+        The time to wait before pulling source again.
+        """
+        delay = source.interval
+        if source.failures:
+            # Not based on the interval, a failing source must not wait
+            # longer than a healthy one for its first retry
+            delay = min(self.retry_delay * 2 ** (source.failures - 1),
+                        self.max_backoff)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def run(self):
+        """
+        Runs the cycles until stop is called. All the sources are pulled on
+        the first cycle.
+        """
+        now = time.time()
+        queue = [(now, urn) for urn in self.sources]
+        heapq.heapify(queue)
+        while queue and not self._stop.is_set():
+            wait = queue[0][0] - time.time()
+            if wait > 0:
+                self._stop.wait(wait)
+                continue
+            due = {}
+            while queue and queue[0][0] <= time.time():
+                urn = heapq.heappop(queue)[1]
+                due[urn] = self.sources[urn].url
+            log.info("Pulling %d sources" % len(due))
+            try:
+                failed = self.run_cycle(due)
+            except Exception, exp:
+                log.exception("Cycle failed: %s" % exp)
+                failed = due
+            now = time.time()
+            for urn in due:
+                source = self.sources[urn]
+                source.failures = source.failures + 1 if urn in failed else 0
+                delay = self.delay(source)
+                if source.failures:
+                    log.info("%s failed %d times, retrying in %.0fs" % \
+                        (urn, source.failures, delay))
+                heapq.heappush(queue, (now + delay, urn))
+
+    def stop(self):
+        """
+        Stops the scheduler after the current cycle.
+        """
+        self._stop.set()
@@ -0,0 +1,132 @@
+"""
+Persistent per URN state shared between runs of the pullers.
+
+The state remembers a normalized hash of the last document that was pushed
+to UNIS for every URN, so documents that did not change since the last run
+don't have to be encoded and pushed again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from lxml import etree
+
+
+log = logging.getLogger('state')
+
+# Root attributes that change on every pull without the topology changing
+VOLATILE_ATTRIBUTES = ('generated', 'expires', 'generated_by')
+
+
+def content_hash(document):
+    """
+    Computes a hash of an XML document that does not depend on formatting.
+
+    The document is canonicalized (C14N) with the ignorable whitespace
+    removed and the volatile root attributes, such as the RSpec generation
+    time, dropped. Documents that can't be parsed are hashed as is.
+
+    Params:
+        document: the name of the file to hash or a seekable file like
+            object positioned at the start of the document
+
+    Returns:
+        the hex digest of the document
+    """
+    parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+    try:
+        tree = etree.parse(document, parser)
+    except etree.XMLSyntaxError:
+        log.debug("Hashing %s without normalization" % document)
+        digest = hashlib.sha1()
+        if isinstance(document, basestring):
+            doc = open(document, 'rb')
+        else:
+            doc = document
+            doc.seek(0)
+        try:
+            for chunk in iter(lambda: doc.read(64 * 1024), ''):
+                digest.update(chunk)
+        finally:
+            if doc is not document:
+                doc.close()
+        return digest.hexdigest()
+    root = tree.getroot()
+    for attr in VOLATILE_ATTRIBUTES:
+        if attr in root.attrib:
+            del root.attrib[attr]
+    try:
+        normalized = etree.tostring(tree, method='c14n')
+    except etree.C14NError:
+        # C14N rejects relative namespace URIs, still hash the cleaned tree
+        normalized = etree.tostring(tree)
+    return hashlib.sha1(normalized).hexdigest()
+
+
+class StateStore(object):
+    """
+    A JSON file of URN: {'hash': digest, 'updated': timestamp}.
+
+    Params:
+        filename: the file the state is kept in, it is created on save
+    """
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+        self.entries = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as state_file:
+                self.entries = json.load(state_file)
+
+    def changed(self, urn, digest):
+        """
+        Returns True if digest differs from the last recorded one for urn.
+        """
+        entry = self.entries.get(urn)
+        return entry is None or entry.get('hash') != digest
+
+    def update(self, urn, digest):
+        """
+        Records digest as the last pushed document for urn.
+        """
+        self.entries[urn] = {'hash': digest, 'updated': time.time()}
+
+    def check(self, urn, document, force=False):
+        """
+        Hashes one document.
+
+        Params:
+            urn: the URN of the document
+            document: the document file name or file like object, see
+                content_hash
+            force: treat the document as changed
+
+        Returns:
+            the digest of the document, or None if it did not change
+        """
+        digest = content_hash(document)
+        if force or self.changed(urn, digest):
+            return digest
+        log.info("%s did not change since the last push" % urn)
+        return None
+
+    def save(self):
+        """
+        Atomically writes the state to its file.
+        """
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmpf = tempfile.NamedTemporaryFile(dir=dirname, delete=False)
+        try:
+            json.dump(self.entries, tmpf, indent=2, sort_keys=True)
+            tmpf.close()
+            os.rename(tmpf.name, self.filename)
+        except:
+            tmpf.close()
+            os.remove(tmpf.name)
+            raise
@@ -0,0 +1,126 @@
+"""
+Tests of the delta of two UNIS documents: applying it to the resources UNIS
+has for the old document gives the resources of the new one.
+
+    python -m unittest test_delta
+"""
+
+import copy
+import unittest
+
+from delta import Document, NotDiffable, diff, href
+
+UNIS = "http://unis"
+
+
+def domain():
+    return {
+        "id": "domain1",
+        "ts": 1,
+        "nodes": [
+            {"id": "node1", "name": "a",
+             "ports": [{"id": "port1", "capacity": 1000},
+                       {"id": "port2", "capacity": 1000}]},
+            {"id": "node2", "name": "b",
+             "ports": [{"id": "port3", "capacity": 1000}]},
+        ],
+        "links": [
+            {"id": "link1",
+             "endpoints": [{"href": "#/nodes/0/ports/0", "rel": "full"},
+                           {"href": "#/nodes/1/ports/0", "rel": "full"}]},
+        ],
+    }
+
+
+def resources(document):
+    """The resources UNIS keeps for a document, by URL."""
+    doc = Document(document, UNIS)
+    stored = dict((href(UNIS, collection, key), doc.own(resource))
+                  for (collection, key), resource in doc.resources.items())
+    stored[href(UNIS, 'domains', document["id"])] = doc.own(document)
+    return stored
+
+
+def apply_delta(stored, delta):
+    """Sends the delta to the resources as DeltaUploader does."""
+    stored = copy.deepcopy(stored)
+    for collection, key, resource in delta.added:
+        url = href(UNIS, collection, key)
+        assert url not in stored
+        stored[url] = resource
+    for collection, key, resource in delta.modified:
+        url = href(UNIS, collection, key)
+        assert url in stored
+        stored[url] = resource
+    if delta.root is not None:
+        stored[href(UNIS, 'domains', delta.root["id"])] = delta.root
+    for collection, key in delta.removed:
+        del stored[href(UNIS, collection, key)]
+    return stored
+
+
+class DiffTest(unittest.TestCase):
+
+    def round_trip(self, old, new):
+        delta = diff(old, new, UNIS)
+        self.assertEqual(apply_delta(resources(old), delta), resources(new))
+        return delta
+
+    def test_unchanged(self):
+        new = domain()
+        # Set by UNIS, and the order of the children does not matter
+        new["ts"] = 2
+        new["nodes"].reverse()
+        new["links"][0]["endpoints"] = [
+            {"href": "#/nodes/1/ports/0", "rel": "full"},
+            {"href": "#/nodes/0/ports/0", "rel": "full"}]
+        delta = diff(domain(), new, UNIS)
+        self.assertEqual(len(delta), 0)
+        self.assertEqual(delta.total, 7)
+
+    def test_modified(self):
+        new = domain()
+        new["nodes"][0]["ports"][1]["capacity"] = 10000
+        delta = self.round_trip(domain(), new)
+        self.assertEqual([(c, k) for c, k, _ in delta.modified],
+                         [("ports", "port2")])
+        self.assertEqual((delta.added, delta.removed, delta.root),
+                         ([], [], None))
+
+    def test_added_removed(self):
+        new = domain()
+        new["nodes"].append({"id": "node3", "name": "c", "ports": []})
+        del new["nodes"][1]["ports"][0]
+        del new["links"][0]
+        delta = self.round_trip(domain(), new)
+        self.assertEqual([(c, k) for c, k, _ in delta.added],
+                         [("nodes", "node3")])
+        self.assertEqual(sorted(delta.removed),
+                         [("links", "link1"), ("ports", "port3")])
+        # The parents list their children by reference
+        self.assertEqual(sorted(k for c, k, _ in delta.modified),
+                         ["node2"])
+        self.assertTrue(delta.root is not None)
+
+    def test_references(self):
+        new = domain()
+        new["links"][0]["endpoints"][1]["href"] = "#/nodes/0/ports/1"
+        delta = self.round_trip(domain(), new)
+        link = delta.modified[0][2]
+        self.assertEqual(link["endpoints"][1]["href"],
+                         "http://unis/ports/port2")
+
+    def test_not_diffable(self):
+        new = domain()
+        new["id"] = "domain2"
+        self.assertRaises(NotDiffable, diff, domain(), new, UNIS)
+        new = domain()
+        new["nodes"][1]["id"] = "node1"
+        self.assertRaises(NotDiffable, diff, domain(), new, UNIS)
+        new = domain()
+        new["links"][0]["endpoints"][0]["href"] = "#/nodes/5"
+        self.assertRaises(NotDiffable, diff, domain(), new, UNIS)
+
+
+if __name__ == '__main__':
+    unittest.main()
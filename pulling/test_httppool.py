@@ -0,0 +1,121 @@
+"""
+Tests of HTTPPool against a local server: plain and gzip bodies read whole or
+incrementally, kept alive connections and the concurrency slots.
+
+    python -m unittest test_httppool
+"""
+
+import BaseHTTPServer
+import gzip
+import SocketServer
+import StringIO
+import threading
+import time
+import unittest
+
+from httppool import HTTPPool, READ_CHUNK
+
+# Bigger than a few read chunks
+BODY = ''.join("<node id='%d'/>\n" % index for index in range(100000))
+
+
+def gzipped(data):
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+        out.write(data)
+    return buf.getvalue()
+
+GZIPPED = gzipped(BODY)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    connections = 0
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(0.3)
+        body = BODY
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = GZIPPED
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_read(self):
+        for compress in (False, True):
+            pool = HTTPPool(compress=compress)
+            status, _, body = pool.request('GET', self.url + '/')
+            self.assertEqual(status, 200)
+            self.assertEqual(body, BODY)
+            pool.close()
+
+    def test_read_chunks(self):
+        pool = HTTPPool()
+        response = pool.open('GET', self.url + '/')
+        self.assertEqual(response.headers['content-encoding'], 'gzip')
+        chunks = []
+        for size in iter(lambda: READ_CHUNK / 3, None):
+            chunk = response.read(size)
+            if not chunk:
+                break
+            self.assertTrue(len(chunk) <= size)
+            chunks.append(chunk)
+        response.close()
+        self.assertEqual(''.join(chunks), BODY)
+        pool.close()
+
+    def test_keep_alive(self):
+        pool = HTTPPool()
+        for _ in range(5):
+            self.assertEqual(pool.request('GET', self.url + '/')[2], BODY)
+        self.assertEqual(self.server.connections, 1)
+        pool.close()
+
+    def test_per_host_limit(self):
+        pool = HTTPPool(max_connections=4, max_per_host=1)
+        threads = [threading.Thread(target=pool.request,
+                                    args=('GET', self.url + '/slow'))
+                   for _ in range(3)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # One at a time, and every slot is back
+        self.assertTrue(time.time() - start >= 0.9)
+        for _ in range(4):
+            self.assertTrue(pool._global.acquire(False))
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
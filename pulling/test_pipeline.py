@@ -0,0 +1,81 @@
+"""
+Tests of the pipeline stages: every item moves on its own and one failing
+source does not stop the others.
+
+    python -m unittest test_pipeline
+"""
+
+import threading
+import time
+import unittest
+
+from pipeline import Pipeline, Stage
+
+
+def items(count):
+    return [ ("urn:%d" % index, index) for index in range(count) ]
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_stages(self):
+        stages = [Stage('double', lambda urn, value: value * 2, 3),
+                  Stage('add', lambda urn, value: value + 1, 2)]
+        results, errors = Pipeline(stages, queue_size=2).run(items(50))
+        self.assertEqual(errors, {})
+        self.assertEqual(results, dict(("urn:%d" % index, index * 2 + 1)
+                                       for index in range(50)))
+
+    def test_error_isolation(self):
+        def pull(urn, value):
+            if value % 5 == 0:
+                raise Exception("%s is down" % urn)
+            return value
+
+        def encode(urn, value):
+            if value == 3:
+                raise ValueError("bad document")
+            return value
+
+        stages = [Stage('pull', pull, 4), Stage('encode', encode, 2),
+                  Stage('upload', lambda urn, value: value)]
+        results, errors = Pipeline(stages).run(items(20))
+        self.assertEqual(sorted(errors), sorted(["urn:%d" % index
+            for index in range(0, 20, 5)] + ["urn:3"]))
+        self.assertEqual(errors["urn:5"], ('pull', "urn:5 is down"))
+        self.assertEqual(errors["urn:3"], ('encode', "bad document"))
+        self.assertEqual(sorted(results), sorted("urn:%d" % index
+            for index in range(20) if index % 5 and index != 3))
+
+    def test_skip(self):
+        stages = [Stage('check', lambda urn, value: value if value % 2
+                        else None),
+                  Stage('upload', lambda urn, value: value)]
+        results, errors = Pipeline(stages).run(items(10))
+        self.assertEqual(errors, {})
+        self.assertEqual(sorted(results.values()), [1, 3, 5, 7, 9])
+
+    def test_slow_item(self):
+        # A slow source only delays itself
+        done = {}
+        lock = threading.Lock()
+
+        def pull(urn, value):
+            if value == 0:
+                time.sleep(0.5)
+            with lock:
+                done[urn] = time.time()
+            return value
+
+        start = time.time()
+        stages = [Stage('pull', pull, 4), Stage('upload', lambda urn, value:
+                                                value, 2)]
+        results, errors = Pipeline(stages).run(items(8))
+        self.assertEqual(len(results), 8)
+        self.assertTrue(done["urn:0"] - start >= 0.5)
+        self.assertTrue(max(stamp for urn, stamp in done.items()
+                            if urn != "urn:0") - start < 0.4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+"""
+Tests of the deadlines, retries and hedged attempts of resilience.py, and of
+the retries of the encode stage of engine.pipeline_sources.
+
+    python -m unittest test_resilience
+"""
+
+import threading
+import time
+import unittest
+
+from engine import SourceType, pipeline_sources
+from payload import Payload
+from resilience import (Resilient, LatencyHistory, DeadlineExceeded,
+                        run_command)
+from uploader import UploadResult
+
+
+class Flaky(object):
+    """A call failing its first failures times."""
+
+    def __init__(self, failures, result='done'):
+        self.failures = failures
+        self.result = result
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise IOError("attempt %d failed" % self.calls)
+        return self.result
+
+
+class Result(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ResilientTest(unittest.TestCase):
+
+    def test_retry(self):
+        flaky = Flaky(1)
+        resilient = Resilient(deadline=5, retries=1, backoff=0.01)
+        self.assertEqual(resilient.call('urn:a', flaky, 'x'), 'done')
+        self.assertEqual(flaky.calls, 2)
+
+    def test_retries_exhausted(self):
+        flaky = Flaky(10)
+        resilient = Resilient(deadline=5, retries=2, backoff=0.01)
+        self.assertRaises(IOError, resilient.call, 'urn:a', flaky, 'x')
+        self.assertEqual(flaky.calls, 3)
+
+    def test_deadline(self):
+        resilient = Resilient(deadline=0.3, retries=1, backoff=0.01)
+        start = time.time()
+        self.assertRaises(DeadlineExceeded, resilient.call, 'urn:a',
+                          time.sleep, 2)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_no_retry_after_deadline(self):
+        # The backoff would end after the deadline
+        flaky = Flaky(1)
+        resilient = Resilient(deadline=0.5, retries=1, backoff=1)
+        self.assertRaises(IOError, resilient.call, 'urn:a', flaky, 'x')
+        self.assertEqual(flaky.calls, 1)
+
+    def test_late_result_closed(self):
+        result = Result()
+
+        def slow(value):
+            time.sleep(0.3)
+            return result
+
+        resilient = Resilient(deadline=0.1, retries=0)
+        self.assertRaises(DeadlineExceeded, resilient.call, 'urn:a', slow,
+                          'x')
+        time.sleep(0.5)
+        self.assertTrue(result.closed)
+
+    def test_hedge(self):
+        history = LatencyHistory()
+        for _ in range(10):
+            history.add('urn:a', 0.05)
+        results = [Result(), Result()]
+        calls = []
+        lock = threading.Lock()
+
+        def first_slow(value):
+            with lock:
+                attempt = len(calls)
+                calls.append(attempt)
+            if attempt == 0:
+                time.sleep(0.5)
+            return results[attempt]
+
+        resilient = Resilient(deadline=5, retries=0, hedge=True,
+                              history=history)
+        start = time.time()
+        self.assertTrue(resilient.call('urn:a', first_slow, 'x') is
+                        results[1])
+        self.assertTrue(time.time() - start < 0.4)
+        # The slow attempt loses and its result is released
+        time.sleep(0.6)
+        self.assertTrue(results[0].closed)
+        self.assertFalse(results[1].closed)
+
+    def test_run_command(self):
+        self.assertEqual(run_command("exit 3", 5), 3)
+        start = time.time()
+        self.assertRaises(DeadlineExceeded, run_command, "sleep 5", 0.2)
+        self.assertTrue(time.time() - start < 2)
+
+
+class Source(SourceType):
+    name = 'test'
+    doc_type = 'ps'
+    collection = 'topologies'
+
+    def __init__(self, encode_failures):
+        self.encode_failures = encode_failures
+        self.encoded = []
+
+    def pull(self, urn, url, deadline=None):
+        return Payload('<topology id="%s"/>' % urn)
+
+    def encode_file(self, urn, filename, unisencoder):
+        with open(filename) as doc:
+            self.encoded.append(doc.read())
+        if len(self.encoded) <= self.encode_failures:
+            raise Exception("unisencoder crashed")
+        tmpf = open(filename + '.json', 'w')
+        tmpf.write('{"id": "%s"}' % urn)
+        tmpf.close()
+        return tmpf.name
+
+
+class Uploader(object):
+    workers = 1
+
+    def upload_body(self, urn, body, url):
+        result = UploadResult(urn)
+        result.ok = True
+        result.bytes = len(body)
+        return result
+
+
+class EncodeRetryTest(unittest.TestCase):
+
+    def run_sources(self, source, retries):
+        return pipeline_sources({'urn:a': (source.name, 'http://ts/a')},
+                                {source.name: source}, 'http://unis',
+                                'unisencoder', Uploader(),
+                                resilient=Resilient(5, retries, 0.01))
+
+    def test_retry_input(self):
+        # Every attempt reads the whole pulled document
+        source = Source(1)
+        results, errors = self.run_sources(source, 1)
+        self.assertEqual(errors, {})
+        self.assertEqual(results['urn:a'].bytes, len('{"id": "urn:a"}'))
+        self.assertEqual(source.encoded, ['<topology id="urn:a"/>'] * 2)
+
+    def test_retry_error(self):
+        # The error of the encoder is reported, not the one of a retry
+        source = Source(10)
+        results, errors = self.run_sources(source, 1)
+        self.assertEqual(results, {})
+        self.assertEqual(errors['urn:a'], ('encode', "unisencoder crashed"))
+        self.assertEqual(len(source.encoded), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Tests of the normalized (C14N) hash of the documents and of the state kept
+between the runs.
+
+    python -m unittest test_state
+"""
+
+import os
+import os.path
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+from state import StateStore, content_hash
+
+RSPEC = """<?xml version="1.0"?>
+<rspec xmlns="http://www.geni.net/resources/rspec/3" type="advertisement"
+       generated="2014-01-01T00:00:00Z" expires="2014-01-02T00:00:00Z">
+  <node component_id="urn:node1" exclusive="false">
+    <interface component_id="urn:node1:eth0"/>
+  </node>
+</rspec>
+"""
+
+# Same document: other attribute order, blank text, comments, quoting and
+# volatile attributes
+SAME_RSPEC = """<rspec expires="2015-01-02T00:00:00Z"
+  generated="2015-01-01T00:00:00Z" type='advertisement'
+  xmlns="http://www.geni.net/resources/rspec/3"><!-- generated by an AM -->
+<node exclusive="false" component_id="urn:node1"><interface
+component_id="urn:node1:eth0"></interface></node></rspec>"""
+
+
+def document(content):
+    return StringIO.StringIO(content)
+
+
+class ContentHashTest(unittest.TestCase):
+
+    def test_normalized(self):
+        self.assertEqual(content_hash(document(RSPEC)),
+                         content_hash(document(SAME_RSPEC)))
+
+    def test_changed(self):
+        changed = RSPEC.replace('exclusive="false"', 'exclusive="true"')
+        self.assertNotEqual(content_hash(document(RSPEC)),
+                            content_hash(document(changed)))
+        # Only the root attributes are volatile
+        changed = RSPEC.replace('<interface ',
+                                '<interface generated="now" ')
+        self.assertNotEqual(content_hash(document(RSPEC)),
+                            content_hash(document(changed)))
+
+    def test_file(self):
+        tmpf = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            tmpf.write(RSPEC)
+            tmpf.close()
+            self.assertEqual(content_hash(tmpf.name),
+                             content_hash(document(SAME_RSPEC)))
+        finally:
+            os.remove(tmpf.name)
+
+    def test_not_xml(self):
+        digest = content_hash(document("not <xml"))
+        self.assertEqual(digest, content_hash(document("not <xml")))
+        self.assertNotEqual(digest, content_hash(document("not <xml ")))
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'state', 'pull.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_check(self):
+        state = StateStore(self.filename)
+        digest = state.check('urn:a', document(RSPEC))
+        self.assertEqual(digest, content_hash(document(RSPEC)))
+        # Only recorded once pushed
+        self.assertEqual(state.check('urn:a', document(RSPEC)), digest)
+        state.update('urn:a', digest)
+        self.assertEqual(state.check('urn:a', document(SAME_RSPEC)), None)
+        self.assertEqual(state.check('urn:a', document(RSPEC), force=True),
+                         digest)
+        self.assertEqual(state.check('urn:b', document(RSPEC)), digest)
+
+    def test_save(self):
+        state = StateStore(self.filename)
+        state.update('urn:a', content_hash(document(RSPEC)))
+        state.save()
+        state = StateStore(self.filename)
+        self.assertEqual(state.check('urn:a', document(SAME_RSPEC)), None)
+        self.assertEqual(os.listdir(os.path.dirname(self.filename)),
+                         ['pull.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+"""
+Parallel upload of UNIS documents over a shared keep-alive HTTPPool.
+"""
+
+import functools
+import gzip
+import logging
+import multiprocessing.pool
+import StringIO
+import time
+
+from httppool import HTTPPool, HTTPPoolError
+
+
+log = logging.getLogger('uploader')
+
+CONTENT_TYPE = 'application/perfsonar+json'
+
+DEFAULT_WORKERS = 8
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+
+def gzip_body(body):
+    """
+    Gzip compresses a request body.
+    """
+    buf = StringIO.StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb')
+    gz.write(body)
+    gz.close()
+    return buf.getvalue()
+
+
+class UploadResult(object):
+    """
+    The outcome of uploading one file.
+
+    Attributes:
+        urn: the URN of the document
+        status: the last HTTP status or None if no response was received
+        ok: True if UNIS accepted the document
+        attempts: the number of requests sent
+        latency: seconds spent including the retries
+        bytes: the number of bytes of the document
+        sent_bytes: the number of bytes on the wire per request
+        error: the error message if the upload failed
+        mode: how the document was sent, 'full' unless sent as a delta
+    """
+    def __init__(self, urn):
+        self.urn = urn
+        self.status = None
+        self.ok = False
+        self.attempts = 0
+        self.latency = 0.0
+        self.bytes = 0
+        self.sent_bytes = 0
+        self.error = None
+        self.mode = 'full'
+
+
+class Uploader(object):
+    """
+    Uploads UNIS documents in parallel, retrying with an exponential backoff
+    on 5xx responses and connection errors.
+
+    Params:
+        http_pool: the HTTPPool to use, a new one is created if None
+        workers: the maximum number of uploads in flight
+        compress: gzip the request bodies
+        retries: the number of retries after the first attempt
+        backoff: the delay in seconds before the first retry, doubled for
+            every other retry
+    """
+    def __init__(self, http_pool=None, workers=DEFAULT_WORKERS, compress=True,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.http_pool = http_pool or HTTPPool(max_connections=workers,
+                                               max_per_host=workers)
+        self.workers = workers
+        self.compress = compress
+        self.retries = retries
+        self.backoff = backoff
+
+    def upload_file(self, urn, filename, url):
+        """
+        POSTs one file to url.
+
+        Returns:
+            an UploadResult
+        """
+        with open(filename, 'rb') as unisf:
+            return self.upload_body(urn, unisf.read(), url)
+
+    def upload_body(self, urn, body, url):
+        """
+        POSTs one document to url.
+
+        Params:
+            urn: the URN of the document
+            body: the UNIS JSON
+            url: the UNIS collection URL
+
+        Returns:
+            an UploadResult
+        """
+        return self.request(urn, 'POST', url, body)
+
+    def request(self, urn, method, url, body=None):
+        """
+        Sends one request to UNIS.
+
+        Params:
+            urn: the URN of the document the request belongs to
+            method: the HTTP method
+            url: the UNIS URL
+            body: the UNIS JSON or None
+
+        Returns:
+            an UploadResult
+        """
+        result = UploadResult(urn)
+        headers = {}
+        if body is not None:
+            result.bytes = len(body)
+            headers['Content-Type'] = CONTENT_TYPE
+            if self.compress:
+                body = gzip_body(body)
+                headers['Content-Encoding'] = 'gzip'
+            result.sent_bytes = len(body)
+
+        start = time.time()
+        delay = self.backoff
+        while result.attempts <= self.retries:
+            if result.attempts > 0:
+                time.sleep(delay)
+                delay *= 2
+            result.attempts += 1
+            try:
+                status, _, reply = self.http_pool.request(method, url, body,
+                                                          headers)
+            except HTTPPoolError, exp:
+                result.status = None
+                result.error = str(exp)
+                continue
+            result.status = status
+            if status < 300:
+                result.ok = True
+                result.error = None
+                break
+            result.error = "HTTP %s: %s" % (status, reply[:200])
+            if status < 500:
+                break
+        result.latency = time.time() - start
+        if result.ok:
+            log.info("Sent %s %s (%d bytes, %d on the wire) to %s in %.3fs" % \
+                (method, urn, result.bytes, result.sent_bytes, url,
+                 result.latency))
+        else:
+            log.error("%s %s to %s failed after %d attempts: %s" % \
+                (method, urn, url, result.attempts, result.error))
+        return result
+
+    def upload(self, unis_files, url):
+        """
+        POSTs all the files to url in parallel.
+
+        Params:
+            unis_files: a dict of URN and the name of the file to be sent
+            url: the UNIS collection URL
+
+        Returns:
+            a dict of URN and UploadResult
+        """
+        if not unis_files:
+            return {}
+        pool = multiprocessing.pool.ThreadPool(
+            min(self.workers, len(unis_files)))
+        upload = functools.partial(self._upload_item, url=url)
+        try:
+            results = pool.map(upload, unis_files.items(), chunksize=1)
+        finally:
+            pool.close()
+        return dict((result.urn, result) for result in results)
+
+    def _upload_item(self, item, url):
+        return self.upload_file(item[0], item[1], url)
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        self.http_pool.close()